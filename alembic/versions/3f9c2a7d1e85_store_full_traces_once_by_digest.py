@@ -0,0 +1,48 @@
+"""Store full traces once, keyed by their digest
+
+Revision ID: 3f9c2a7d1e85
+Revises: b83e5f17c2d4
+Create Date: 2026-10-18 19:02:11.407356
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f9c2a7d1e85'
+down_revision = 'b83e5f17c2d4'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+TABLES = ('mastertrace', 'sitetrace', 'sitealiasmastertrace')
+# must match what checks.TracefileFetcher computes
+DIGEST = "encode(sha256(convert_to(\"full\", 'UTF8')), 'hex')"
+
+def upgrade():
+    op.create_table('traceblob',
+    sa.Column('digest', sa.String(), nullable=False),
+    sa.Column('full', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('digest')
+    )
+    for table in TABLES:
+        op.add_column(table, sa.Column('full_digest', sa.String(), nullable=True))
+        op.execute("""
+            INSERT INTO traceblob (digest, "full")
+            SELECT DISTINCT %s, "full" FROM %s WHERE "full" IS NOT NULL
+            ON CONFLICT DO NOTHING
+            """ % (DIGEST, table))
+        op.execute('UPDATE %s SET full_digest = %s WHERE "full" IS NOT NULL' % (table, DIGEST))
+        op.create_index(op.f('ix_%s_full_digest' % (table,)), table, ['full_digest'], unique=False)
+        op.create_foreign_key(None, table, 'traceblob', ['full_digest'], ['digest'])
+        op.drop_column(table, 'full')
+
+
+def downgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column('full', sa.String(), nullable=True))
+        op.execute('UPDATE %s SET "full" = traceblob."full" FROM traceblob WHERE traceblob.digest = %s.full_digest' % (table, table))
+        op.drop_constraint('%s_full_digest_fkey' % (table,), table, type_='foreignkey')
+        op.drop_index(op.f('ix_%s_full_digest' % (table,)), table_name=table)
+        op.drop_column(table, 'full_digest')
+    op.drop_table('traceblob')
@@ -0,0 +1,46 @@
+"""Queue check jobs for workers
+
+Revision ID: 4a7b0e2d9c61
+Revises: 9e1d6c3b5a70
+Create Date: 2026-10-18 21:03:52.218604
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a7b0e2d9c61'
+down_revision = '9e1d6c3b5a70'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # all existing checkruns are as complete as they will ever be
+    op.add_column('checkrun', sa.Column('completed', sa.Boolean(), server_default=sa.true(), nullable=False))
+    op.alter_column('checkrun', 'completed', server_default=sa.false())
+
+    op.create_table('checkjob',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('site_id', sa.Integer(), nullable=False),
+    sa.Column('checkrun_id', sa.Integer(), nullable=False),
+    sa.Column('due', sa.Boolean(), server_default=sa.true(), nullable=False),
+    sa.Column('worker', sa.String(), nullable=True),
+    sa.Column('leased_until', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('finished', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.ForeignKeyConstraint(['checkrun_id'], ['checkrun.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['site_id'], ['site.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_checkjob_site_id'), 'checkjob', ['site_id'], unique=False)
+    op.create_index('ix_checkjob_unfinished', 'checkjob', ['checkrun_id', 'id'], unique=False, postgresql_where=sa.text('finished IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_checkjob_unfinished', table_name='checkjob')
+    op.drop_index(op.f('ix_checkjob_site_id'), table_name='checkjob')
+    op.drop_table('checkjob')
+    op.drop_column('checkrun', 'completed')
@@ -0,0 +1,27 @@
+"""Carry forward results of sites that were not scheduled for checking
+
+Revision ID: 5d2b8e1f9a64
+Revises: a1f4e02c7b93
+Create Date: 2026-10-18 14:12:47.318205
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d2b8e1f9a64'
+down_revision = 'a1f4e02c7b93'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+TABLES = ('mastertrace', 'sitetrace', 'sitealiasmastertrace')
+
+def upgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column('carried_forward_from', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_column(table, 'carried_forward_from')
@@ -0,0 +1,42 @@
+"""Record fetch latency and adaptive timeouts
+
+Revision ID: 7c41a9e0d3b2
+Revises: 5d2b8e1f9a64
+Create Date: 2026-10-18 16:03:21.904417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c41a9e0d3b2'
+down_revision = '5d2b8e1f9a64'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('fetchstat',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('site_id', sa.Integer(), nullable=False),
+    sa.Column('checkrun_id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('elapsed', sa.Float(), nullable=False),
+    sa.Column('timeout', sa.Float(), nullable=False),
+    sa.Column('timed_out', sa.Boolean(), nullable=False),
+    sa.Column('adaptive_timeout', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['checkrun_id'], ['checkrun.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['site_id'], ['site.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_fetchstat_checkrun_id'), 'fetchstat', ['checkrun_id'], unique=False)
+    op.create_index(op.f('ix_fetchstat_site_id'), 'fetchstat', ['site_id'], unique=False)
+    op.add_column('checkoverview', sa.Column('adaptive_timeout', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+
+def downgrade():
+    op.drop_column('checkoverview', 'adaptive_timeout')
+    op.drop_index(op.f('ix_fetchstat_site_id'), table_name='fetchstat')
+    op.drop_index(op.f('ix_fetchstat_checkrun_id'), table_name='fetchstat')
+    op.drop_table('fetchstat')
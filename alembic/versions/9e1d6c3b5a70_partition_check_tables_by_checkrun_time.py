@@ -0,0 +1,73 @@
+"""Partition check tables by checkrun time
+
+Revision ID: 9e1d6c3b5a70
+Revises: 3f9c2a7d1e85
+Create Date: 2026-10-18 20:14:37.592018
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e1d6c3b5a70'
+down_revision = '3f9c2a7d1e85'
+branch_labels = None
+depends_on = None
+
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+# table -> indexed columns
+TABLES = {
+    'mastertrace':          ('site_id', 'checkrun_id', 'full_digest'),
+    'sitetrace':            ('site_id', 'checkrun_id', 'full_digest', 'trace_timestamp'),
+    'traceset':             ('site_id', 'checkrun_id'),
+    'sitealiasmastertrace': ('sitealias_id', 'checkrun_id', 'full_digest'),
+    'fetchstat':            ('site_id', 'checkrun_id'),
+    'checkoverview':        ('site_id', 'checkrun_id'),
+}
+# column -> (table, column, ondelete)
+REFERENCES = {
+    'site_id':      ('site', 'id', 'CASCADE'),
+    'sitealias_id': ('sitealias', 'id', 'CASCADE'),
+    'checkrun_id':  ('checkrun', 'id', 'CASCADE'),
+    'full_digest':  ('traceblob', 'digest', None),
+}
+
+def _rebuild(table, indexed, days=None):
+    """Copy table into a new one, partitioned by day if days is given.
+    """
+    op.rename_table(table, table + '_old')
+    if days is None:
+        op.execute("CREATE TABLE %s (LIKE %s_old INCLUDING DEFAULTS)" % (table, table))
+    else:
+        op.execute("CREATE TABLE %s (LIKE %s_old INCLUDING DEFAULTS) PARTITION BY RANGE (checkrun_timestamp)" % (table, table))
+        for day in days:
+            op.execute("CREATE TABLE %s_p%s PARTITION OF %s FOR VALUES FROM ('%s+00') TO ('%s+00')" % (
+                table, day.strftime('%Y%m%d'), table, day, day + datetime.timedelta(days=1)))
+    op.execute("INSERT INTO %s SELECT * FROM %s_old" % (table, table))
+    op.execute("ALTER SEQUENCE %s_id_seq OWNED BY %s.id" % (table, table))
+    op.drop_table(table + '_old')
+
+    op.create_primary_key('%s_pkey' % (table,), table, ['id'] if days is None else ['id', 'checkrun_timestamp'])
+    for column in indexed:
+        if column in REFERENCES:
+            (reftable, refcolumn, ondelete) = REFERENCES[column]
+            op.create_foreign_key('%s_%s_fkey' % (table, column), table, reftable, [column], [refcolumn], ondelete=ondelete)
+        op.create_index(op.f('ix_%s_%s' % (table, column)), table, [column], unique=False)
+
+
+def upgrade():
+    days = [row[0] for row in op.get_bind().execute(sa.text(
+        "SELECT DISTINCT date_trunc('day', timestamp AT TIME ZONE 'UTC') FROM checkrun WHERE timestamp IS NOT NULL"))]
+    for table, indexed in TABLES.items():
+        op.add_column(table, sa.Column('checkrun_timestamp', sa.DateTime(timezone=True), nullable=True))
+        op.execute("UPDATE %s SET checkrun_timestamp = checkrun.timestamp FROM checkrun WHERE checkrun.id = %s.checkrun_id" % (table, table))
+        op.alter_column(table, 'checkrun_timestamp', nullable=False)
+        _rebuild(table, indexed, days)
+
+
+def downgrade():
+    for table, indexed in TABLES.items():
+        _rebuild(table, indexed)
+        op.drop_column(table, 'checkrun_timestamp')
@@ -0,0 +1,26 @@
+"""Record values carried forward instead of observed
+
+Revision ID: a1f4e02c7b93
+Revises: c66b45d89dc9
+Create Date: 2026-10-18 11:40:02.530114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a1f4e02c7b93'
+down_revision = 'c66b45d89dc9'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('sitetrace', sa.Column('archive_update_carried_forward_from', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('traceset', sa.Column('carried_forward_from', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade():
+    op.drop_column('traceset', 'carried_forward_from')
+    op.drop_column('sitetrace', 'archive_update_carried_forward_from')
@@ -0,0 +1,48 @@
+"""Remember when each ftp-master trace was first and last seen
+
+Revision ID: a6c2e8f04d95
+Revises: f3a8d6b2c149
+Create Date: 2026-10-19 01:03:55.219467
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a6c2e8f04d95'
+down_revision = 'f3a8d6b2c149'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# helpers.FTPMASTER at the time of writing
+FTPMASTER = 'repo.kali.org'
+
+def upgrade():
+    op.create_table('ftpmastertrace',
+    sa.Column('trace_timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('first_seen', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('last_seen', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('trace_timestamp')
+    )
+    # Run-process keeps it up to date from here on; see
+    # helpers.update_ftpmaster_traces().
+    op.execute(sa.text("""
+        INSERT INTO ftpmastertrace (trace_timestamp, first_seen, last_seen)
+        SELECT
+            mastertrace.trace_timestamp,
+            min(mastertrace.checkrun_timestamp),
+            max(mastertrace.last_checkrun_timestamp)
+        FROM mastertrace JOIN
+            site ON mastertrace.site_id = site.id
+        WHERE
+            site.name = :ftpmastername AND
+            mastertrace.trace_timestamp IS NOT NULL
+        GROUP BY
+            mastertrace.trace_timestamp
+        """).bindparams(ftpmastername=FTPMASTER))
+
+
+def downgrade():
+    op.drop_table('ftpmastertrace')
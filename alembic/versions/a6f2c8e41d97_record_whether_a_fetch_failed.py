@@ -0,0 +1,26 @@
+"""Record whether a fetch failed
+
+Revision ID: a6f2c8e41d97
+Revises: e9d3b7c15a42
+Create Date: 2026-10-19 09:41:06.518230
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a6f2c8e41d97'
+down_revision = 'e9d3b7c15a42'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # We cannot tell for the fetches recorded so far; they stay NULL, and
+    # timeouts.TimeoutPolicy only learns from fetches recorded from now on.
+    op.add_column('fetchstat', sa.Column('error', sa.Boolean(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('fetchstat', 'error')
@@ -0,0 +1,63 @@
+"""Show what we learned over https
+
+Revision ID: b1e7d4a9c306
+Revises: a6f2c8e41d97
+Create Date: 2026-10-19 11:12:37.604918
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b1e7d4a9c306'
+down_revision = 'a6f2c8e41d97'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+TABLES = ('httpsmastertrace', 'httpssitetrace')
+
+def _columns(table):
+    return [row[0] for row in op.get_bind().execute(sa.text("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = :table
+        ORDER BY ordinal_position
+        """), {'table': table})]
+
+def _create_view(table):
+    """One row per checkrun a run covers, like the views of d7a2c4e9f813.
+    """
+    expressions = []
+    for c in _columns(table):
+        if c == 'checkrun_id':
+            expressions.append('checkrun.id AS checkrun_id')
+        elif c == 'checkrun_timestamp':
+            expressions.append('checkrun.timestamp AS checkrun_timestamp')
+        elif c != 'last_checkrun_timestamp':
+            expressions.append('%s.%s' % (table, c))
+    op.execute("""
+        CREATE VIEW %(table)s_by_checkrun AS
+        SELECT %(expressions)s
+        FROM %(table)s JOIN checkrun
+            ON checkrun.timestamp BETWEEN %(table)s.checkrun_timestamp AND %(table)s.last_checkrun_timestamp
+        """ % {'table': table, 'expressions': ', '.join(expressions)})
+
+
+def upgrade():
+    for table in TABLES:
+        _create_view(table)
+    # Filled by the next run-process.
+    op.add_column('sitestatus', sa.Column('httpsmastertrace_error', sa.String(), nullable=True))
+    op.add_column('sitestatus', sa.Column('httpsmastertrace_tls_failed', sa.Boolean(), nullable=True))
+    op.add_column('sitestatus', sa.Column('httpssitetrace_error', sa.String(), nullable=True))
+    op.add_column('sitestatus', sa.Column('httpssitetrace_tls_failed', sa.Boolean(), nullable=True))
+    op.add_column('sitestatus', sa.Column('httpssitetrace_tls_version', sa.String(), nullable=True))
+    op.add_column('sitestatus', sa.Column('httpssitetrace_certificate_expires', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade():
+    for column in ('httpssitetrace_certificate_expires', 'httpssitetrace_tls_version', 'httpssitetrace_tls_failed',
+                   'httpssitetrace_error', 'httpsmastertrace_tls_failed', 'httpsmastertrace_error'):
+        op.drop_column('sitestatus', column)
+    for table in reversed(TABLES):
+        op.execute("DROP VIEW %s_by_checkrun" % (table,))
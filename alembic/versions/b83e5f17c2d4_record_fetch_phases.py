@@ -0,0 +1,31 @@
+"""Record where the time of a fetch went
+
+Revision ID: b83e5f17c2d4
+Revises: 7c41a9e0d3b2
+Create Date: 2026-10-18 17:25:49.112873
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b83e5f17c2d4'
+down_revision = '7c41a9e0d3b2'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+PHASES = ('dns', 'connect', 'ttfb', 'transfer')
+
+def upgrade():
+    for phase in PHASES:
+        op.add_column('fetchstat', sa.Column(phase, sa.Float(), nullable=True))
+    op.add_column('fetchstat', sa.Column('bytes', sa.Integer(), nullable=True))
+    op.add_column('fetchstat', sa.Column('reused', sa.Boolean(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('fetchstat', 'reused')
+    op.drop_column('fetchstat', 'bytes')
+    for phase in reversed(PHASES):
+        op.drop_column('fetchstat', phase)
@@ -0,0 +1,35 @@
+"""Keep scores replayed under other scoring policies
+
+Revision ID: b8d4f1a7e362
+Revises: a6c2e8f04d95
+Create Date: 2026-10-19 02:41:08.730215
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b8d4f1a7e362'
+down_revision = 'a6c2e8f04d95'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('scorereplay',
+    sa.Column('policy', sa.String(), nullable=False),
+    sa.Column('site_id', sa.Integer(), nullable=False),
+    sa.Column('checkrun_id', sa.Integer(), nullable=False),
+    sa.Column('checkrun_timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['checkrun_id'], ['checkrun.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['site_id'], ['site.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('policy', 'site_id', 'checkrun_id')
+    )
+    op.create_index(op.f('ix_scorereplay_checkrun_id'), 'scorereplay', ['checkrun_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_scorereplay_checkrun_id'), table_name='scorereplay')
+    op.drop_table('scorereplay')
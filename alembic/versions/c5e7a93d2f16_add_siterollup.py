@@ -0,0 +1,35 @@
+"""Keep daily rollups of what we learned about each site
+
+Revision ID: c5e7a93d2f16
+Revises: b8d4f1a7e362
+Create Date: 2026-10-19 03:41:08.362915
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c5e7a93d2f16'
+down_revision = 'b8d4f1a7e362'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Filled from checkoverview and sitetrace by the next run-process.
+    op.create_table('siterollup',
+    sa.Column('site_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('first_checkrun_timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('updates', sa.Integer(), nullable=False),
+    sa.Column('max_age_count', sa.Integer(), nullable=False),
+    sa.Column('max_age_sum', sa.Float(), nullable=False),
+    sa.Column('max_age_sumsq', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['site_id'], ['site.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('site_id', 'day')
+    )
+
+
+def downgrade():
+    op.drop_table('siterollup')
@@ -0,0 +1,41 @@
+"""Extract often used sitetrace fields into columns
+
+Revision ID: c5f83d1a2e47
+Revises: 4a7b0e2d9c61
+Create Date: 2026-10-18 21:41:06.853190
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c5f83d1a2e47'
+down_revision = '4a7b0e2d9c61'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# column -> type, and how to get it from content, like checks.SitetraceFetcher.extract_fields does
+COLUMNS = (
+    ('upstream_mirror', sa.String(), "content->'upstream-mirror'->>'text'"),
+    ('creator', sa.String(), "coalesce(content->'creator'->>'text', content->'used ftpsync version'->>'text')"),
+    ('trigger', sa.String(), "content->'trigger'->>'text'"),
+    ('rsync_seconds', sa.Integer(),
+        r"""CASE WHEN content->'total time spent in rsync'->>'text' ~ '^\s*[0-9]{1,9}\s*$'
+                 THEN (content->'total time spent in rsync'->>'text')::integer END"""),
+    ('architectures', postgresql.ARRAY(sa.String()),
+        r"""string_to_array(regexp_replace(btrim(content->'architectures'->>'text', E' \t\r\n'), '\s+', ' ', 'g'), ' ')"""),
+    ('architectures_configuration', sa.String(), "content->'architectures-configuration'->>'text'"),
+)
+
+def upgrade():
+    for column, type_, _ in COLUMNS:
+        op.add_column('sitetrace', sa.Column(column, type_, nullable=True))
+    op.execute("UPDATE sitetrace SET %s WHERE content IS NOT NULL" % (
+        ', '.join('%s = %s' % (column, expression) for column, _, expression in COLUMNS),))
+
+
+def downgrade():
+    for column, _, _ in reversed(COLUMNS):
+        op.drop_column('sitetrace', column)
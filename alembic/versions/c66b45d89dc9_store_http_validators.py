@@ -0,0 +1,29 @@
+"""Store HTTP validators so we can do conditional requests
+
+Revision ID: c66b45d89dc9
+Revises: 017e0e81cb5c
+Create Date: 2026-10-18 09:12:40.118237
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c66b45d89dc9'
+down_revision = '017e0e81cb5c'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+TABLES = ('mastertrace', 'sitetrace', 'traceset', 'sitealiasmastertrace')
+
+def upgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column('http_last_modified', sa.String(), nullable=True))
+        op.add_column(table, sa.Column('http_etag', sa.String(), nullable=True))
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_column(table, 'http_etag')
+        op.drop_column(table, 'http_last_modified')
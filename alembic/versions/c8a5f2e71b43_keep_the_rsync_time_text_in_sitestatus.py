@@ -0,0 +1,27 @@
+"""Keep the rsync time text in sitestatus
+
+Revision ID: c8a5f2e71b43
+Revises: b1e7d4a9c306
+Create Date: 2026-10-19 12:40:18.377052
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c8a5f2e71b43'
+down_revision = 'b1e7d4a9c306'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Filled by the next run-process.
+    op.drop_column('sitestatus', 'rsync_seconds')
+    op.add_column('sitestatus', sa.Column('rsync_time', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('sitestatus', 'rsync_time')
+    op.add_column('sitestatus', sa.Column('rsync_seconds', sa.Integer(), nullable=True))
@@ -0,0 +1,101 @@
+"""Store runs of unchanged observations instead of a row per checkrun
+
+Revision ID: d7a2c4e9f813
+Revises: c5f83d1a2e47
+Create Date: 2026-10-18 22:27:45.106372
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd7a2c4e9f813'
+down_revision = 'c5f83d1a2e47'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+# table -> what its rows are about
+TABLES = {
+    'mastertrace':          'site_id',
+    'sitetrace':            'site_id',
+    'traceset':             'site_id',
+    'sitealiasmastertrace': 'sitealias_id',
+}
+NOT_VALUES = ('id', 'checkrun_id', 'checkrun_timestamp', 'last_checkrun_timestamp')
+
+def _columns(table):
+    return [row[0] for row in op.get_bind().execute(sa.text("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = :table
+        ORDER BY ordinal_position
+        """), {'table': table})]
+
+def _value_columns(table):
+    return [c for c in _columns(table) if c not in NOT_VALUES]
+
+def _create_view(table):
+    """One row per checkrun a run covers, looking like the table did before.
+    """
+    expressions = []
+    for c in _columns(table):
+        if c == 'checkrun_id':
+            expressions.append('checkrun.id AS checkrun_id')
+        elif c == 'checkrun_timestamp':
+            expressions.append('checkrun.timestamp AS checkrun_timestamp')
+        elif c != 'last_checkrun_timestamp':
+            expressions.append('%s.%s' % (table, c))
+    op.execute("""
+        CREATE VIEW %(table)s_by_checkrun AS
+        SELECT %(expressions)s
+        FROM %(table)s JOIN checkrun
+            ON checkrun.timestamp BETWEEN %(table)s.checkrun_timestamp AND %(table)s.last_checkrun_timestamp
+        """ % {'table': table, 'expressions': ', '.join(expressions)})
+
+
+def upgrade():
+    for table, key in TABLES.items():
+        op.add_column(table, sa.Column('last_checkrun_timestamp', sa.DateTime(timezone=True), nullable=True))
+        values = ', '.join('t.%s' % (c,) for c in _value_columns(table))
+        # A run goes on while the values stay the same from one checkrun
+        # to the very next; its first row stays and covers the others.
+        op.execute("""
+            WITH seq AS (
+                SELECT timestamp, row_number() OVER (ORDER BY timestamp) AS n FROM checkrun
+            ), marked AS (
+                SELECT t.id, t.%(key)s, t.checkrun_timestamp,
+                    CASE WHEN lag(seq.n) OVER w = seq.n - 1 AND
+                              lag(ROW(%(values)s)) OVER w IS NOT DISTINCT FROM ROW(%(values)s)
+                         THEN 0 ELSE 1 END AS starts
+                FROM %(table)s AS t JOIN seq ON seq.timestamp = t.checkrun_timestamp
+                WINDOW w AS (PARTITION BY t.%(key)s ORDER BY t.checkrun_timestamp)
+            ), numbered AS (
+                SELECT id, %(key)s, checkrun_timestamp,
+                    sum(starts) OVER (PARTITION BY %(key)s ORDER BY checkrun_timestamp) AS run
+                FROM marked
+            ), runs AS (
+                SELECT (array_agg(id ORDER BY checkrun_timestamp))[1] AS id, max(checkrun_timestamp) AS last
+                FROM numbered
+                GROUP BY %(key)s, run
+            )
+            UPDATE %(table)s SET last_checkrun_timestamp = runs.last
+            FROM runs WHERE %(table)s.id = runs.id
+            """ % {'table': table, 'key': key, 'values': values})
+        op.execute("DELETE FROM %s WHERE last_checkrun_timestamp IS NULL" % (table,))
+        op.alter_column(table, 'last_checkrun_timestamp', nullable=False)
+        op.create_index(op.f('ix_%s_last_checkrun_timestamp' % (table,)), table, ['last_checkrun_timestamp'], unique=False)
+        _create_view(table)
+
+
+def downgrade():
+    for table in TABLES:
+        op.execute("DROP VIEW %s_by_checkrun" % (table,))
+        values = _value_columns(table)
+        op.execute("""
+            INSERT INTO %(table)s (checkrun_id, checkrun_timestamp, last_checkrun_timestamp, %(columns)s)
+            SELECT checkrun.id, checkrun.timestamp, checkrun.timestamp, %(values)s
+            FROM %(table)s JOIN checkrun
+                ON checkrun.timestamp > %(table)s.checkrun_timestamp AND checkrun.timestamp <= %(table)s.last_checkrun_timestamp
+            """ % {'table': table, 'columns': ', '.join(values), 'values': ', '.join('%s.%s' % (table, c) for c in values)})
+        op.drop_index(op.f('ix_%s_last_checkrun_timestamp' % (table,)), table_name=table)
+        op.drop_column(table, 'last_checkrun_timestamp')
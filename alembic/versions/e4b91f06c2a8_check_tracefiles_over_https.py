@@ -0,0 +1,62 @@
+"""Check tracefiles over https
+
+Revision ID: e4b91f06c2a8
+Revises: d7a2c4e9f813
+Create Date: 2026-10-18 23:05:12.448190
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e4b91f06c2a8'
+down_revision = 'd7a2c4e9f813'
+branch_labels = None
+depends_on = None
+
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+TABLES = ('httpsmastertrace', 'httpssitetrace')
+
+
+def upgrade():
+    days = [row[0] for row in op.get_bind().execute(sa.text(
+        "SELECT DISTINCT date_trunc('day', timestamp AT TIME ZONE 'UTC') FROM checkrun WHERE timestamp IS NOT NULL"))]
+    for table in TABLES:
+        op.create_table(table,
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('site_id', sa.Integer(), nullable=False),
+        sa.Column('checkrun_id', sa.Integer(), nullable=False),
+        sa.Column('checkrun_timestamp', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('last_checkrun_timestamp', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('full_digest', sa.String(), nullable=True),
+        sa.Column('trace_timestamp', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.Column('tls_failed', sa.Boolean(), server_default=sa.false(), nullable=False),
+        sa.Column('tls_version', sa.String(), nullable=True),
+        sa.Column('certificate_expires', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('carried_forward_from', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('http_last_modified', sa.String(), nullable=True),
+        sa.Column('http_etag', sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(['checkrun_id'], ['checkrun.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['full_digest'], ['traceblob.digest'], ),
+        sa.ForeignKeyConstraint(['site_id'], ['site.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id', 'checkrun_timestamp'),
+        postgresql_partition_by='RANGE (checkrun_timestamp)'
+        )
+        for column in ('site_id', 'checkrun_id', 'last_checkrun_timestamp', 'full_digest'):
+            op.create_index(op.f('ix_%s_%s' % (table, column)), table, [column], unique=False)
+        for day in days:
+            op.execute("CREATE TABLE %s_p%s PARTITION OF %s FOR VALUES FROM ('%s+00') TO ('%s+00')" % (
+                table, day.strftime('%Y%m%d'), table, day, day + datetime.timedelta(days=1)))
+
+    op.add_column('fetchstat', sa.Column('tls', sa.Float(), nullable=True))
+    op.add_column('fetchstat', sa.Column('tls_resumed', sa.Boolean(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('fetchstat', 'tls_resumed')
+    op.drop_column('fetchstat', 'tls')
+    for table in reversed(TABLES):
+        op.drop_table(table)
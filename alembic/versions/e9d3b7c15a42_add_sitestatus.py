@@ -0,0 +1,58 @@
+"""Keep a snapshot of where each site stands for the pages
+
+Revision ID: e9d3b7c15a42
+Revises: c5e7a93d2f16
+Create Date: 2026-10-19 05:17:42.903614
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e9d3b7c15a42'
+down_revision = 'c5e7a93d2f16'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    # Filled by the next run-process.
+    op.create_table('sitestatus',
+    sa.Column('site_id', sa.Integer(), nullable=False),
+    sa.Column('checkrun_id', sa.Integer(), nullable=False),
+    sa.Column('checkrun_timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('checkoverview_error', sa.String(), nullable=True),
+    sa.Column('checkoverview_age', sa.Interval(), nullable=True),
+    sa.Column('checkoverview_score', sa.Float(), nullable=True),
+    sa.Column('checkoverview_aliases', postgresql.JSONB(), nullable=True),
+    sa.Column('mastertrace_error', sa.String(), nullable=True),
+    sa.Column('mastertrace_trace_timestamp', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('sitetrace_error', sa.String(), nullable=True),
+    sa.Column('sitetrace_trace_timestamp', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('sitetrace_content', postgresql.JSONB(), nullable=True),
+    sa.Column('traceset_id', sa.Integer(), nullable=True),
+    sa.Column('traceset_error', sa.String(), nullable=True),
+    sa.Column('traceset_traceset', postgresql.JSONB(), nullable=True),
+    sa.Column('recent_traceset', postgresql.JSONB(), nullable=True),
+    sa.Column('traceset_changes', sa.Integer(), nullable=False),
+    sa.Column('traceset_last_change', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('tracefile_last_seen', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('upstream_mirror', sa.String(), nullable=True),
+    sa.Column('creator', sa.String(), nullable=True),
+    sa.Column('trigger', sa.String(), nullable=True),
+    sa.Column('rsync_seconds', sa.Integer(), nullable=True),
+    sa.Column('architectures', postgresql.ARRAY(sa.String()), nullable=True),
+    sa.Column('architectures_configuration', sa.String(), nullable=True),
+    sa.Column('runs_per_day', sa.Float(), nullable=True),
+    sa.Column('max_age_avg', sa.Interval(), nullable=True),
+    sa.Column('max_age_stddev', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['checkrun_id'], ['checkrun.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['site_id'], ['site.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('site_id')
+    )
+
+
+def downgrade():
+    op.drop_table('sitestatus')
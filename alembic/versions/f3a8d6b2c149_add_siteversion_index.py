@@ -0,0 +1,32 @@
+"""Remember which version each site tracefile stands for
+
+Revision ID: f3a8d6b2c149
+Revises: e4b91f06c2a8
+Create Date: 2026-10-19 00:12:37.581904
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f3a8d6b2c149'
+down_revision = 'e4b91f06c2a8'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Filled in by run-process as it needs them.
+    op.create_table('siteversion',
+    sa.Column('site_id', sa.Integer(), nullable=False),
+    sa.Column('sitetrace_trace_timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('version', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('first_seen', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['site_id'], ['site.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('site_id', 'sitetrace_trace_timestamp')
+    )
+
+
+def downgrade():
+    op.drop_table('siteversion')
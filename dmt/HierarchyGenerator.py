@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 import argparse
+import copy
 import datetime
 import itertools
 import sys
@@ -14,10 +15,11 @@ if __name__ == '__main__' and __package__ is None:
 
 import dmt.db as db
 import dmt.helpers as helpers
+import dmt.StatusSnapshot as StatusSnapshot
 
 
 OUTFILE='mirror-hierarchy.html'
-RECENTCHANGE_HOURS=24*2
+RECENTCHANGE_HOURS=StatusSnapshot.RECENT_HOURS
 
 def powersetish(iterable):
     """return the powerset of iterable, from longest subset to smallest
@@ -167,7 +169,7 @@ def get_traceset_changes(cur, site_id, traces_last_change_cutoff):
         SELECT
             traceset.traceset,
             checkrun.timestamp
-        FROM traceset JOIN
+        FROM traceset_by_checkrun AS traceset JOIN
             checkrun  ON traceset.checkrun_id = checkrun.id
         WHERE
             traceset.site_id = %(site_id)s AND
@@ -180,12 +182,31 @@ def get_traceset_changes(cur, site_id, traces_last_change_cutoff):
             'traces_last_change_cutoff': traces_last_change_cutoff,
         })
 
-    it = iter(cur.fetchall())
-    last_ts = None
-    try:
-        last_ts = next(it)
-    except StopIteration:
-        pass
+    rows = cur.fetchall()
+    # a change at the start of the window is one from what we saw before it
+    cur.execute("""
+        SELECT traceset
+        FROM traceset
+        WHERE
+            site_id = %(site_id)s AND
+            traceset IS NOT NULL AND
+            checkrun_timestamp < %(traces_last_change_cutoff)s
+        ORDER BY
+            checkrun_timestamp DESC
+        LIMIT 1
+        """, {
+            'site_id': site_id,
+            'traces_last_change_cutoff': traces_last_change_cutoff,
+        })
+    previous = cur.fetchone()
+
+    it = iter(rows)
+    last_ts = previous
+    if last_ts is None:
+        try:
+            last_ts = next(it)
+        except StopIteration:
+            pass
     cnt = 0
     last_change = None
     for i in it:
@@ -196,7 +217,7 @@ def get_traceset_changes(cur, site_id, traces_last_change_cutoff):
 
     res = { 'cnt': cnt,
             'last_change': last_change,
-            'most_recent': last_ts['traceset'] if last_ts is not None else None,
+            'most_recent': rows[-1]['traceset'] if len(rows) > 0 else None,
           }
     return res
 
@@ -219,40 +240,37 @@ class Generator():
         cur2 = dbh.cursor()
 
         now = datetime.datetime.now()
-        checkrun = helpers.get_latest_checkrun(cur)
+        checkrun = helpers.get_sitestatus_checkrun(cur)
         if checkrun is None: return
         traces_last_change_cutoff = now - datetime.timedelta(hours=self.recent_hours)
 
+        # The latest traceset of the last few hours, if there is one, and
+        # otherwise what the latest checkrun got instead.
         cur.execute("""
-            SELECT DISTINCT ON (site.id)
+            SELECT
                 site.id AS site_id,
                 site.name,
                 site.http_override_host,
                 site.http_override_port,
                 site.http_path,
 
-                checkoverview.error AS checkoverview_error,
-                checkoverview.age AS checkoverview_age,
-                checkoverview.aliases AS checkoverview_aliases,
+                sitestatus.checkoverview_error,
+                sitestatus.checkoverview_age,
+                sitestatus.checkoverview_aliases,
+
+                sitestatus.traceset_id,
+                CASE WHEN sitestatus.recent_traceset IS NULL THEN sitestatus.traceset_error END AS traceset_error,
+                coalesce(sitestatus.recent_traceset, sitestatus.traceset_traceset) AS traces,
 
-                traceset.id AS traceset_id,
-                traceset.error AS traceset_error,
-                traceset.traceset AS traces
+                sitestatus.traceset_changes,
+                sitestatus.traceset_last_change
 
-            FROM
-                site
-                LEFT OUTER JOIN traceset ON site.id = traceset.site_id
-                LEFT OUTER JOIN checkoverview ON site.id = checkoverview.site_id
-                INNER JOIN checkrun ON checkrun.id = traceset.checkrun_id AND checkrun.id = checkoverview.checkrun_id
+            FROM sitestatus JOIN
+                site ON site.id = sitestatus.site_id
             WHERE
-                checkrun.timestamp > CURRENT_TIMESTAMP - INTERVAL '%(recent_hours)s hours'
-            ORDER BY
-                site.id,
-                traceset.traceset IS NULL ASC,
-                checkrun.timestamp DESC
-            """ % {
-                'recent_hours': self.recent_hours,
-            })
+                sitestatus.traceset_id IS NOT NULL OR
+                sitestatus.recent_traceset IS NOT NULL
+            """)
 
         mirrors = {}
         for row in cur.fetchall():
@@ -260,12 +278,21 @@ class Generator():
             error = []
 
             error.append(row['traceset_error'])
-            if row['traceset_id'] is None: error.append("No traceset information")
+            if row['traceset_id'] is None and row['traces'] is None: error.append("No traceset information")
             error.append(row['checkoverview_error'])
             row['error'] = "; ".join(filter(lambda x: x is not None, error))
             if row['error'] == "": row['error'] = None
 
-            row['traceset_changes'] = get_traceset_changes(cur2, row['site_id'], traces_last_change_cutoff)
+            # sitestatus has them for the default window only
+            last_change = row.pop('traceset_last_change')
+            if self.recent_hours == StatusSnapshot.RECENT_HOURS:
+                row['traceset_changes'] = {
+                    'cnt': row['traceset_changes'],
+                    'last_change': last_change,
+                    'most_recent': copy.copy(row['traces']),
+                }
+            else:
+                row['traceset_changes'] = get_traceset_changes(cur2, row['site_id'], traces_last_change_cutoff)
 
             if row['traces'] is not None:
                 try:
@@ -2,7 +2,6 @@
 
 import argparse
 import os
-import hashlib
 import sys
 import errno
 
@@ -30,14 +29,16 @@ class Generator():
         cur = dbh.cursor()
 
         cur.execute("""
-            SELECT sitetrace.full,  extract('epoch' from max(trace_timestamp)) AS ts FROM sitetrace WHERE sitetrace.full IS NOT NULL GROUP BY sitetrace.full
+            SELECT traceblob.digest, traceblob.full, latest.ts
+            FROM (SELECT full_digest, extract('epoch' from max(trace_timestamp))::float AS ts FROM sitetrace WHERE full_digest IS NOT NULL GROUP BY full_digest) AS latest
+            JOIN traceblob ON traceblob.digest = latest.full_digest
 
             """, {
             })
 
         for row in cur.fetchall():
             full = row['full']
-            digest = hashlib.sha256(full.encode('utf-8')).hexdigest()
+            digest = row['digest']
             dstdir = self.outfile+'/'+digest[:2]
             try:
                 os.mkdir(dstdir)
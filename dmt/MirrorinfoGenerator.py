@@ -53,10 +53,16 @@ class MirrorReport():
                 sitetrace.id AS sitetrace_id,
                 sitetrace.error AS sitetrace_error,
                 sitetrace.trace_timestamp AS sitetrace_trace_timestamp,
-                encode(digest(sitetrace.full, 'sha256'), 'hex') as sitetrace_trace_digest,
+                sitetrace.full_digest as sitetrace_trace_digest,
                 sitetrace.archive_update_in_progress AS sitetrace_archive_update_in_progress,
                 sitetrace.archive_update_required AS sitetrace_archive_update_required,
 
+                httpssitetrace.id AS httpssitetrace_id,
+                httpssitetrace.error AS httpssitetrace_error,
+                httpssitetrace.tls_failed AS httpssitetrace_tls_failed,
+                httpssitetrace.tls_version AS httpssitetrace_tls_version,
+                httpssitetrace.certificate_expires AS httpssitetrace_certificate_expires,
+
                 traceset.id AS traceset_id,
                 traceset.error AS traceset_error,
                 traceset.traceset AS traceset_traceset,
@@ -69,9 +75,10 @@ class MirrorReport():
                 checkoverview.score AS checkoverview_score
 
             FROM checkrun LEFT OUTER JOIN
-                (SELECT * FROM mastertrace   WHERE site_id = %(site_id)s) AS mastertrace   ON checkrun.id = mastertrace.checkrun_id LEFT OUTER JOIN
-                (SELECT * FROM sitetrace     WHERE site_id = %(site_id)s) AS sitetrace     ON checkrun.id = sitetrace.checkrun_id LEFT OUTER JOIN
-                (SELECT * FROM traceset      WHERE site_id = %(site_id)s) AS traceset      ON checkrun.id = traceset.checkrun_id LEFT OUTER JOIN
+                (SELECT * FROM mastertrace_by_checkrun WHERE site_id = %(site_id)s) AS mastertrace   ON checkrun.id = mastertrace.checkrun_id LEFT OUTER JOIN
+                (SELECT * FROM sitetrace_by_checkrun   WHERE site_id = %(site_id)s) AS sitetrace     ON checkrun.id = sitetrace.checkrun_id LEFT OUTER JOIN
+                (SELECT * FROM httpssitetrace_by_checkrun WHERE site_id = %(site_id)s) AS httpssitetrace ON checkrun.id = httpssitetrace.checkrun_id LEFT OUTER JOIN
+                (SELECT * FROM traceset_by_checkrun    WHERE site_id = %(site_id)s) AS traceset      ON checkrun.id = traceset.checkrun_id LEFT OUTER JOIN
                 (SELECT * FROM checkoverview WHERE site_id = %(site_id)s) AS checkoverview ON checkrun.id = checkoverview.checkrun_id
             WHERE
                 checkrun.timestamp >= %(check_age_cutoff)s
@@ -115,6 +122,8 @@ class MirrorReport():
             'now': now,
             'last_run': checkrun['timestamp'],
             'checks': reversed(checks),
+            # only with run-tests --https
+            'https': any(c['httpssitetrace_id'] is not None for c in checks),
             'allsitenames': self.allsitenames,
         }
         context['site'] = {
@@ -153,7 +162,7 @@ class Generator():
             FROM site LEFT JOIN
                 (
                  SELECT *
-                   FROM traceset
+                   FROM traceset_by_checkrun
                    WHERE checkrun_id = (SELECT id FROM checkrun ORDER BY checkrun.timestamp LIMIT 1)
                 ) AS traceset ON site.id = traceset.site_id
             """)
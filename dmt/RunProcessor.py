@@ -1,11 +1,16 @@
 #!/usr/bin/python3
 
 import argparse
+import collections
 import datetime
 import itertools
 import json
+import multiprocessing
 import sys
 import os
+import time
+
+import psycopg2.extras
 
 if __name__ == '__main__' and __package__ is None:
     from pathlib import Path
@@ -21,8 +26,12 @@ class MirrorProcessor():
     def __init__(self, site, mastertraces_lastseen):
         self.site = site
         self.mastertraces_lastseen = mastertraces_lastseen
+        self.new_versions = {}
 
-    def process(self, dbh):
+    def rows(self, dbh):
+        """Yield the checkoverview rows for the checkruns of our site
+        that have not been processed yet.
+        """
         cur = dbh.cursor()
         cur2 = dbh.cursor()
 
@@ -44,12 +53,22 @@ class MirrorProcessor():
 
                 sitetrace.id AS sitetrace_id,
                 sitetrace.error AS sitetrace_error,
-                sitetrace.trace_timestamp AS sitetrace_trace_timestamp
+                sitetrace.trace_timestamp AS sitetrace_trace_timestamp,
+
+                EXISTS (SELECT * FROM fetchstat
+                        WHERE fetchstat.site_id = %(site_id)s AND
+                              fetchstat.checkrun_id = checkrun.id AND
+                              fetchstat.kind IN ('mastertrace', 'sitetrace') AND
+                              fetchstat.timed_out AND
+                              fetchstat.adaptive_timeout) AS adaptive_timeout
 
             FROM checkrun LEFT OUTER JOIN
-                (SELECT * FROM mastertrace WHERE site_id = %(site_id)s) AS mastertrace ON checkrun.id = mastertrace.checkrun_id LEFT OUTER JOIN
-                (SELECT * FROM sitetrace   WHERE site_id = %(site_id)s) AS sitetrace   ON checkrun.id = sitetrace.checkrun_id
+                (SELECT * FROM mastertrace_by_checkrun WHERE site_id = %(site_id)s) AS mastertrace ON checkrun.id = mastertrace.checkrun_id LEFT OUTER JOIN
+                (SELECT * FROM sitetrace_by_checkrun   WHERE site_id = %(site_id)s) AS sitetrace   ON checkrun.id = sitetrace.checkrun_id
             WHERE
+              -- Only check runs all checks of which are done
+                checkrun.completed
+              AND
               -- Select check runs that have not been processed yet
                 checkrun.id NOT in (SELECT checkrun_id FROM checkoverview WHERE site_id = %(site_id)s)
               AND
@@ -108,7 +127,7 @@ class MirrorProcessor():
                     sitealiasmastertrace.trace_timestamp AS sitealiasmastertrace_trace_timestamp
 
                 FROM sitealias LEFT OUTER JOIN
-                    sitealiasmastertrace ON sitealias.id = sitealiasmastertrace.sitealias_id
+                    sitealiasmastertrace_by_checkrun AS sitealiasmastertrace ON sitealias.id = sitealiasmastertrace.sitealias_id
                 WHERE
                     site_id = %(site_id)s AND
                     checkrun_id = %(checkrun_id)s
@@ -118,82 +137,414 @@ class MirrorProcessor():
                     'site_id': self.site['id'],
                     'checkrun_id': row['checkrun_id'],
                 })
-            aliases = {}
-            for row2 in cur2.fetchall():
-                if row2['sitealiasmastertrace_id'] is None:
-                    continue
-                d = {}
-                if row2['sitealiasmastertrace_error'] is not None:
-                    d['error'] = row2['sitealiasmastertrace_error']
-                    d['ok'] = False
-                elif row2['sitealiasmastertrace_trace_timestamp'] == row['mastertrace_trace_timestamp']:
-                    d['ok'] = True
+            aliases = alias_results(row, cur2.fetchall())
+
+            def find_version(sitetrace_trace_timestamp):
+                # Like BatchProcessor, prefer what siteversion knows over the
+                # retained history of the site, which pruning may have cut short.
+                if sitetrace_trace_timestamp not in cache:
+                    key = (self.site['id'], sitetrace_trace_timestamp)
+                    known = known_versions(cur2, [key])
+                    if key not in known:
+                        found = find_versions(cur2, [key])
+                        self.new_versions.update(found)
+                        known = dict((k, version) for k, (version, _) in found.items())
+                    cache[sitetrace_trace_timestamp] = known.get(key)
+                return cache[sitetrace_trace_timestamp]
+
+            yield checkoverview_row(self.site['id'], row, aliases, find_version, self.mastertraces_lastseen)
+
+    def process(self, dbh):
+        cur = dbh.cursor()
+        rows = list(self.rows(dbh))
+        insert_checkoverview(cur, rows)
+        update_rollups(cur, rows)
+        insert_siteversions(cur, self.new_versions)
+        dbh.commit()
+        return len(rows)
+
+
+class BatchProcessor():
+    """Build the checkoverview rows of all sites at once.
+
+    Where MirrorProcessor does a few queries for every site and checkrun,
+    this finds all unprocessed (site, checkrun) pairs, their aliases, and
+    the versions their sitetraces stand for in one query each, and joins
+    them up in memory.  The rows it makes are the same.
+
+    Both take versions from siteversion.  Only those of site tracefiles
+    it does not know yet are worked out from the history of the site,
+    and stored there by process().
+
+    If site_ids is given, only those sites are processed.
+    """
+    def __init__(self, mastertraces_lastseen, site_ids=None):
+        self.mastertraces_lastseen = mastertraces_lastseen
+        self.site_ids = site_ids
+        self.new_versions = {}
+
+    def rows(self, dbh):
+        cur = dbh.cursor()
+
+        # The same (site, checkrun) pairs MirrorProcessor picks: all
+        # checkruns newer than the last one processed for a site, and
+        # older ones if we have data for them.  Unless a site has nothing
+        # processed yet, such older ones are among the completed
+        # checkruns newer than what every site has, or that nothing was
+        # processed for (say they completed late), so the runs of
+        # mastertrace and sitetrace are only matched against those
+        # instead of being expanded over all of history.  With site_ids,
+        # each of them only looks at those sites.
+        cur.execute("""
+            WITH processed AS (
+                SELECT site_id, max(checkrun_timestamp) AS last
+                FROM checkoverview
+                WHERE %(site_ids)s::integer[] IS NULL OR site_id = ANY(%(site_ids)s)
+                GROUP BY site_id
+            ), unprocessed AS (
+                SELECT id, timestamp
+                FROM checkrun
+                WHERE
+                    checkrun.completed AND
+                    (checkrun.timestamp > (SELECT min(last) FROM processed) OR
+                     NOT EXISTS (SELECT * FROM checkoverview
+                                 WHERE checkoverview.checkrun_id = checkrun.id AND
+                                       (%(site_ids)s::integer[] IS NULL OR checkoverview.site_id = ANY(%(site_ids)s))))
+            ), runs AS (
+                SELECT site_id, checkrun_timestamp, last_checkrun_timestamp FROM mastertrace
+                WHERE %(site_ids)s::integer[] IS NULL OR site_id = ANY(%(site_ids)s)
+              UNION ALL
+                SELECT site_id, checkrun_timestamp, last_checkrun_timestamp FROM sitetrace
+                WHERE %(site_ids)s::integer[] IS NULL OR site_id = ANY(%(site_ids)s)
+            ), candidates AS (
+                SELECT processed.site_id, unprocessed.id AS checkrun_id
+                FROM processed JOIN unprocessed ON unprocessed.timestamp > processed.last
+              UNION
+                SELECT runs.site_id, unprocessed.id
+                FROM runs JOIN unprocessed
+                    ON unprocessed.timestamp BETWEEN runs.checkrun_timestamp AND runs.last_checkrun_timestamp
+              UNION
+                SELECT runs.site_id, checkrun.id
+                FROM runs JOIN checkrun
+                    ON checkrun.timestamp BETWEEN runs.checkrun_timestamp AND runs.last_checkrun_timestamp
+                WHERE NOT EXISTS (SELECT * FROM processed WHERE processed.site_id = runs.site_id)
+            )
+            SELECT
+                candidates.site_id,
+                checkrun.id as checkrun_id,
+                checkrun.timestamp as checkrun_timestamp,
+
+                mastertrace.id AS mastertrace_id,
+                mastertrace.error AS mastertrace_error,
+                mastertrace.trace_timestamp AS mastertrace_trace_timestamp,
+
+                sitetrace.id AS sitetrace_id,
+                sitetrace.error AS sitetrace_error,
+                sitetrace.trace_timestamp AS sitetrace_trace_timestamp,
+
+                EXISTS (SELECT * FROM fetchstat
+                        WHERE fetchstat.site_id = candidates.site_id AND
+                              fetchstat.checkrun_id = checkrun.id AND
+                              fetchstat.kind IN ('mastertrace', 'sitetrace') AND
+                              fetchstat.timed_out AND
+                              fetchstat.adaptive_timeout) AS adaptive_timeout
+
+            FROM candidates JOIN
+                checkrun ON checkrun.id = candidates.checkrun_id LEFT OUTER JOIN
+                mastertrace_by_checkrun AS mastertrace ON mastertrace.site_id = candidates.site_id AND mastertrace.checkrun_id = checkrun.id LEFT OUTER JOIN
+                sitetrace_by_checkrun   AS sitetrace   ON sitetrace.site_id   = candidates.site_id AND sitetrace.checkrun_id   = checkrun.id
+            WHERE
+                checkrun.completed AND
+                NOT EXISTS (SELECT * FROM checkoverview
+                            WHERE checkoverview.site_id = candidates.site_id AND
+                                  checkoverview.checkrun_id = checkrun.id)
+            ORDER BY
+                candidates.site_id,
+                checkrun.timestamp
+            """, {
+                'site_ids': self.site_ids,
+            })
+        pending = cur.fetchall()
+        if len(pending) == 0:
+            return
+
+        cur.execute("""
+            SELECT
+                sitealias.site_id,
+                sitealiasmastertrace.checkrun_id,
+                sitealias.name as sitealias_name,
+
+                sitealiasmastertrace.id AS sitealiasmastertrace_id,
+                sitealiasmastertrace.error AS sitealiasmastertrace_error,
+                sitealiasmastertrace.trace_timestamp AS sitealiasmastertrace_trace_timestamp
+
+            FROM sitealias JOIN
+                sitealiasmastertrace_by_checkrun AS sitealiasmastertrace ON sitealias.id = sitealiasmastertrace.sitealias_id
+            WHERE
+                (%(site_ids)s::integer[] IS NULL OR sitealias.site_id = ANY(%(site_ids)s)) AND
+                sitealiasmastertrace.checkrun_id = ANY(%(checkrun_ids)s)
+            ORDER BY
+                sitealias.name
+            """, {
+                'site_ids': self.site_ids,
+                'checkrun_ids': sorted(set(row['checkrun_id'] for row in pending)),
+            })
+        aliases = collections.defaultdict(list)
+        for row in cur.fetchall():
+            aliases[(row['site_id'], row['checkrun_id'])].append(row)
+
+        wanted = sorted(set((row['site_id'], row['sitetrace_trace_timestamp']) for row in pending
+                            if row['sitetrace_trace_timestamp'] is not None))
+        versions = known_versions(cur, wanted)
+        self.new_versions = find_versions(cur, [key for key in wanted if key not in versions])
+        versions.update((key, version) for key, (version, _) in self.new_versions.items())
+
+        for row in pending:
+            yield checkoverview_row(row['site_id'], row,
+                                    alias_results(row, aliases[(row['site_id'], row['checkrun_id'])]),
+                                    lambda sitetrace_trace_timestamp: versions.get((row['site_id'], sitetrace_trace_timestamp)),
+                                    self.mastertraces_lastseen)
+
+    def process(self, dbh):
+        cur = dbh.cursor()
+        rows = list(self.rows(dbh))
+        insert_checkoverview(cur, rows)
+        update_rollups(cur, rows)
+        insert_siteversions(cur, self.new_versions)
+        dbh.commit()
+        return len(rows)
+
+
+def alias_results(row, alias_rows):
+    """The aliases column for the checkrun of row, from the
+    sitealiasmastertrace rows of that site and checkrun.
+    """
+    aliases = {}
+    for row2 in alias_rows:
+        if row2['sitealiasmastertrace_id'] is None:
+            continue
+        d = {}
+        if row2['sitealiasmastertrace_error'] is not None:
+            d['error'] = row2['sitealiasmastertrace_error']
+            d['ok'] = False
+        elif row2['sitealiasmastertrace_trace_timestamp'] == row['mastertrace_trace_timestamp']:
+            d['ok'] = True
+        else:
+            d['ok'] = True
+        aliases[row2['sitealias_name']] = d
+    return json.dumps(aliases, separators=(',', ':'))
+
+def checkoverview_row(site_id, row, aliases, find_version, mastertraces_lastseen):
+    """Summarize the checks of a site in a checkrun.
+
+    find_version(sitetrace_trace_timestamp) returns the version that
+    sitetrace stands for, or None if we cannot tell.
+    """
+    errors = []
+    for kind in ('master', 'site'):
+        if row[kind+'trace_error'] is not None:
+            errors.append(kind+"trace: "+row[kind+'trace_error'])
+        elif row[kind+'trace_trace_timestamp'] is None:
+            errors.append(kind+"trace unavailable")
+
+    data = {}
+    data['site_id'] = site_id
+    data['checkrun_id'] = row['checkrun_id']
+    data['checkrun_timestamp'] = row['checkrun_timestamp']
+    data['error'] = None
+    data['version'] = None
+    data['age'] = None
+    data['aliases'] = aliases
+    data['adaptive_timeout'] = False
+    if len(errors) > 0:
+        data['error'] = '; '.join(errors)
+        data['adaptive_timeout'] = row['adaptive_timeout']
+    else:
+        # compute version and age
+        ##
+        # The version we think this mirror is at is the contents of the master tracefile
+        # the last time the site tracefile got updated, i.e., the earliest time the
+        # sitetrace existed.
+        version = find_version(row['sitetrace_trace_timestamp'])
+        if version is None:
+            data['error'] = 'mastertrace validity uncertain'
+        else:
+            data['version'] = version
+
+            if data['version'] in mastertraces_lastseen:
+                if mastertraces_lastseen[data['version']] > row['checkrun_timestamp']:
+                    data['age'] = datetime.timedelta(0)
                 else:
-                    d['ok'] = True
-                aliases[row2['sitealias_name']] = d
-            aliases = json.dumps(aliases, separators=(',', ':'))
-
-            errors = []
-            for kind in ('master', 'site'):
-                if row[kind+'trace_error'] is not None:
-                    errors.append(kind+"trace: "+row[kind+'trace_error'])
-                elif row[kind+'trace_trace_timestamp'] is None:
-                    errors.append(kind+"trace unavailable")
-
-            data = {}
-            data['site_id'] = self.site['id']
-            data['checkrun_id'] = row['checkrun_id']
-            data['error'] = None
-            data['version'] = None
-            data['age'] = None
-            data['aliases'] = aliases
-            if len(errors) > 0:
-                data['error'] = '; '.join(errors)
+                    data['age'] = row['checkrun_timestamp'] - mastertraces_lastseen[data['version']]
             else:
-                if row['sitetrace_trace_timestamp'] in cache:
-                    res = cache[row['sitetrace_trace_timestamp']]
-                else:
-                    # compute version and age
-                    ##
-                    # The version we think this mirror is at is the contents of the master tracefile
-                    # the last time the site tracefile got updated, i.e., the earliest time the
-                    # sitetrace existed.
-                    #
-                    # Only consider checkruns where we got both, a mastertrace and a sitetrace.
-                    cur2.execute("""
-                        SELECT
-                            mastertrace.trace_timestamp AS mastertrace_trace_timestamp
-                        FROM checkrun JOIN
-                            (SELECT * FROM mastertrace WHERE site_id = %(site_id)s) AS mastertrace ON checkrun.id = mastertrace.checkrun_id JOIN
-                            (SELECT * FROM sitetrace   WHERE site_id = %(site_id)s) AS sitetrace   ON checkrun.id = sitetrace.checkrun_id
-                        WHERE
-                            sitetrace.trace_timestamp = %(sitetrace_trace_timestamp)s AND
-                            mastertrace.trace_timestamp IS NOT NULL
-                        ORDER BY
-                            checkrun.timestamp ASC
-                        LIMIT 1
-                        """, {
-                            'site_id': self.site['id'],
-                            'sitetrace_trace_timestamp': row['sitetrace_trace_timestamp']
-                        })
-                    res = cur2.fetchone()
-                    cache[row['sitetrace_trace_timestamp']] = res
-                if res is None:
-                    data['error'] = 'mastertrace validity uncertain'
-                else:
-                    data['version'] = res['mastertrace_trace_timestamp']
-
-                    if data['version'] in self.mastertraces_lastseen:
-                        if self.mastertraces_lastseen[data['version']] > row['checkrun_timestamp']:
-                            data['age'] = datetime.timedelta(0)
-                        else:
-                            data['age'] = row['checkrun_timestamp'] - self.mastertraces_lastseen[data['version']]
-                    else:
-                        data['error'] = 'unexpected mirror version: ' + str(data['version'])
-            cur2.execute("""INSERT INTO checkoverview (site_id, checkrun_id, error, version, age, aliases)
-                            VALUES (%(site_id)s, %(checkrun_id)s, %(error)s, %(version)s, %(age)s, %(aliases)s)""",
-                         data)
-        dbh.commit()
+                data['error'] = 'unexpected mirror version: ' + str(data['version'])
+    return data
+
+def insert_checkoverview(cur, rows):
+    psycopg2.extras.execute_values(cur,
+        """INSERT INTO checkoverview (site_id, checkrun_id, checkrun_timestamp, error, version, age, aliases, adaptive_timeout)
+           VALUES %s""", rows,
+        template="(%(site_id)s, %(checkrun_id)s, %(checkrun_timestamp)s, %(error)s, %(version)s, %(age)s, %(aliases)s, %(adaptive_timeout)s)",
+        page_size=1000)
+
+def known_versions(cur, keys):
+    """Look up the versions of (site_id, sitetrace_trace_timestamp)
+    keys in siteversion.
+    """
+    cur.execute("""
+        SELECT
+            siteversion.site_id,
+            siteversion.sitetrace_trace_timestamp,
+            siteversion.version
+        FROM
+            unnest(%(site_ids)s::integer[], %(trace_timestamps)s::timestamptz[]) AS wanted(site_id, trace_timestamp) JOIN
+            siteversion ON siteversion.site_id = wanted.site_id AND siteversion.sitetrace_trace_timestamp = wanted.trace_timestamp
+        """, {
+            'site_ids': [site_id for (site_id, _) in keys],
+            'trace_timestamps': [trace_timestamp for (_, trace_timestamp) in keys],
+        })
+    return dict(((row['site_id'], row['sitetrace_trace_timestamp']), row['version']) for row in cur.fetchall())
+
+def find_versions(cur, keys):
+    """Work out the versions of (site_id, sitetrace_trace_timestamp)
+    keys that siteversion does not know from the history of the sites.
+
+    Returns a dict of key -> (version, first_seen) for those we found.
+    """
+    if len(keys) == 0:
+        return {}
+    # Only consider checkruns where we got both, a mastertrace and a sitetrace.
+    # A run of each covers the checkruns from the later of their
+    # first to the earlier of their last checkruns.
+    cur.execute("""
+        SELECT DISTINCT ON (sitetrace.site_id, sitetrace.trace_timestamp)
+            sitetrace.site_id,
+            sitetrace.trace_timestamp AS sitetrace_trace_timestamp,
+            mastertrace.trace_timestamp AS mastertrace_trace_timestamp,
+            greatest(mastertrace.checkrun_timestamp, sitetrace.checkrun_timestamp) AS first_seen
+        FROM
+            unnest(%(site_ids)s::integer[], %(trace_timestamps)s::timestamptz[]) AS wanted(site_id, trace_timestamp) JOIN
+            sitetrace ON sitetrace.site_id = wanted.site_id AND sitetrace.trace_timestamp = wanted.trace_timestamp JOIN
+            mastertrace ON mastertrace.site_id = sitetrace.site_id AND
+                mastertrace.checkrun_timestamp <= sitetrace.last_checkrun_timestamp AND
+                sitetrace.checkrun_timestamp <= mastertrace.last_checkrun_timestamp
+        WHERE
+            mastertrace.trace_timestamp IS NOT NULL
+        ORDER BY
+            sitetrace.site_id,
+            sitetrace.trace_timestamp,
+            greatest(mastertrace.checkrun_timestamp, sitetrace.checkrun_timestamp) ASC,
+            mastertrace.checkrun_timestamp ASC
+        """, {
+            'site_ids': [site_id for (site_id, _) in keys],
+            'trace_timestamps': [trace_timestamp for (_, trace_timestamp) in keys],
+        })
+    return dict(((row['site_id'], row['sitetrace_trace_timestamp']), (row['mastertrace_trace_timestamp'], row['first_seen']))
+                for row in cur.fetchall())
+
+def insert_siteversions(cur, versions):
+    """Store the versions find_versions() worked out in siteversion."""
+    psycopg2.extras.execute_values(cur,
+        """INSERT INTO siteversion (site_id, sitetrace_trace_timestamp, version, first_seen)
+           VALUES %s ON CONFLICT DO NOTHING""",
+        [key + value for key, value in versions.items()],
+        page_size=1000)
+
+# The siterollup rows of the days of sites from start on, worked out from
+# their checkoverview and sitetrace rows.  A site's age is a maximum if
+# the next checkoverview row has a lower one, i.e., right before it got
+# updated; a site tracefile is an update the first time we see it.
+ROLLUP_QUERY = """
+    WITH affected AS (
+        SELECT * FROM unnest(%(site_ids)s::integer[], %(starts)s::timestamptz[]) AS affected(site_id, start)
+    ), overview AS (
+        SELECT
+            checkoverview.site_id,
+            checkoverview.checkrun_timestamp,
+            CASE WHEN age > lead(age) OVER (PARTITION BY checkoverview.site_id ORDER BY checkoverview.checkrun_timestamp)
+                 THEN extract(epoch from age) END AS max_age
+        FROM affected JOIN
+            checkoverview ON checkoverview.site_id = affected.site_id AND checkoverview.checkrun_timestamp >= affected.start
+    ), updates AS (
+        SELECT
+            sitetrace.site_id,
+            (sitetrace.checkrun_timestamp AT TIME ZONE 'UTC')::date AS day,
+            count(*) AS updates
+        FROM affected JOIN
+            sitetrace ON sitetrace.site_id = affected.site_id AND sitetrace.checkrun_timestamp >= affected.start
+        WHERE
+            sitetrace.trace_timestamp IS NOT NULL AND
+            NOT EXISTS (SELECT * FROM sitetrace AS earlier
+                        WHERE earlier.site_id = sitetrace.site_id AND
+                              earlier.trace_timestamp = sitetrace.trace_timestamp AND
+                              earlier.checkrun_timestamp < sitetrace.checkrun_timestamp)
+        GROUP BY 1, 2
+    )
+    SELECT
+        overview.site_id,
+        overview.day,
+        overview.first_checkrun_timestamp,
+        coalesce(updates.updates, 0) AS updates,
+        overview.max_age_count,
+        overview.max_age_sum,
+        overview.max_age_sumsq
+    FROM (
+        SELECT
+            site_id,
+            (checkrun_timestamp AT TIME ZONE 'UTC')::date AS day,
+            min(checkrun_timestamp) AS first_checkrun_timestamp,
+            count(max_age) AS max_age_count,
+            coalesce(sum(max_age), 0) AS max_age_sum,
+            coalesce(sum(max_age * max_age), 0) AS max_age_sumsq
+        FROM overview
+        GROUP BY 1, 2
+    ) AS overview LEFT OUTER JOIN
+        updates ON updates.site_id = overview.site_id AND updates.day = overview.day
+    """
+
+def update_rollups(cur, rows):
+    """Bring the siterollup rows up to date with newly stored checkoverview
+    rows.
+
+    Rows of a day are recomputed as a whole: those of the days of the new
+    rows, and of the day of the row before them, whose age may just have
+    become a maximum.  Sites without any yet get them for all their
+    history.
+    """
+    since = {}
+    for row in rows:
+        since[row['site_id']] = min(since.get(row['site_id'], row['checkrun_timestamp']), row['checkrun_timestamp'])
+    if len(since) == 0:
+        return
+    cur.execute("""
+        SELECT
+            wanted.site_id,
+            CASE WHEN EXISTS (SELECT * FROM siterollup WHERE siterollup.site_id = wanted.site_id)
+                 THEN date_trunc('day', coalesce(
+                        (SELECT max(checkrun_timestamp) FROM checkoverview
+                         WHERE checkoverview.site_id = wanted.site_id AND checkoverview.checkrun_timestamp < wanted.since),
+                        wanted.since) AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+                 ELSE '-infinity'
+                 END AS start
+        FROM unnest(%(site_ids)s::integer[], %(sinces)s::timestamptz[]) AS wanted(site_id, since)
+        """, {
+            'site_ids': list(since.keys()),
+            'sinces': list(since.values()),
+        })
+    affected = {
+        'site_ids': [],
+        'starts': [],
+    }
+    for row in cur.fetchall():
+        affected['site_ids'].append(row['site_id'])
+        affected['starts'].append(row['start'])
+    cur.execute("""
+        DELETE FROM siterollup
+        USING unnest(%(site_ids)s::integer[], %(starts)s::timestamptz[]) AS affected(site_id, start)
+        WHERE siterollup.site_id = affected.site_id AND siterollup.day >= (affected.start AT TIME ZONE 'UTC')::date
+        """, affected)
+    cur.execute("INSERT INTO siterollup (site_id, day, first_checkrun_timestamp, updates, max_age_count, max_age_sum, max_age_sumsq) " +
+                ROLLUP_QUERY, affected)
 
 class Processor():
     @staticmethod
@@ -201,23 +552,134 @@ class Processor():
         cur = dbh.cursor()
         mastertraces_lastseen = helpers.get_ftpmaster_traces_lastseen(cur)
 
-        cur.execute("""
-            SELECT
-                site.id,
-                site.name
-            FROM site
-            """)
-        for site in cur.fetchall():
+        for site in get_sites(cur):
             yield MirrorProcessor(site = site, mastertraces_lastseen = mastertraces_lastseen)
 
+    @staticmethod
+    def batch(dbh):
+        return BatchProcessor(helpers.get_ftpmaster_traces_lastseen(dbh.cursor()))
+
+def get_sites(cur):
+    cur.execute("""
+        SELECT
+            site.id,
+            site.name
+        FROM site
+        """)
+    return cur.fetchall()
+
+# Each worker process of a ParallelProcessor has its own connection, and
+# gets the things all shards need once, when it starts.
+worker = None
+
+def init_worker(dburl, mastertraces_lastseen, per_site):
+    global worker
+    worker = {
+        'dbh': db.RawDB(dburl),
+        'mastertraces_lastseen': mastertraces_lastseen,
+        'per_site': per_site,
+    }
+
+def process_shard(sites):
+    """Process some sites in a worker; return how many sites and rows that
+    was.
+    """
+    dbh = worker['dbh']
+    if worker['per_site']:
+        rows = sum(MirrorProcessor(site, worker['mastertraces_lastseen']).process(dbh) for site in sites)
+    else:
+        rows = BatchProcessor(worker['mastertraces_lastseen'], [site['id'] for site in sites]).process(dbh)
+    return (len(sites), rows)
+
+class ParallelProcessor():
+    """Spread the sites over jobs worker processes, each with its own
+    database connection, to catch up faster on many unprocessed checkruns.
+
+    Sites are handed out in shards, a few per worker, so a worker that is
+    done early can take another.  With progress, we report after each
+    shard how far we got and how fast.
+    """
+    SHARDS_PER_JOB = 4
+
+    def __init__(self, dburl, jobs, per_site=False, progress=False, file=sys.stdout):
+        self.dburl = dburl
+        self.jobs = jobs
+        self.per_site = per_site
+        self.progress = progress
+        self.file = file
+
+    def process(self, dbh):
+        cur = dbh.cursor()
+        mastertraces_lastseen = helpers.get_ftpmaster_traces_lastseen(cur)
+        sites = [dict(site) for site in get_sites(cur)]
+        count = max(1, min(len(sites), self.jobs * self.SHARDS_PER_JOB))
+        shards = [sites[i::count] for i in range(count)]
+
+        start = time.monotonic()
+        done_sites = 0
+        done_rows = 0
+        with multiprocessing.Pool(self.jobs, initializer=init_worker, initargs=(self.dburl, mastertraces_lastseen, self.per_site)) as pool:
+            for (shard_sites, rows) in pool.imap_unordered(process_shard, shards):
+                done_sites += shard_sites
+                done_rows += rows
+                if self.progress:
+                    elapsed = time.monotonic() - start
+                    print("%d of %d sites, %d rows in %.1fs; %.1f sites/s, %.1f rows/s" % (
+                        done_sites, len(sites), done_rows, elapsed,
+                        done_sites / elapsed if elapsed > 0 else 0, done_rows / elapsed if elapsed > 0 else 0), file=self.file)
+        return done_rows
+
+def compare(dbh, file=sys.stdout):
+    """Build the checkoverview rows with both processors, without storing
+    them, and report where they differ.  Returns the number of differences.
+    """
+    per_site = {}
+    for x in Processor.process(dbh):
+        for row in x.rows(dbh):
+            per_site[(row['site_id'], row['checkrun_id'])] = row
+    batch = dict(((row['site_id'], row['checkrun_id']), row) for row in Processor.batch(dbh).rows(dbh))
+    differences = 0
+    for key in sorted(set(per_site) | set(batch)):
+        if per_site.get(key) != batch.get(key):
+            differences += 1
+            print("site %d, checkrun %d:\n  per site: %s\n  batch:    %s" % (key + (per_site.get(key), batch.get(key))), file=file)
+    print("%d rows per site, %d rows batched, %d differences" % (len(per_site), len(batch), differences), file=file)
+    return differences
+
+def add_arguments(parser):
+    parser.add_argument('--per-site', help='process one site at a time instead of all at once', action='store_true', default=False)
+    parser.add_argument('--compare', help='process both ways and report differences, but store nothing', action='store_true', default=False)
+    parser.add_argument('--jobs', help='spread the sites over this many worker processes', type=int, default=1)
+    parser.add_argument('--progress', help='report progress and throughput', action='store_true', default=False)
+
+def run(args, dbh):
+    # with --compare, this is not committed either
+    helpers.update_ftpmaster_traces(dbh.cursor())
+    if args.compare:
+        if compare(dbh) > 0:
+            sys.exit(1)
+        return
+    start = time.monotonic()
+    if args.jobs > 1:
+        # so the workers see the ftp-master traces
+        dbh.commit()
+        rows = ParallelProcessor(args.dburl, args.jobs, args.per_site, args.progress).process(dbh)
+    elif args.per_site:
+        rows = sum(x.process(dbh) for x in Processor.process(dbh))
+    else:
+        rows = Processor.batch(dbh).process(dbh)
+    if args.progress:
+        elapsed = time.monotonic() - start
+        print("stored %d checkoverview rows in %.1fs; %.1f rows/s" % (rows, elapsed, rows / elapsed if elapsed > 0 else 0))
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
+    add_arguments(parser)
     args = parser.parse_args()
 
     dbh = db.RawDB(args.dburl)
-    for x in Processor.process(dbh):
-        x.process(dbh)
+    run(args, dbh)
 
 if __name__ == "__main__":
     main()
@@ -7,9 +7,7 @@ import json
 import sys
 import os
 
-# ignore checkrun for scoring purposes if more than this fraction
-# of checks resulted in errors
-IGNORE_RUN_THRESHOLD = 0.7
+import psycopg2.extras
 
 if __name__ == '__main__' and __package__ is None:
     from pathlib import Path
@@ -20,6 +18,7 @@ if __name__ == '__main__' and __package__ is None:
 
 import dmt.db as db
 import dmt.helpers as helpers
+import dmt.scoring as scoring
 
 class CheckrunScorer():
     def __init__(self, checkrun):
@@ -40,7 +39,7 @@ class CheckrunScorer():
                 'checkrun_id': self.checkrun['id'],
             })
         counts = cur.fetchone()
-        ignore_this_run = counts['total'] > 0 and float(counts['errors'])/counts['total'] > IGNORE_RUN_THRESHOLD
+        ignore_this_run = counts['total'] > 0 and float(counts['errors'])/counts['total'] > scoring.IGNORE_RUN_THRESHOLD
         #if ignore_this_run:
         #    print("IGNORING THIS RUN for scoring purposes:", counts['errors'], "out of", counts['total'], "failed.")
 
@@ -49,7 +48,8 @@ class CheckrunScorer():
                 checkoverview.site_id AS site_id,
                 checkoverview.id      AS checkoverview_id,
                 checkoverview.error   AS checkoverview_error,
-                checkoverview.age     AS checkoverview_age
+                checkoverview.age     AS checkoverview_age,
+                checkoverview.adaptive_timeout AS checkoverview_adaptive_timeout
 
             FROM checkoverview
             WHERE
@@ -94,6 +94,9 @@ class CheckrunScorer():
 
             if ignore_this_run:
                 adj = 0
+            elif row['checkoverview_adaptive_timeout']:
+                # we gave up on it earlier than usual; don't hold that against the mirror
+                adj = 0
             elif row['checkoverview_error'] is not None:
                 adj = -30
             elif row['checkoverview_age'] <= datetime.timedelta(hours = 4):
@@ -116,7 +119,6 @@ class CheckrunScorer():
                          {'checkoverview_id': row['checkoverview_id'],
                           'score': score}
                         )
-        dbh.commit()
 
 class Scorer():
     @staticmethod
@@ -135,14 +137,148 @@ class Scorer():
         for checkrun in cur.fetchall():
             yield CheckrunScorer(checkrun = checkrun)
 
+class BatchScorer():
+    """Score all unscored checkoverview rows at once.
+
+    CheckrunScorer goes through the checkruns in order and does a query
+    and an update for every row.  This loads the unscored rows, and the
+    rows of the same sites they follow, in one query, and scores each
+    site under policy, a scoring.ScoringPolicy; with NumPy if we have
+    it.  With the default policy the scores are the same, to the bit.
+    They are written back with one batched update.
+    """
+    def __init__(self, policy=None):
+        self.policy = policy if policy is not None else scoring.ScoringPolicy()
+
+    def load(self, cur):
+        """Return (total, errors) counts of the checkruns with unscored
+        rows, and the rows of all sites with unscored ones: from the last
+        row before their first unscored one on, in order.
+        """
+        cur.execute("""
+            SELECT
+                checkrun_id,
+                count(*) AS total,
+                count(error) AS errors
+            FROM checkoverview
+            WHERE
+                checkrun_id IN (SELECT checkrun_id FROM checkoverview WHERE score IS NULL)
+            GROUP BY
+                checkrun_id
+            """)
+        counts = dict((row['checkrun_id'], (row['total'], row['errors'])) for row in cur.fetchall())
+
+        cur.execute("""
+            WITH first AS (
+                SELECT
+                    checkoverview.site_id,
+                    min(checkrun.timestamp) AS timestamp
+                FROM checkrun JOIN
+                    checkoverview ON checkrun.id = checkoverview.checkrun_id
+                WHERE
+                    checkoverview.score IS NULL
+                GROUP BY
+                    checkoverview.site_id
+            ), since AS (
+                SELECT
+                    first.site_id,
+                    coalesce((SELECT max(checkrun.timestamp)
+                              FROM checkrun JOIN
+                                  checkoverview ON checkrun.id = checkoverview.checkrun_id
+                              WHERE
+                                  checkoverview.site_id = first.site_id AND
+                                  checkrun.timestamp < first.timestamp),
+                             first.timestamp) AS timestamp
+                FROM first
+            )
+            SELECT
+                checkoverview.site_id,
+                checkoverview.id,
+                checkoverview.checkrun_id,
+                checkoverview.checkrun_timestamp,
+                checkrun.timestamp,
+                checkoverview.score,
+                checkoverview.error,
+                checkoverview.age,
+                checkoverview.adaptive_timeout
+            FROM since JOIN
+                checkoverview ON checkoverview.site_id = since.site_id JOIN
+                checkrun ON checkrun.id = checkoverview.checkrun_id
+            WHERE
+                checkrun.timestamp >= since.timestamp
+            ORDER BY
+                checkoverview.site_id,
+                checkrun.timestamp
+            """)
+        return (counts, cur.fetchall())
+
+    def scores(self, cur):
+        """Return (checkoverview id, checkrun_timestamp, score) for all
+        unscored rows.
+        """
+        (counts, rows) = self.load(cur)
+        ignored = scoring.ignored_checkruns(self.policy, counts)
+        result = []
+        for (site_id, group) in itertools.groupby(rows, key=lambda row: row['site_id']):
+            for (row, score) in self.policy.site_scores(list(group), ignored):
+                result.append((row['id'], row['checkrun_timestamp'], score))
+        return result
+
+    def process(self, dbh):
+        cur = dbh.cursor()
+        scores = self.scores(cur)
+        psycopg2.extras.execute_values(cur,
+            """UPDATE checkoverview SET score = scores.score
+               FROM (VALUES %s) AS scores(id, checkrun_timestamp, score)
+               WHERE checkoverview.id = scores.id AND checkoverview.checkrun_timestamp = scores.checkrun_timestamp""",
+            scores,
+            template="(%s, %s::timestamptz, %s::double precision)",
+            page_size=1000)
+        return len(scores)
+
+def compare(dbh, file=sys.stdout):
+    """Score the unscored rows with both scorers, without storing anything,
+    and report where they differ.  Returns the number of differences.
+    """
+    batch = dict((id, score) for (id, _, score) in BatchScorer().scores(dbh.cursor()))
+    for x in Scorer.process(dbh):
+        x.process(dbh)
+    cur = dbh.cursor()
+    cur.execute("SELECT id, score FROM checkoverview WHERE id = ANY(%(ids)s)", {'ids': list(batch)})
+    per_checkrun = dict((row['id'], row['score']) for row in cur.fetchall())
+    dbh.rollback()
+    differences = 0
+    for id in sorted(set(per_checkrun) | set(batch)):
+        if per_checkrun.get(id) != batch.get(id):
+            differences += 1
+            print("checkoverview %d: per checkrun %r, batch %r" % (id, per_checkrun.get(id), batch.get(id)), file=file)
+    print("%d rows scored, %d differences" % (len(batch), differences), file=file)
+    return differences
+
+def add_arguments(parser):
+    parser.add_argument('--per-checkrun', help='score one checkrun and row at a time instead of all at once', action='store_true', default=False)
+    parser.add_argument('--compare-scores', help='score both ways and report differences, but store nothing', action='store_true', default=False)
+
+def run(args, dbh):
+    if args.compare_scores:
+        if compare(dbh) > 0:
+            sys.exit(1)
+    elif args.per_checkrun:
+        for x in Scorer.process(dbh):
+            x.process(dbh)
+            dbh.commit()
+    else:
+        BatchScorer().process(dbh)
+        dbh.commit()
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
+    add_arguments(parser)
     args = parser.parse_args()
 
     dbh = db.RawDB(args.dburl)
-    for x in Scorer.process(dbh):
-        x.process(dbh)
+    run(args, dbh)
 
 if __name__ == "__main__":
     main()
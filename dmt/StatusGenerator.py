@@ -28,7 +28,7 @@ class Generator():
         now = datetime.datetime.now(datetime.timezone.utc)
         ftpmastertrace = helpers.get_ftpmaster_trace(cur)
         if ftpmastertrace is None: ftpmastertrace = now
-        checkrun = helpers.get_latest_checkrun(cur)
+        checkrun = helpers.get_sitestatus_checkrun(cur)
         if checkrun is None: return
 
         cur.execute("""
@@ -38,69 +38,30 @@ class Generator():
                 site.http_override_port,
                 site.http_path,
 
-                checkoverview.error AS checkoverview_error,
-                checkoverview.age AS checkoverview_age,
-                checkoverview.score AS checkoverview_score,
-                checkoverview.aliases AS checkoverview_aliases,
-
-                mastertrace.error AS mastertrace_error,
-                mastertrace.trace_timestamp AS mastertrace_trace_timestamp,
-
-                sitetrace.error AS sitetrace_error,
-                sitetrace.trace_timestamp AS sitetrace_trace_timestamp,
-                sitetrace.content AS sitetrace_content,
-
-                traceset.id AS traceset_id,
-                traceset.error AS traceset_error,
-                traceset.traceset AS traceset_traceset,
-
-                runs_per_day.runs_per_day,
-
-                max_age.avg    AS max_age_avg,
-                max_age.stddev AS max_age_stddev
-
-            FROM site JOIN
-                checkoverview ON site.id = checkoverview.site_id LEFT OUTER JOIN
-                mastertrace ON site.id = mastertrace.site_id LEFT OUTER JOIN
-                sitetrace     ON site.id = sitetrace.site_id LEFT OUTER JOIN
-                traceset      ON site.id = traceset.site_id LEFT OUTER JOIN
-                (
-                 SELECT num_runs / days AS runs_per_day,
-                        site_id
-                 FROM (
-                  SELECT COUNT(distinct trace_timestamp) AS num_runs,
-                         EXTRACT(epoch from CURRENT_TIMESTAMP - MIN(checkrun.timestamp))/24/3600 AS days,
-                         sitetrace.site_id
-                  FROM sitetrace JOIN
-                       checkrun ON sitetrace.checkrun_id = checkrun.id
-                  WHERE sitetrace.trace_timestamp IS NOT NULL AND
-                        checkrun.timestamp > CURRENT_TIMESTAMP - INTERVAL '2 week'
-                  GROUP BY sitetrace.site_id) AS sub
-                ) AS runs_per_day ON site.id = runs_per_day.site_id  LEFT OUTER JOIN
-                (
-                 SELECT
-                        site_id,
-                        AVG(max_age) AS avg,
-                        STDDEV_SAMP(extract('epoch' from max_age)) as stddev
-                  FROM
-                        (SELECT
-                                site_id,
-                                CASE WHEN age > lead(age) OVER (PARTITION BY site_id ORDER BY checkrun.timestamp)
-                                     THEN age END AS max_age
-                                FROM checkrun LEFT OUTER JOIN
-                                     checkoverview ON checkrun.id = checkoverview.checkrun_id
-                                WHERE checkrun.timestamp > CURRENT_TIMESTAMP - INTERVAL '2 week'
-                        ) AS SUB
-                          GROUP BY site_id
-                 ) as max_age ON site.id = max_age.site_id
-            WHERE
-                (checkoverview.checkrun_id = %(checkrun_id)s) AND
-                (mastertrace  .checkrun_id = %(checkrun_id)s OR mastertrace.checkrun_id IS NULL) AND
-                (sitetrace    .checkrun_id = %(checkrun_id)s OR sitetrace.checkrun_id IS NULL) AND
-                (traceset     .checkrun_id = %(checkrun_id)s OR traceset.checkrun_id IS NULL)
-            """, {
-                'checkrun_id': checkrun['id']
-            })
+                sitestatus.checkoverview_error,
+                sitestatus.checkoverview_age,
+                sitestatus.checkoverview_score,
+                sitestatus.checkoverview_aliases,
+
+                sitestatus.mastertrace_error,
+                sitestatus.mastertrace_trace_timestamp,
+
+                sitestatus.sitetrace_error,
+                sitestatus.sitetrace_trace_timestamp,
+                sitestatus.sitetrace_content,
+
+                sitestatus.traceset_id,
+                sitestatus.traceset_error,
+                sitestatus.traceset_traceset,
+
+                sitestatus.runs_per_day,
+
+                sitestatus.max_age_avg,
+                sitestatus.max_age_stddev
+
+            FROM sitestatus JOIN
+                site ON site.id = sitestatus.site_id
+            """)
 
         mirrors = []
         traceset_elem_ctr = {}
@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+
+# Write the sitestatus table: one row per site, with where it stood at
+# the latest completed checkrun, or, if that has nothing on the site,
+# at the latest one that does.
+#
+# The pages used to find the latest checkrun and join site,
+# checkoverview and the observation tables with queries of their own,
+# some over time windows.  Now run-process does that once when it is
+# done, and they read sitestatus.  It is replaced as a whole, in one
+# transaction, so a page never sees half of one snapshot and half of
+# another.
+
+import argparse
+import sys
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.StatusSnapshot
+    __package__ = 'dmt.StatusSnapshot'
+
+import dmt.db as db
+
+# how far back to look for tracesets, and changes to them
+RECENT_HOURS = 24*2
+
+
+def update(cur, recent_hours=RECENT_HOURS):
+    """Replace the rows of sitestatus with those of the latest completed
+    checkrun.  Sites without a checkoverview row for it get one for the
+    most recent checkrun they have one for.  Returns how many there are
+    now.
+    """
+    cur.execute("DELETE FROM sitestatus")
+    cur.execute("""
+        INSERT INTO sitestatus (
+            site_id, checkrun_id, checkrun_timestamp,
+            checkoverview_error, checkoverview_age, checkoverview_score, checkoverview_aliases,
+            mastertrace_error, mastertrace_trace_timestamp,
+            sitetrace_error, sitetrace_trace_timestamp, sitetrace_content,
+            traceset_id, traceset_error, traceset_traceset,
+            httpsmastertrace_error, httpsmastertrace_tls_failed,
+            httpssitetrace_error, httpssitetrace_tls_failed, httpssitetrace_tls_version, httpssitetrace_certificate_expires,
+            recent_traceset, traceset_changes, traceset_last_change,
+            tracefile_last_seen, upstream_mirror, creator, trigger, rsync_time, architectures, architectures_configuration,
+            runs_per_day, max_age_avg, max_age_stddev)
+        WITH latest AS (
+            SELECT id, timestamp
+            FROM checkrun
+            WHERE completed
+            ORDER BY timestamp DESC
+            LIMIT 1
+        ), current AS (
+            SELECT checkoverview.*
+            FROM latest JOIN
+                checkoverview ON checkoverview.checkrun_id = latest.id AND checkoverview.checkrun_timestamp = latest.timestamp
+        ), overview AS (
+            SELECT * FROM current
+          UNION ALL
+            SELECT fallback.*
+            FROM site JOIN LATERAL (
+                SELECT *
+                FROM checkoverview
+                WHERE checkoverview.site_id = site.id
+                ORDER BY checkrun_timestamp DESC
+                LIMIT 1
+            ) AS fallback ON TRUE
+            WHERE NOT EXISTS (SELECT * FROM current WHERE current.site_id = site.id)
+        ), traceset_runs AS (
+            SELECT site_id, checkrun_timestamp, traceset
+            FROM traceset
+            WHERE
+                traceset IS NOT NULL AND
+                last_checkrun_timestamp >= CURRENT_TIMESTAMP - %(recent_hours)s * INTERVAL '1 hour'
+        ), traceset_changes AS (
+            -- changes to tracesets that started being seen in the window,
+            -- from the one seen before, even if that was before the window
+            SELECT
+                site_id,
+                count(*) FILTER (WHERE changed) AS cnt,
+                max(checkrun_timestamp) FILTER (WHERE changed) AS last_change
+            FROM (
+                SELECT
+                    site_id,
+                    checkrun_timestamp,
+                    traceset <> lag(traceset) OVER (PARTITION BY site_id ORDER BY checkrun_timestamp) AS changed
+                FROM (
+                    SELECT * FROM traceset_runs
+                  UNION ALL
+                    SELECT previous.*
+                    FROM (SELECT DISTINCT site_id FROM traceset_runs) AS sites JOIN LATERAL (
+                        SELECT site_id, checkrun_timestamp, traceset
+                        FROM traceset
+                        WHERE
+                            traceset.site_id = sites.site_id AND
+                            traceset.traceset IS NOT NULL AND
+                            traceset.last_checkrun_timestamp < CURRENT_TIMESTAMP - %(recent_hours)s * INTERVAL '1 hour'
+                        ORDER BY last_checkrun_timestamp DESC
+                        LIMIT 1
+                    ) AS previous ON TRUE
+                ) AS runs
+            ) AS sub
+            WHERE checkrun_timestamp >= CURRENT_TIMESTAMP - %(recent_hours)s * INTERVAL '1 hour'
+            GROUP BY site_id
+        ), rollup AS (
+            -- the last 14 days of the site, see RunProcessor.update_rollups()
+            SELECT
+                site_id,
+                SUM(updates) / NULLIF(EXTRACT(epoch from CURRENT_TIMESTAMP - MIN(first_checkrun_timestamp))/24/3600, 0) AS runs_per_day,
+                make_interval(secs => SUM(max_age_sum) / NULLIF(SUM(max_age_count), 0)) AS max_age_avg,
+                CASE WHEN SUM(max_age_count) > 1
+                     THEN sqrt(greatest(0, (SUM(max_age_sumsq) - SUM(max_age_sum)^2 / SUM(max_age_count)) / (SUM(max_age_count) - 1)))
+                     END AS max_age_stddev
+            FROM siterollup
+            WHERE day > (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')::date - 14
+            GROUP BY site_id
+        )
+        SELECT
+            checkoverview.site_id,
+            checkoverview.checkrun_id,
+            checkoverview.checkrun_timestamp,
+
+            checkoverview.error,
+            checkoverview.age,
+            checkoverview.score,
+            checkoverview.aliases,
+
+            mastertrace.error,
+            mastertrace.trace_timestamp,
+
+            sitetrace.error,
+            sitetrace.trace_timestamp,
+            sitetrace.content,
+
+            traceset.id,
+            traceset.error,
+            traceset.traceset,
+
+            httpsmastertrace.error,
+            httpsmastertrace.tls_failed,
+            httpssitetrace.error,
+            httpssitetrace.tls_failed,
+            httpssitetrace.tls_version,
+            httpssitetrace.certificate_expires,
+
+            recent_traceset.traceset,
+            coalesce(traceset_changes.cnt, 0),
+            traceset_changes.last_change,
+
+            tracefile.last_checkrun_timestamp,
+            tracefile.upstream_mirror,
+            tracefile.creator,
+            tracefile.trigger,
+            tracefile.content->'total time spent in rsync'->>'text',
+            tracefile.architectures,
+            tracefile.architectures_configuration,
+
+            rollup.runs_per_day,
+            rollup.max_age_avg,
+            rollup.max_age_stddev
+
+        FROM overview AS checkoverview LEFT OUTER JOIN
+            mastertrace_by_checkrun AS mastertrace ON mastertrace.site_id = checkoverview.site_id AND mastertrace.checkrun_id = checkoverview.checkrun_id LEFT OUTER JOIN
+            sitetrace_by_checkrun   AS sitetrace   ON sitetrace.site_id   = checkoverview.site_id AND sitetrace.checkrun_id   = checkoverview.checkrun_id LEFT OUTER JOIN
+            traceset_by_checkrun    AS traceset    ON traceset.site_id    = checkoverview.site_id AND traceset.checkrun_id    = checkoverview.checkrun_id LEFT OUTER JOIN
+            httpsmastertrace_by_checkrun AS httpsmastertrace ON httpsmastertrace.site_id = checkoverview.site_id AND httpsmastertrace.checkrun_id = checkoverview.checkrun_id LEFT OUTER JOIN
+            httpssitetrace_by_checkrun   AS httpssitetrace   ON httpssitetrace.site_id   = checkoverview.site_id AND httpssitetrace.checkrun_id   = checkoverview.checkrun_id LEFT OUTER JOIN
+            LATERAL (
+                SELECT traceset
+                FROM traceset
+                WHERE
+                    traceset.site_id = checkoverview.site_id AND
+                    traceset.traceset IS NOT NULL AND
+                    traceset.last_checkrun_timestamp >= CURRENT_TIMESTAMP - %(recent_hours)s * INTERVAL '1 hour'
+                ORDER BY last_checkrun_timestamp DESC
+                LIMIT 1
+            ) AS recent_traceset ON TRUE LEFT OUTER JOIN
+            traceset_changes ON traceset_changes.site_id = checkoverview.site_id LEFT OUTER JOIN
+            LATERAL (
+                SELECT *
+                FROM sitetrace
+                WHERE
+                    sitetrace.site_id = checkoverview.site_id AND
+                    sitetrace.content IS NOT NULL
+                ORDER BY last_checkrun_timestamp DESC
+                LIMIT 1
+            ) AS tracefile ON TRUE LEFT OUTER JOIN
+            rollup ON rollup.site_id = checkoverview.site_id
+        """, {
+            'recent_hours': recent_hours,
+        })
+    return cur.rowcount
+
+def run(args, dbh):
+    update(dbh.cursor())
+    dbh.commit()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
+    args = parser.parse_args()
+
+    dbh = db.RawDB(args.dburl)
+    run(args, dbh)
+
+if __name__ == "__main__":
+    main()
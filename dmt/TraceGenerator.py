@@ -24,30 +24,27 @@ class Generator():
         cur = dbh.cursor()
 
         now = datetime.datetime.now(datetime.timezone.utc)
-        checkrun = helpers.get_latest_checkrun(cur)
+        checkrun = helpers.get_sitestatus_checkrun(cur)
         if checkrun is None: return
 
         cur.execute("""
-            SELECT DISTINCT ON (site.id)
+            SELECT
                 site.name,
                 site.http_override_host,
                 site.http_override_port,
                 site.http_path,
 
-                sitetrace.content->'upstream-mirror'->>'text' AS upstream,
-                coalesce(sitetrace.content->'creator'->>'text', sitetrace.content->'used ftpsync version'->>'text') AS creator,
-                sitetrace.content->'trigger'->>'text' AS trigger,
-                sitetrace.content->'total time spent in rsync'->>'text' AS time_total,
-                sitetrace.content->'architectures-configuration'->>'text' AS arches
+                sitestatus.upstream_mirror AS upstream,
+                sitestatus.creator,
+                sitestatus.trigger,
+                sitestatus.rsync_time AS time_total,
+                sitestatus.architectures_configuration AS arches
 
             FROM
-                sitetrace
-                INNER JOIN site ON site.id = sitetrace.site_id
-                INNER JOIN checkrun ON checkrun.id = sitetrace.checkrun_id
+                sitestatus
+                INNER JOIN site ON site.id = sitestatus.site_id
             WHERE
-                checkrun.timestamp > CURRENT_TIMESTAMP - INTERVAL '1 day'
-                AND sitetrace.content IS NOT NULL
-            ORDER BY site.id, checkrun.timestamp DESC
+                sitestatus.tracefile_last_seen > CURRENT_TIMESTAMP - INTERVAL '1 day'
             """)
 
         mirrors = []
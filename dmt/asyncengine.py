@@ -0,0 +1,398 @@
+#!/usr/bin/python3
+
+# Run checks as coroutines on a single asyncio event loop instead of
+# a large thread pool.  Most of the time of a checkrun is spent waiting
+# for slow or dead mirrors, so we want many fetches in flight without
+# having one (mostly idle) thread for each.
+
+import asyncio
+import collections
+import concurrent.futures
+import email.parser
+import http.client
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+import urllib
+import urllib.error
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.asyncengine
+    __package__ = 'dmt.asyncengine'
+
+from dmt.checks import BaseCheck, MirrorFailureException
+import dmt.connpool as connpool
+import dmt.dnscache as dnscache
+
+MAX_CONCURRENT = 512
+MAX_PER_HOST = 4
+MAX_QUEUE_SIZE = 8192
+MAX_HEADERS = 100
+# StreamWriter.start_tls() is new in Python 3.11; before, TLS connections
+# are opened in one go and the handshake counts as connecting
+START_TLS = hasattr(asyncio.StreamWriter, 'start_tls')
+# threads for name lookups, which may block for up to dnscache.DNS_TIMEOUT
+RESOLVER_THREADS = 64
+
+
+class FetchResponse:
+    """The bits of a http.client.HTTPResponse that checks look at.
+    """
+    def __init__(self, url, status, reason, headers, tls=None):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.tls = tls
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class AsyncFetcher:
+    """Minimal asynchronous HTTP/1.1 client.
+
+    It only does what BaseCheck._fetch gets out of its connection pool: GET
+    requests over keep-alive connections, following redirects, and turning
+    HTTP errors into HTTPError exceptions.  The number of requests in flight
+    is limited both globally and per host.
+
+    Like connpool.ConnectionPool, idle connections are keyed by (scheme,
+    host, port), failed connects are remembered for a little while,
+    and TLS sessions are resumed.  Names are resolved through resolver, a
+    dnscache.DNSCache, in a thread pool of their own: a lookup that is
+    given up on keeps its thread until it finishes, and should not hold
+    up anything else run in the loop's default executor.
+    """
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_per_host=MAX_PER_HOST, timeout=BaseCheck.TIMEOUT, stats=None, resolver=None):
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.global_limit = asyncio.Semaphore(max_concurrent)
+        self.host_limits = collections.defaultdict(lambda: asyncio.Semaphore(self.max_per_host))
+        self.idle = collections.defaultdict(list)
+        self.failed = connpool.FailedConnects()
+        self.stats = stats if stats is not None else connpool.PoolStats()
+        self.resolver = resolver if resolver is not None else dnscache.DNSCache()
+        self.resolver_executor = concurrent.futures.ThreadPoolExecutor(max_workers=RESOLVER_THREADS, thread_name_prefix='resolver')
+        self.ssl_context = None
+
+    def _get_ssl_context(self):
+        if self.ssl_context is None:
+            self.ssl_context = connpool.create_ssl_context()
+        return self.ssl_context
+
+    async def _io(self, aw, timeout):
+        return await asyncio.wait_for(aw, timeout)
+
+    async def _open_connection(self, host, port, ssl_context, timeout, timing):
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        try:
+            infos = await self._io(loop.run_in_executor(self.resolver_executor, self.resolver.resolve, host, port), timeout)
+        finally:
+            timing.dns += time.monotonic() - start
+        err = None
+        connection = None
+        start = time.monotonic()
+        try:
+            for (_, _, _, _, sockaddr) in infos:
+                try:
+                    if ssl_context is not None and not START_TLS:
+                        connection = await self._io(asyncio.open_connection(sockaddr[0], sockaddr[1], ssl=ssl_context, server_hostname=host), timeout)
+                    else:
+                        connection = await self._io(asyncio.open_connection(sockaddr[0], sockaddr[1]), timeout)
+                    break
+                except OSError as e:
+                    err = e
+        finally:
+            timing.connect += time.monotonic() - start
+        if connection is None:
+            if err is not None:
+                raise err
+            raise OSError("getaddrinfo returns an empty list")
+        if ssl_context is None:
+            return connection
+
+        (reader, writer) = connection
+        if not START_TLS:
+            self.stats.handshake(writer.get_extra_info('ssl_object'), timing)
+            return (reader, writer)
+        start = time.monotonic()
+        try:
+            await self._io(writer.start_tls(ssl_context, server_hostname=host), timeout)
+        except:
+            writer.close()
+            raise
+        finally:
+            timing.tls += time.monotonic() - start
+        self.stats.handshake(writer.get_extra_info('ssl_object'), timing)
+        return (reader, writer)
+
+    async def _get(self, key, timeout, timing):
+        err = self.failed.get(key, timeout)
+        if err is not None:
+            self.stats.incr('connect_failed_cached')
+            raise err
+        while len(self.idle[key]) > 0:
+            (reader, writer) = self.idle[key].pop()
+            if not reader.at_eof():
+                return (reader, writer, True)
+            writer.close()
+
+        (scheme, host, port) = key
+        ssl_context = self._get_ssl_context() if scheme == 'https' else None
+        try:
+            (reader, writer) = await self._open_connection(host, port, ssl_context, timeout, timing)
+        except (OSError, asyncio.TimeoutError) as e:
+            if isinstance(e, asyncio.TimeoutError):
+                e = socket.timeout('timed out')
+            elif isinstance(e, ConnectionError) and e.errno is not None:
+                # asyncio words connect failures differently than the socket module
+                e = OSError(e.errno, os.strerror(e.errno))
+            # like connpool, including certificate and TLS protocol errors
+            err = urllib.error.URLError(e)
+            self.failed.add(key, err, timeout)
+            self.stats.incr('connect_failed')
+            raise err
+        self.stats.incr('opened')
+        return (reader, writer, False)
+
+    def _put(self, key, reader, writer):
+        if len(self.idle[key]) < connpool.MAX_IDLE_PER_HOST:
+            self.idle[key].append((reader, writer))
+        else:
+            writer.close()
+
+    async def _read_headers(self, reader, timeout):
+        lines = []
+        while True:
+            line = await self._io(reader.readline(), timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            lines.append(line)
+            if len(lines) > MAX_HEADERS:
+                raise http.client.HTTPException("got more than %d headers" % (MAX_HEADERS,))
+        hstring = b''.join(lines).decode('iso-8859-1')
+        return email.parser.Parser(_class=http.client.HTTPMessage).parsestr(hstring)
+
+    async def _read_body(self, reader, status, headers, sink, timeout, timing):
+        """Read the response body.
+
+        Returns the body and whether the connection can be used for another
+        request.  If the body goes to a sink, None is returned instead of it.
+        """
+        if status in (204, 304) or 100 <= status < 200:
+            return (b'', True)
+        chunks = []
+        to_sink = connpool.wants_sink(sink, status)
+        store = sink.feed if to_sink else chunks.append
+        def emit(chunk):
+            timing.bytes += len(chunk)
+            store(chunk)
+
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                line = await self._io(reader.readline(), timeout)
+                size = int(line.split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    # skip trailers
+                    while (await self._io(reader.readline(), timeout)) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                emit(await self._io(reader.readexactly(size), timeout))
+                await self._io(reader.readline(), timeout)
+            keep_alive = True
+        else:
+            length = headers.get('Content-Length')
+            if length is not None:
+                remaining = int(length)
+                while remaining > 0:
+                    chunk = await self._io(reader.readexactly(min(remaining, connpool.CHUNK_SIZE)), timeout)
+                    remaining -= len(chunk)
+                    emit(chunk)
+                keep_alive = True
+            else:
+                while True:
+                    chunk = await self._io(reader.read(connpool.CHUNK_SIZE), timeout)
+                    if not chunk: break
+                    emit(chunk)
+                keep_alive = False
+        if to_sink:
+            return (None, keep_alive)
+        return (b''.join(chunks), keep_alive)
+
+    async def _request(self, url, request_headers, sink, timeout, timing):
+        (key, netloc, selector) = connpool.split_url(url)
+        headers = connpool.build_request_headers(netloc, request_headers)
+        req = 'GET %s HTTP/1.1\r\n' % (selector,)
+        req += ''.join('%s: %s\r\n' % (k, v) for k, v in headers.items())
+        req += '\r\n'
+
+        # Wait for a slot for the host first: a request queued behind
+        # others to the same mirror should not hold one of the global
+        # slots meanwhile, and keep requests to other hosts waiting.
+        async with self.host_limits[key], self.global_limit:
+            start = time.monotonic()
+            try:
+                return await self._request_locked(url, key, req, sink, timeout, timing)
+            finally:
+                timing.elapsed += time.monotonic() - start
+
+    async def _request_locked(self, url, key, req, sink, timeout, timing):
+        while True:
+            (reader, writer, reused) = await self._get(key, timeout, timing)
+            timing.reused = reused
+            start = time.monotonic()
+            try:
+                writer.write(req.encode('iso-8859-1'))
+                await self._io(writer.drain(), timeout)
+
+                statusline = (await self._io(reader.readline(), timeout)).decode('iso-8859-1')
+                if not statusline:
+                    raise http.client.RemoteDisconnected("Remote end closed connection without response")
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                timing.ttfb += time.monotonic() - start
+                writer.close()
+                # The server closed an idle keep-alive connection on us.  Try again on a fresh one.
+                if reused:
+                    self.stats.incr('stale')
+                    continue
+                raise
+            except:
+                timing.ttfb += time.monotonic() - start
+                writer.close()
+                raise
+            break
+
+        try:
+            try:
+                try:
+                    version, status, reason = (statusline.rstrip('\r\n').split(None, 2) + [''])[:3]
+                    status = int(status)
+                except ValueError:
+                    raise http.client.BadStatusLine(statusline)
+                if not version.startswith('HTTP/'):
+                    raise http.client.BadStatusLine(statusline)
+
+                response_headers = await self._read_headers(reader, timeout)
+            finally:
+                timing.ttfb += time.monotonic() - start
+            start = time.monotonic()
+            try:
+                (data, keep_alive) = await self._read_body(reader, status, response_headers, sink, timeout, timing)
+            finally:
+                timing.transfer += time.monotonic() - start
+        except:
+            writer.close()
+            raise
+
+        self.stats.incr('requests')
+        if reused:
+            self.stats.incr('reused')
+        tls = None
+        sslobj = writer.get_extra_info('ssl_object')
+        if sslobj is not None:
+            tls = connpool.get_tls_info(sslobj)
+            self.ssl_context.remember(key[1], sslobj.session)
+        if version == 'HTTP/1.0' or response_headers.get('Connection', '').lower() == 'close':
+            keep_alive = False
+        if keep_alive:
+            self._put(key, reader, writer)
+        else:
+            writer.close()
+        return (data, FetchResponse(url, status, reason, response_headers, tls))
+
+    async def _fetch(self, url, request_headers, sink, timeout, timing):
+        for _ in range(connpool.MAX_REDIRECTS + 1):
+            (data, response) = await self._request(url, request_headers, sink, timeout, timing)
+            newurl = connpool.get_redirect(url, response)
+            if newurl is not None:
+                url = newurl
+                continue
+            if response.status >= 400 or response.status in connpool.REDIRECT_CODES:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            return (data, response)
+        raise urllib.error.HTTPError(url, response.status, "redirect error that would lead to an infinite loop", response.headers, None)
+
+    async def fetch(self, url, request_headers={}, sink=None, timeout=None, timing=None):
+        """Asynchronous counterpart of BaseCheck._fetch.
+
+        Returns a (data, response) tuple or raises MirrorFailureException
+        with the same kind of messages the synchronous fetcher produces.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if timing is None:
+            timing = connpool.FetchTiming()
+        try:
+            return await self._fetch(url, request_headers, sink, timeout, timing)
+        except (socket.timeout, asyncio.TimeoutError) as e:
+            raise MirrorFailureException(socket.timeout('timed out'), 'timed out fetching '+url)
+        except urllib.error.URLError as e:
+            raise MirrorFailureException(e, e.reason)
+        except OSError as e:
+            raise MirrorFailureException(e, e.strerror)
+        except Exception as e:
+            raise MirrorFailureException(e, 'other exception: '+str(e))
+
+    def close(self):
+        for conns in self.idle.values():
+            for (_, writer) in conns:
+                writer.close()
+        self.idle.clear()
+        # do not wait for lookups nobody is waiting for any more
+        self.resolver_executor.shutdown(wait=False)
+
+
+class AsyncCheckRunner:
+    """Run a list of checks on an asyncio event loop in a background thread,
+    handing back finished checks in completion order.
+    """
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_per_host=MAX_PER_HOST, resolver=None):
+        self.max_concurrent = max_concurrent
+        self.max_per_host = max_per_host
+        self.stats = connpool.PoolStats()
+        self.resolver = resolver if resolver is not None else dnscache.DNSCache()
+
+    async def _run_all(self, checklist, result_queue):
+        loop = asyncio.get_event_loop()
+        fetcher = AsyncFetcher(max_concurrent=self.max_concurrent, max_per_host=self.max_per_host, stats=self.stats, resolver=self.resolver)
+
+        async def run_one(checkitem):
+            assert(isinstance(checkitem, BaseCheck))
+            await checkitem.run_async(fetcher)
+            await loop.run_in_executor(None, result_queue.put, checkitem)
+
+        try:
+            await asyncio.gather(*(run_one(c) for c in checklist))
+        finally:
+            fetcher.close()
+
+    def _checking_thread(self, result_queue, checklist):
+        try:
+            asyncio.run(self._run_all(checklist, result_queue))
+        except Exception as e:
+            # hand it to the consumer, like AsyncResult.get() would in the threaded engine
+            result_queue.put(e)
+        result_queue.put(None)
+
+    def results(self, checklist):
+        result_queue = queue.Queue(MAX_QUEUE_SIZE)
+        t = threading.Thread(target=self._checking_thread, args=[result_queue, checklist], daemon=True)
+        t.start()
+
+        while True:
+            element = result_queue.get()
+            result_queue.task_done()
+
+            if element is None: break
+            if isinstance(element, Exception):
+                raise element
+            yield element
+        t.join()
@@ -1,12 +1,14 @@
 #!/usr/bin/python3
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 #import dateutil.parser
 import datetime
-from bs4 import BeautifulSoup
+import hashlib
 import re
 import socket
+import ssl
 import sys
+import time
 import urllib
 import urllib.request
 
@@ -18,8 +20,10 @@ if __name__ == '__main__' and __package__ is None:
     import dmt.checks
     __package__ = 'dmt.checks'
 
+import dmt.connpool as connpool
 import dmt.db as db
 import dmt.helpers as helpers
+import dmt.linkextractor as linkextractor
 
 class MirrorFailureException(Exception):
     def __init__(self, e, msg):
@@ -29,11 +33,22 @@ class MirrorFailureException(Exception):
             self.message = str(msg)
         self.origin = e
 
+# A request for a single document, yielded by a check's steps() generator.
+# If sink is given, the body of a successful response is fed to its feed()
+# method chunk by chunk while it is downloaded, instead of being returned.
+# kind says what we are fetching, for timeouts and fetch statistics.
+FetchRequest = namedtuple('FetchRequest', ['url', 'headers', 'sink', 'kind'], defaults=(None, None))
+
 class BaseCheck:
     TIMEOUT = 30
+    connection_pool = connpool.ConnectionPool()
+    KIND = None
+    # the table our result goes into
+    MODEL = None
+    SCHEME = 'http'
 
     def get_tracedir(self):
-        return helpers.get_tracedir(self.site)
+        return helpers.get_tracedir(self.site, self.SCHEME)
 
     @staticmethod
     def _decode(b):
@@ -44,12 +59,11 @@ class BaseCheck:
         return b.decode('iso8859-1')
 
     @staticmethod
-    def _fetch(url, request_headers={}):
+    def _fetch(url, request_headers={}, sink=None, timeout=None, timing=None):
+        if timeout is None:
+            timeout = BaseCheck.TIMEOUT
         try:
-            req = urllib.request.Request(url, headers=request_headers)
-            with urllib.request.urlopen(req, timeout=BaseCheck.TIMEOUT) as response:
-                data = response.read()
-                return (data, response)
+            return BaseCheck.connection_pool.fetch(url, request_headers, timeout=timeout, sink=sink, timing=timing)
         except socket.timeout as e:
             raise MirrorFailureException(e, 'timed out fetching '+url)
         except urllib.error.URLError as e:
@@ -59,23 +73,166 @@ class BaseCheck:
         except Exception as e:
             raise MirrorFailureException(e, 'other exception: '+str(e))
 
-    def __init__(self, site, checkrun_id):
+    @staticmethod
+    def _is_timeout(e):
+        origin = e.origin
+        if isinstance(origin, urllib.error.URLError):
+            origin = origin.reason
+        return isinstance(origin, socket.timeout)
+
+    @staticmethod
+    def _is_tls_error(e):
+        """Whether e is a certificate or TLS protocol error.
+        """
+        origin = e.origin
+        if isinstance(origin, urllib.error.URLError):
+            origin = origin.reason
+        return isinstance(origin, ssl.SSLError)
+
+    def __init__(self, site, checkrun_id, previous=None, timeouts=None):
         self.site      = site.__dict__
+        self.previous  = previous
+        self.timeouts  = timeouts
+        self.fetchstats = []
         self.result = {
             'site_id':     site.id,
             'checkrun_id': checkrun_id
         }
 
+    def _conditional_headers(self):
+        """Validators from our previous result, so the mirror can tell us
+        with a 304 if nothing changed since.
+        """
+        headers = {}
+        if self.previous is not None:
+            if self.previous.http_etag is not None:
+                headers['If-None-Match'] = self.previous.http_etag
+            if self.previous.http_last_modified is not None:
+                headers['If-Modified-Since'] = self.previous.http_last_modified
+        return headers
+
+    def _not_modified(self, response):
+        return response.status == 304 and self.previous is not None
+
+    def previous_observed(self, marker='carried_forward_from'):
+        """When the values in our previous result were actually fetched from the mirror.
+        """
+        observed = getattr(self.previous, marker)
+        if observed is None:
+            # fetched in every checkrun of the run, the last one included
+            observed = self.previous.last_checkrun_timestamp
+        return observed
+
+    def carry_forward(self):
+        """Re-use our previous result as a whole instead of fetching anything.
+        """
+        for column in self.previous.__table__.columns.keys():
+            if column in ('id', 'checkrun_id', 'checkrun_timestamp', 'last_checkrun_timestamp', 'carried_forward_from') or column in self.result:
+                continue
+            self.result[column] = getattr(self.previous, column)
+        self.result['carried_forward_from'] = self.previous_observed()
+
+    def _remember_validators(self, response):
+        for key, header in (('http_last_modified', 'Last-Modified'), ('http_etag', 'ETag')):
+            value = response.getheader(header)
+            if value is None and self._not_modified(response):
+                value = getattr(self.previous, key)
+            self.result[key] = value
+
+    def _prepare_fetch(self, req):
+        """Get the timeout for req, whether it was lowered from the default
+        based on the host's history, and a FetchTiming to fill in.
+        """
+        if self.timeouts is None:
+            timeout, adaptive = None, False
+        else:
+            timeout, adaptive = self.timeouts.get(self.result['site_id'], req.kind)
+        return (timeout, adaptive, connpool.FetchTiming())
+
+    def _record_fetch(self, req, timeout, adaptive, timing, exc):
+        timed_out = exc is not None and self._is_timeout(exc)
+        if timed_out and adaptive:
+            exc.message += ' (adaptive timeout of %.1fs)' % (timeout,)
+        self.fetchstats.append({
+            'site_id': self.result['site_id'],
+            'checkrun_id': self.result['checkrun_id'],
+            'kind': req.kind or self.KIND,
+            'elapsed': timing.elapsed,
+            'timeout': timeout if timeout is not None else self.TIMEOUT,
+            'timed_out': timed_out,
+            'error': exc is not None,
+            'adaptive_timeout': adaptive,
+            'dns': timing.dns,
+            'connect': timing.connect,
+            'tls': timing.tls,
+            'ttfb': timing.ttfb,
+            'transfer': timing.transfer,
+            'bytes': timing.bytes,
+            'reused': timing.reused,
+            'tls_resumed': timing.tls_resumed,
+        })
+
+    def steps(self):
+        """Do the actual work of this check.
+
+        This is a generator.  For every document the check needs it yields a
+        FetchRequest and is sent back the (data, response) tuple, or gets the
+        MirrorFailureException thrown in at the yield.  That way the same
+        check logic can be driven by the threaded engine (run()) as well as
+        by the asyncio engine (run_async()).
+        """
+        raise Exception("steps called on abstractish base class")
+
     def run(self):
-        raise Exception("run called on abstractish base class")
+        gen = self.steps()
+        reply, exc = None, None
+        while True:
+            try:
+                if exc is None:
+                    req = gen.send(reply)
+                else:
+                    req = gen.throw(exc)
+            except StopIteration:
+                return
+            (timeout, adaptive, timing) = self._prepare_fetch(req)
+            try:
+                reply, exc = self._fetch(req.url, request_headers=req.headers, sink=req.sink, timeout=timeout, timing=timing), None
+            except MirrorFailureException as e:
+                reply, exc = None, e
+            self._record_fetch(req, timeout, adaptive, timing, exc)
 
-    def store(self, session, checkrun_id):
-        raise Exception("store called on abstractish base class")
+    async def run_async(self, fetcher):
+        gen = self.steps()
+        reply, exc = None, None
+        while True:
+            try:
+                if exc is None:
+                    req = gen.send(reply)
+                else:
+                    req = gen.throw(exc)
+            except StopIteration:
+                return
+            (timeout, adaptive, timing) = self._prepare_fetch(req)
+            try:
+                reply, exc = await fetcher.fetch(req.url, request_headers=req.headers, sink=req.sink, timeout=timeout, timing=timing), None
+            except MirrorFailureException as e:
+                reply, exc = None, e
+            self._record_fetch(req, timeout, adaptive, timing, exc)
+
+    def rows(self):
+        """The (model, values) rows this check produced.
+        """
+        yield (self.MODEL, self.result)
 
 
 class TracefileFetcher(BaseCheck):
-    def __init__(self, site, checkrun_id, tracefilename, request_host=None):
-        super().__init__(site, checkrun_id)
+    # what we get from parsing a tracefile, and can re-use if it is unchanged
+    TRACE_FIELDS = ('full_digest', 'trace_timestamp', 'content')
+
+    def __init__(self, site, checkrun_id, tracefilename, request_host=None, previous=None):
+        super().__init__(site, checkrun_id, previous)
+        # the text of the tracefile, if we fetched one
+        self.full = None
         self.tracefilename = tracefilename
         self.request_headers = {}
         if request_host is not None:
@@ -84,7 +241,8 @@ class TracefileFetcher(BaseCheck):
     def parse_tracefile(self, rawcontents):
         try:
             decoded = self._decode(rawcontents)
-            self.result['full'] = decoded
+            self.full = decoded
+            self.result['full_digest'] = hashlib.sha256(decoded.encode('utf-8')).hexdigest()
             content = {}
 
             lines = decoded.split('\n')
@@ -113,38 +271,124 @@ class TracefileFetcher(BaseCheck):
         except:
             self.result['error'] = "Invalid tracefile"
 
-    def run(self):
+    def steps(self):
         try:
             traceurl = urllib.parse.urljoin(self.get_tracedir(), self.tracefilename)
-            (rawtracefilecontents, _) = self._fetch(traceurl, request_headers=self.request_headers)
-            self.parse_tracefile(rawtracefilecontents)
+            request_headers = dict(self.request_headers)
+            request_headers.update(self._conditional_headers())
+            (rawtracefilecontents, response) = yield FetchRequest(traceurl, request_headers, kind=self.KIND)
+            if self._not_modified(response):
+                for key in self.TRACE_FIELDS:
+                    self.result[key] = getattr(self.previous, key)
+            else:
+                self.parse_tracefile(rawtracefilecontents)
+            self._remember_validators(response)
         except MirrorFailureException as e:
-            self.result['error'] = e.message
+            self.failed(e)
+
+    def failed(self, e):
+        self.result['error'] = e.message
+
+    def _stored(self, digest):
+        """Whether the full text with digest is in traceblob already.
+        """
+        return self.previous is not None and self.previous.full_digest == digest
+
+    def rows(self):
+        """The full text goes into traceblob, once per distinct tracefile;
+        our result only references it by digest.
+        """
+        digest = self.result.get('full_digest')
+        if self.full is not None and not self._stored(digest):
+            yield (db.Traceblob, {'digest': digest, 'full': self.full})
+        yield from super().rows()
 
 class MastertraceFetcher(TracefileFetcher):
-    def __init__(self, site, checkrun_id):
-        super().__init__(site, checkrun_id, 'master')
+    KIND = 'mastertrace'
+    MODEL = db.Mastertrace
 
-    def store(self, session, checkrun_id):
-        i = db.Mastertrace(**self.result)
-        session.add(i)
+    def __init__(self, site, checkrun_id, previous=None):
+        super().__init__(site, checkrun_id, 'master', previous=previous)
 
 class SitetraceFetcher(TracefileFetcher):
-    def __init__(self, site, checkrun_id):
-        super().__init__(site, checkrun_id, site.name)
+    KIND = 'sitetrace'
+    MODEL = db.Sitetrace
+    ARCHIVE_UPDATE_FIELDS = ('archive_update_in_progress', 'archive_update_required')
+    # columns of their own for often used fields of the content
+    CONTENT_FIELDS = ('upstream_mirror', 'creator', 'trigger', 'rsync_seconds', 'architectures', 'architectures_configuration')
+    TRACE_FIELDS = TracefileFetcher.TRACE_FIELDS + CONTENT_FIELDS
 
-    def run(self):
-        super().run()
+    def __init__(self, site, checkrun_id, previous=None, carry_forward_cutoff=None):
+        super().__init__(site, checkrun_id, site.name, previous=previous)
+        self.carry_forward_cutoff = carry_forward_cutoff
+
+    @staticmethod
+    def extract_fields(content):
+        """Get the values of CONTENT_FIELDS from a parsed tracefile.
+
+        Keep in sync with the backfill in the migration that added them.
+        """
+        def text(*keys):
+            # the first one that is there and not null, like coalesce()
+            for key in keys:
+                value = content.get(key, {}).get('text')
+                if value is not None:
+                    return value
+            return None
+        rsync_seconds = text('total time spent in rsync')
+        if rsync_seconds is not None and re.fullmatch(r'\s*[0-9]{1,9}\s*', rsync_seconds):
+            rsync_seconds = int(rsync_seconds)
+        else:
+            rsync_seconds = None
+        architectures = text('architectures')
+        if architectures is not None:
+            architectures = architectures.split()
+        return {
+            'upstream_mirror': text('upstream-mirror'),
+            'creator': text('creator', 'used ftpsync version'),
+            'trigger': text('trigger'),
+            'rsync_seconds': rsync_seconds,
+            'architectures': architectures,
+            'architectures_configuration': text('architectures-configuration'),
+        }
+
+    def parse_tracefile(self, rawcontents):
+        super().parse_tracefile(rawcontents)
+        if 'content' in self.result:
+            self.result.update(self.extract_fields(self.result['content']))
+
+    def unchanged(self):
+        """Whether we got the very same tracefile as in our previous result.
+        """
+        return 'error' not in self.result and \
+               self.previous is not None and \
+               self.result.get('full_digest') == self.previous.full_digest
+
+    def carry_forward(self):
+        super().carry_forward()
+        self.result['archive_update_carried_forward_from'] = self.previous_observed('archive_update_carried_forward_from')
+
+    def steps(self):
+        yield from super().steps()
         if 'error' in self.result: return
 
+        # The site has not synced since last time, so skip fetching the
+        # Archive-Update-* files again unless what we know about them is too old.
+        if self.carry_forward_cutoff is not None and self.unchanged():
+            observed = self.previous_observed('archive_update_carried_forward_from')
+            if observed >= self.carry_forward_cutoff:
+                for key in self.ARCHIVE_UPDATE_FIELDS:
+                    self.result[key] = getattr(self.previous, key)
+                self.result['archive_update_carried_forward_from'] = observed
+                return
+
         base = helpers.get_baseurl(self.site)
         errors = []
         for key in ('Archive-Update-in-Progress', 'Archive-Update-Required'):
             url = base + key + '-' + self.site['name']
-            req = urllib.request.Request(url)
             lm = None
             try:
-                (_, response) = self._fetch(url)
+                (_, response) = yield FetchRequest(url, {}, kind='archive-update')
                 lm = response.getheader('Last-Modified')
             except MirrorFailureException as e:
                 if isinstance(e.origin, urllib.error.HTTPError) and (e.origin.code == 404 or e.origin.code == 403):
@@ -159,28 +403,73 @@ class SitetraceFetcher(TracefileFetcher):
         if len(errors) > 0:
             self.result['error'] = '; '.join(errors)
 
-    def store(self, session, checkrun_id):
-        i = db.Sitetrace(**self.result)
-        session.add(i)
-
 class SiteAliasFetcher(TracefileFetcher):
-    def __init__(self, site, checkrun_id, sitealias):
+    KIND = 'sitealias'
+    MODEL = db.SiteAliasMastertrace
+
+    def __init__(self, site, checkrun_id, sitealias, previous=None):
         #self.sitealias = sitealias
-        super().__init__(site, checkrun_id, 'master', request_host=sitealias.name)
+        super().__init__(site, checkrun_id, 'master', request_host=sitealias.name, previous=previous)
         del self.result['site_id']
         self.result['sitealias_id'] = sitealias.id
 
-    def store(self, session, checkrun_id):
-        i = db.SiteAliasMastertrace(**self.result)
-        session.add(i)
-
-def siteAliasChecker_generator(site, checkrun_id):
+class HttpsTracefileFetcher(TracefileFetcher):
+    """A tracefile fetched over https.
+
+    Besides the trace, we record the TLS version and when the certificate
+    expires, and whether an error is a certificate or TLS protocol problem
+    rather than an HTTP one.  The full content is the same as over http,
+    so we keep it there: it is only stored by us if http, the fetcher of
+    the same tracefile over http, did not get the same.
+    """
+    SCHEME = 'https'
+    TRACE_FIELDS = ('full_digest', 'trace_timestamp')
+
+    def __init__(self, site, checkrun_id, tracefilename, previous=None, http=None):
+        super().__init__(site, checkrun_id, tracefilename, previous=previous)
+        self.http = http
+        self.result['tls_failed'] = False
+
+    def _stored(self, digest):
+        # if http got it, it is stored, or being stored along with us
+        return super()._stored(digest) or \
+            (self.http is not None and self.http.result.get('full_digest') == digest)
+
+    def _remember_validators(self, response):
+        super()._remember_validators(response)
+        if response.tls is not None:
+            self.result['tls_version'] = response.tls.version
+            self.result['certificate_expires'] = response.tls.certificate_expires
+
+    def failed(self, e):
+        super().failed(e)
+        self.result['tls_failed'] = self._is_tls_error(e)
+
+class HttpsMastertraceFetcher(HttpsTracefileFetcher):
+    KIND = 'https-mastertrace'
+    MODEL = db.HttpsMastertrace
+
+    def __init__(self, site, checkrun_id, previous=None, http=None):
+        super().__init__(site, checkrun_id, 'master', previous=previous, http=http)
+
+class HttpsSitetraceFetcher(HttpsTracefileFetcher):
+    KIND = 'https-sitetrace'
+    MODEL = db.HttpsSitetrace
+
+    def __init__(self, site, checkrun_id, previous=None, http=None):
+        super().__init__(site, checkrun_id, site.name, previous=previous, http=http)
+
+def siteAliasChecker_generator(site, checkrun_id, previous_results=None):
     for alias in site.sitealiases:
-        yield SiteAliasFetcher(site, checkrun_id, alias)
+        previous = previous_results.get(db.SiteAliasMastertrace, alias.id) if previous_results is not None else None
+        yield SiteAliasFetcher(site, checkrun_id, alias, previous=previous)
 
 class TracesetFetcher(BaseCheck):
-    def __init__(self, site, checkrun_id):
-        super().__init__(site, checkrun_id)
+    KIND = 'traceset'
+    MODEL = db.Traceset
+
+    def __init__(self, site, checkrun_id, previous=None):
+        super().__init__(site, checkrun_id, previous)
 
     @staticmethod
     def _filter_tracefilenames(tracefilenames):
@@ -204,7 +493,7 @@ class TracesetFetcher(BaseCheck):
         if fulllink.startswith(tracedir):
             link = fulllink[len(tracedir):]
 
-        if re.fullmatch('\.*', link):
+        if re.fullmatch(r'\.*', link):
             return None
         elif re.fullmatch('[a-zA-Z0-9._-]*', link):
             return link
@@ -213,19 +502,19 @@ class TracesetFetcher(BaseCheck):
 
     def list_tracefiles(self):
         tracedir = self.get_tracedir()
-        (data, _) = self._fetch(tracedir)
+        collector = TracefileCollector(tracedir)
+        (_, response) = yield FetchRequest(tracedir, self._conditional_headers(), collector, self.KIND)
+        self._remember_validators(response)
+        if self._not_modified(response):
+            return list(self.previous.traceset)
+        return collector.close()
 
-        soup = BeautifulSoup(data, "html.parser")
-        links = soup.find_all('a')
-        links = filter(lambda x: 'href' in x.attrs, links)
-        links = map(lambda x: self._clean_link(x.get('href'), tracedir), links)
-        tracefiles = filter(lambda x: x is not None, links)
-        tracefiles = self._filter_tracefilenames(tracefiles)
-        return sorted(set(tracefiles))
+    def can_carry_forward(self, cutoff):
+        return self.previous is not None and self.previous_observed() >= cutoff
 
-    def run(self):
+    def steps(self):
         try:
-            traces = self.list_tracefiles()
+            traces = yield from self.list_tracefiles()
 
             if len(traces) > 0:
                 self.result['traceset'] = traces
@@ -234,6 +523,155 @@ class TracesetFetcher(BaseCheck):
         except MirrorFailureException as e:
             self.result['error'] = e.message
 
-    def store(self, session, checkrun_id):
-        i = db.Traceset(**self.result)
-        session.add(i)
+class TracefileCollector:
+    """Collect tracefile names from a trace directory listing while it is
+    being downloaded.
+    """
+    def __init__(self, tracedir):
+        self.tracedir = tracedir
+        self.extractor = linkextractor.HrefExtractor()
+        self.tracefiles = set()
+
+    def _add(self, hrefs):
+        for href in hrefs:
+            link = TracesetFetcher._clean_link(href, self.tracedir)
+            if link is not None:
+                self.tracefiles.update(TracesetFetcher._filter_tracefilenames([link]))
+
+    def feed(self, data):
+        self._add(self.extractor.feed(data))
+
+    def close(self):
+        self._add(self.extractor.close())
+        return sorted(self.tracefiles)
+
+class SiteCheckBatch(BaseCheck):
+    """The check plan for one site.
+
+    All checks of a site are run one after the other, so that they all can
+    use the same keep-alive connection to the mirror.
+
+    The sitetrace goes first.  If it is unchanged since our previous result
+    the mirror has not synced, and neither its Archive-Update-* files nor its
+    trace directory are likely to have changed.  So, if carry_forward_cutoff
+    is given and we observed those after it, we carry the old values forward
+    instead of fetching them again.  Carried forward rows record when the
+    values were actually observed.
+
+    If the scheduler decided the site is not due for a check this run, and
+    our previous check of it went fine, we fetch nothing at all and carry
+    all its previous results forward.
+
+    Every fetch of the batch is timed, with timeouts from timeouts (a
+    timeouts.TimeoutPolicy) if given, and recorded in fetchstat.
+
+    With https, the site and master tracefiles are also fetched over
+    https, one after the other over the same TLS connection.  If the
+    site tracefile could not be fetched over http, we do not try https
+    at all: the site is most likely down, and would only make us wait
+    for another timeout.
+    """
+    def __init__(self, site, checkrun_id, previous_results=None, carry_forward_cutoff=None, due=True, timeouts=None, https=False):
+        super().__init__(site, checkrun_id, timeouts=timeouts)
+        def previous(model):
+            return previous_results.get(model, site.id) if previous_results is not None else None
+        self.carry_forward_cutoff = carry_forward_cutoff
+        self.sitetrace = SitetraceFetcher(site, checkrun_id, previous=previous(db.Sitetrace), carry_forward_cutoff=carry_forward_cutoff)
+        self.mastertrace = MastertraceFetcher(site, checkrun_id, previous=previous(db.Mastertrace))
+        self.traceset = TracesetFetcher(site, checkrun_id, previous=previous(db.Traceset))
+        self.checks = [
+            self.sitetrace,
+            self.mastertrace,
+            self.traceset,
+        ]
+        self.checks.extend(siteAliasChecker_generator(site, checkrun_id, previous_results))
+        self.https_checks = []
+        if https:
+            self.https_checks = [
+                HttpsSitetraceFetcher(site, checkrun_id, previous=previous(db.HttpsSitetrace), http=self.sitetrace),
+                HttpsMastertraceFetcher(site, checkrun_id, previous=previous(db.HttpsMastertrace), http=self.mastertrace),
+            ]
+            self.checks.extend(self.https_checks)
+        self.skip = not due and previous_results is not None and \
+            previous_results.clean(site, [c.MODEL for c in self.checks])
+        self.skipped = []
+
+    def steps(self):
+        if self.skip:
+            for c in self.checks:
+                c.carry_forward()
+            return
+        for c in self.checks:
+            if c in self.https_checks and 'error' in self.sitetrace.result:
+                self.skipped.append(c)
+                continue
+            if c is self.traceset and \
+                    self.carry_forward_cutoff is not None and \
+                    self.sitetrace.unchanged() and \
+                    self.traceset.can_carry_forward(self.carry_forward_cutoff):
+                self.traceset.carry_forward()
+                continue
+            yield from c.steps()
+
+    def rows(self):
+        for c in self.checks:
+            if c not in self.skipped:
+                yield from c.rows()
+        for stat in self.fetchstats:
+            yield (db.Fetchstat, stat)
+
+class PreviousResults:
+    """The most recent successful result of each check.
+
+    We use it to ask mirrors whether anything changed since (if it came
+    with HTTP validators), and to carry forward values that we do not
+    need to fetch again.
+
+    We also remember which checks failed the last time we ran them.
+
+    If site_ids is given, only results for those sites are loaded; if
+    before is, only results of checkruns before then.
+    """
+    MODELS = db.OBSERVATIONS
+
+    def __init__(self, session, site_ids=None, before=None):
+        self.results = {}
+        self.failed = set()
+        for model, key in self.MODELS:
+            key_column = getattr(model, key)
+            def restrict(query):
+                if site_ids is not None:
+                    if key == 'site_id':
+                        query = query.filter(model.site_id.in_(site_ids))
+                    else:
+                        query = query.join(model.sitealias).filter(db.SiteAlias.site_id.in_(site_ids))
+                if before is not None:
+                    query = query.filter(model.last_checkrun_timestamp < before)
+                return query
+
+            latest = restrict(session.query(key_column, model.error)). \
+                distinct(key_column). \
+                order_by(key_column, model.last_checkrun_timestamp.desc())
+            for keyvalue, error in latest:
+                if error is not None:
+                    self.failed.add((model, keyvalue))
+
+            rows = restrict(session.query(model)). \
+                filter(model.error == None). \
+                distinct(key_column). \
+                order_by(key_column, model.last_checkrun_timestamp.desc())
+            for row in rows:
+                session.expunge(row)
+                self.results[(model, getattr(row, key))] = row
+
+    def get(self, model, key):
+        return self.results.get((model, key))
+
+    def clean(self, site, models):
+        """Whether we have results for all checks of site that go into
+        models, and none of them failed the last time.
+        """
+        keys = [(model, site.id) for model, key in self.MODELS if key == 'site_id' and model in models]
+        if db.SiteAliasMastertrace in models:
+            keys.extend((db.SiteAliasMastertrace, alias.id) for alias in site.sitealiases)
+        return all(k in self.results and k not in self.failed for k in keys)
@@ -0,0 +1,419 @@
+#!/usr/bin/python3
+
+# Keep-alive HTTP connections shared by all checks of a checkrun.
+#
+# Every site gets several documents fetched from the same host (master
+# and site tracefile, the Archive-Update-* flags, the trace directory
+# listing, and the master tracefile once more for every alias).  Instead
+# of doing a TCP handshake for each of them, keep the connection around
+# and re-use it.
+#
+# For HTTPS, the TLS handshake costs more than the TCP one.  Connections
+# are shared just the same, and when we do have to connect again, we
+# offer the server to resume the TLS session we last had with it, which
+# saves most of the work of a full handshake.
+
+import collections
+import datetime
+import http.client
+import socket
+import ssl
+import threading
+import time
+import urllib
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import dmt.dnscache as dnscache
+
+MAX_REDIRECTS = 10
+MAX_IDLE_PER_HOST = 4
+# how long to remember that connecting to a host failed, in seconds
+FAILED_TTL = 30
+# Bodies handed to a sink are read in pieces of this size.
+CHUNK_SIZE = 16*1024
+
+USER_AGENT = 'Python-urllib/%s' % (urllib.request.__version__,)
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def split_url(url):
+    """Split url into the pool key (scheme, host, port), the netloc to send
+    as Host header, and the request selector.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in DEFAULT_PORTS:
+        raise urllib.error.URLError('unknown url type: %s' % (parts.scheme,))
+    if not parts.hostname:
+        raise urllib.error.URLError('no host given')
+    port = parts.port or DEFAULT_PORTS[parts.scheme]
+    selector = parts.path or '/'
+    if parts.query:
+        selector += '?' + parts.query
+    return (parts.scheme, parts.hostname.lower(), port), parts.netloc, selector
+
+def build_request_headers(netloc, request_headers):
+    headers = collections.OrderedDict()
+    headers['Host'] = netloc
+    headers['User-Agent'] = USER_AGENT
+    headers['Accept-Encoding'] = 'identity'
+    for k, v in request_headers.items():
+        headers[k.capitalize()] = v
+    return headers
+
+def wants_sink(sink, status):
+    """Only successful responses are streamed into a sink; the bodies of
+    redirects and errors are read (and thrown away) as usual.
+    """
+    return sink is not None and 200 <= status < 300
+
+def create_ssl_context():
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_default_certs()
+    return context
+
+def get_tls_info(sslobj):
+    """The TLSInfo of an established ssl.SSLSocket or ssl.SSLObject.
+    """
+    cert = sslobj.getpeercert()
+    expires = None
+    if cert and 'notAfter' in cert:
+        expires = datetime.datetime.fromtimestamp(ssl.cert_time_to_seconds(cert['notAfter']), datetime.timezone.utc)
+    return TLSInfo(sslobj.version(), expires)
+
+def get_redirect(url, response):
+    """If response is a redirect we should follow, return the new url.
+    """
+    location = response.getheader('Location') or response.getheader('URI')
+    if response.status not in REDIRECT_CODES or location is None:
+        return None
+    newurl = urllib.parse.urljoin(url, location)
+    if urllib.parse.urlsplit(newurl).scheme not in DEFAULT_PORTS:
+        raise urllib.error.HTTPError(newurl, response.status, "redirection to url '%s' is not allowed" % (newurl,), response.headers, None)
+    return newurl
+
+
+# What we learned about the TLS connection a response came over.
+TLSInfo = collections.namedtuple('TLSInfo', ['version', 'certificate_expires'])
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """An ssl.SSLContext that remembers the last TLS session it had with
+    each server, and offers to resume it when connecting to that server
+    again.
+
+    Both engines create their TLS connections through wrap_socket() or
+    wrap_bio(), so this works for either.  Sessions are only known once
+    the server has sent them, which with TLS 1.3 happens after the
+    handshake; so the fetchers call remember() after each response.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+    def remember(self, server_hostname, session):
+        if session is not None:
+            with self.sessions_lock:
+                self.sessions[server_hostname] = session
+
+    def _session(self, server_hostname, session):
+        if session is None:
+            with self.sessions_lock:
+                session = self.sessions.get(server_hostname)
+        return session
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        return super().wrap_socket(sock, *args, server_hostname=server_hostname,
+                                   session=self._session(server_hostname, session), **kwargs)
+
+    def wrap_bio(self, incoming, outgoing, *args, server_hostname=None, session=None, **kwargs):
+        return super().wrap_bio(incoming, outgoing, *args, server_hostname=server_hostname,
+                                session=self._session(server_hostname, session), **kwargs)
+
+
+class FetchTiming:
+    """Where the time of a fetch went, filled in by the fetcher.
+
+    elapsed is the time in seconds spent talking to the mirror, not
+    counting any wait for a free connection slot.  It is split into name
+    resolution, connecting, the TLS handshake, waiting for the response
+    headers after sending the request, and reading the body.  With
+    redirects, all requests add up.  bytes is the size of the bodies,
+    and reused whether the last request went over a connection we
+    already had open.  tls_resumed says whether the TLS handshake of a
+    new connection resumed an earlier session; it stays None if there
+    was none.
+    """
+    PHASES = ('dns', 'connect', 'tls', 'ttfb', 'transfer')
+
+    def __init__(self):
+        self.elapsed = 0.0
+        self.dns = 0.0
+        self.connect = 0.0
+        self.tls = 0.0
+        self.ttfb = 0.0
+        self.transfer = 0.0
+        self.bytes = 0
+        self.reused = False
+        self.tls_resumed = None
+
+
+class PoolStats:
+    """Thread-safe counters of how connections got used.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def incr(self, what, n=1):
+        with self.lock:
+            self.counters[what] += n
+
+    def handshake(self, sslobj, timing):
+        """Count a TLS handshake of a new connection, and note in timing
+        whether it resumed a session.
+        """
+        timing.tls_resumed = sslobj.session_reused
+        self.incr('tls_handshakes')
+        if timing.tls_resumed:
+            self.incr('tls_resumed')
+
+    def __getitem__(self, what):
+        return self.counters[what]
+
+    def __str__(self):
+        requests = self.counters['requests']
+        reused = self.counters['reused']
+        s = "%d requests over %d connections; %d reused (%.1f%%), %d stale reconnects, %d failed connects (%d repeated from cache)" % (
+            requests, self.counters['opened'],
+            reused, 100.0*reused/requests if requests > 0 else 0,
+            self.counters['stale'],
+            self.counters['connect_failed'], self.counters['connect_failed_cached'])
+        if self.counters['tls_handshakes'] > 0:
+            s += "; %d TLS handshakes, %d of them resumed" % (self.counters['tls_handshakes'], self.counters['tls_resumed'])
+        return s
+
+
+class FailedConnects:
+    """Hosts connecting to failed recently, keyed like idle connections.
+
+    A failure is remembered for ttl seconds, so checks of a dead host do
+    not each wait for a timeout, but a passing failure does not stick for
+    the life of a worker.  A timeout only stands for requests that would
+    not wait any longer: one that got an adaptive (lowered) timeout does
+    not hold up a later request with the default one.
+
+    Not thread-safe by itself; ConnectionPool holds its lock.
+    """
+    def __init__(self, ttl=FAILED_TTL):
+        self.ttl = ttl
+        self.entries = {}
+
+    def get(self, key, timeout):
+        """The error connecting to key failed with, if that still counts
+        for a request with timeout; None otherwise.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        (err, expires, failed_timeout) = entry
+        if time.monotonic() >= expires:
+            del self.entries[key]
+            return None
+        if failed_timeout is not None and (timeout is None or timeout > failed_timeout):
+            return None
+        return err
+
+    def add(self, key, err, timeout):
+        timed_out = isinstance(err.reason, socket.timeout)
+        self.entries[key] = (err, time.monotonic() + self.ttl, timeout if timed_out else None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class ConnectionPool:
+    """Pool of idle keep-alive http.client connections, keyed by (scheme, host, port).
+
+    The host is the one we actually connect to, i.e. the site's
+    http_override_host and http_override_port if it has them.  Requests
+    that only differ in their Host header (like the alias checks) share
+    connections.
+
+    If connecting to a host fails, later requests to that host fail the
+    same way right away for a little while instead of waiting for another
+    timeout; see FailedConnects.
+
+    Host names are resolved through resolver, a dnscache.DNSCache.  TLS
+    connections are made with ssl_context, a ResumingSSLContext.
+    """
+    def __init__(self, max_idle_per_host=MAX_IDLE_PER_HOST, resolver=None, ssl_context=None):
+        self.max_idle_per_host = max_idle_per_host
+        self.resolver = resolver if resolver is not None else dnscache.DNSCache()
+        self.ssl_context = ssl_context if ssl_context is not None else create_ssl_context()
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+        self.failed = FailedConnects()
+        self.stats = PoolStats()
+
+    def forget_failures(self):
+        """Try again hosts that failed to connect, e.g. in a new batch of
+        checks.
+        """
+        with self.lock:
+            self.failed.clear()
+
+    def _get(self, key, timeout, timing):
+        with self.lock:
+            err = self.failed.get(key, timeout)
+            if err is not None:
+                self.stats.incr('connect_failed_cached')
+                raise err
+            if len(self.idle[key]) > 0:
+                conn = self.idle[key].pop()
+                conn.timeout = timeout
+                conn.sock.settimeout(timeout)
+                return (conn, True)
+
+        (scheme, host, port) = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout, context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        conn._create_connection = self.resolver.create_connection
+        try:
+            # resolve first, so that connect() finds the address in the cache
+            # and we can tell the time for both apart
+            start = time.monotonic()
+            try:
+                self.resolver.resolve(host, port)
+            finally:
+                timing.dns += time.monotonic() - start
+            start = time.monotonic()
+            try:
+                # only the TCP part of HTTPSConnection.connect(), so we can
+                # time the TLS handshake on its own
+                http.client.HTTPConnection.connect(conn)
+            finally:
+                timing.connect += time.monotonic() - start
+            if scheme == 'https':
+                start = time.monotonic()
+                try:
+                    conn.sock = self.ssl_context.wrap_socket(conn.sock, server_hostname=host)
+                except:
+                    conn.close()
+                    raise
+                finally:
+                    timing.tls += time.monotonic() - start
+                self.stats.handshake(conn.sock, timing)
+        except OSError as e:
+            # urllib reports connect errors as URLError; so do we.
+            # That includes certificate and TLS protocol errors.
+            err = urllib.error.URLError(e)
+            with self.lock:
+                self.failed.add(key, err, timeout)
+            self.stats.incr('connect_failed')
+            raise err
+        self.stats.incr('opened')
+        return (conn, False)
+
+    def _put(self, key, conn):
+        with self.lock:
+            if len(self.idle[key]) < self.max_idle_per_host:
+                self.idle[key].append(conn)
+                return
+        conn.close()
+
+    def _request(self, url, request_headers, timeout, sink, timing):
+        (key, netloc, selector) = split_url(url)
+        headers = build_request_headers(netloc, request_headers)
+
+        while True:
+            (conn, reused) = self._get(key, timeout, timing)
+            timing.reused = reused
+            try:
+                start = time.monotonic()
+                try:
+                    try:
+                        conn.request('GET', selector, headers=headers)
+                    except OSError as e:
+                        if reused: raise
+                        raise urllib.error.URLError(e)
+                    response = conn.getresponse()
+                finally:
+                    timing.ttfb += time.monotonic() - start
+                start = time.monotonic()
+                try:
+                    if wants_sink(sink, response.status):
+                        data = None
+                        while True:
+                            chunk = response.read(CHUNK_SIZE)
+                            if not chunk: break
+                            timing.bytes += len(chunk)
+                            sink.feed(chunk)
+                    else:
+                        data = response.read()
+                        timing.bytes += len(data)
+                finally:
+                    timing.transfer += time.monotonic() - start
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # The server closed an idle keep-alive connection on us.  Try again on a fresh one.
+                if reused:
+                    self.stats.incr('stale')
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+
+            self.stats.incr('requests')
+            if reused:
+                self.stats.incr('reused')
+            response.tls = None
+            if key[0] == 'https':
+                response.tls = get_tls_info(conn.sock)
+                self.ssl_context.remember(key[1], conn.sock.session)
+            if response.will_close:
+                conn.close()
+            else:
+                self._put(key, conn)
+            return (data, response)
+
+    def fetch(self, url, request_headers={}, timeout=None, sink=None, timing=None):
+        """Get url, following redirects, and return a (data, response) tuple.
+
+        If sink is given, the body of a successful response is passed to
+        sink.feed() piece by piece as it arrives, and data is None.  If
+        timing is given, it is a FetchTiming that we fill in.  For HTTPS,
+        response.tls is the TLSInfo of the connection; otherwise None.
+
+        Raises urllib.error.HTTPError for HTTP errors and urllib.error.URLError
+        if we cannot connect, just like urllib.request.urlopen would.
+        """
+        if timing is None:
+            timing = FetchTiming()
+        start = time.monotonic()
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                (data, response) = self._request(url, request_headers, timeout, sink, timing)
+                newurl = get_redirect(url, response)
+                if newurl is not None:
+                    url = newurl
+                    continue
+                if response.status >= 400 or response.status in REDIRECT_CODES:
+                    raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+                return (data, response)
+            raise urllib.error.HTTPError(url, response.status, "redirect error that would lead to an infinite loop", response.headers, None)
+        finally:
+            timing.elapsed += time.monotonic() - start
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
@@ -1,7 +1,9 @@
 #!/usr/bin/python3
 
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Interval, Float
-from sqlalchemy.dialects.postgresql import JSONB
+import datetime
+
+from sqlalchemy import Column, String, Integer, DateTime, Date, ForeignKey, Interval, Float, Boolean, Index
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY
 import sqlalchemy
 from sqlalchemy.orm import relationship, backref
 import sqlalchemy.ext.declarative
@@ -52,6 +54,54 @@ class Checkrun(Base):
     id                      = Column(Integer, primary_key=True)
 
     timestamp               = Column(DateTime(timezone=True), index=True)
+    # all checks of the run are done and stored; only then is it processed
+    completed               = Column(Boolean, nullable=False, server_default=sqlalchemy.false())
+
+class Checkjob(Base):
+    """A site to check in a checkrun, waiting for a worker to pick it up
+    """
+    __tablename__           = 'checkjob'
+    __plural__              = __tablename__ + 's'
+    __table_args__          = (
+        # what workers look for
+        Index('ix_checkjob_unfinished', 'checkrun_id', 'id', postgresql_where=sqlalchemy.text('finished IS NULL')),
+    )
+    id                      = Column(Integer, primary_key=True)
+
+    site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
+    checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False)
+    site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
+    checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+
+    # whether the scheduler wants the site checked, or its results carried forward
+    due                     = Column(Boolean, nullable=False, server_default=sqlalchemy.true())
+    # who is working on it, and until when nobody else may
+    worker                  = Column(String)
+    leased_until            = Column(DateTime(timezone=True))
+    attempts                = Column(Integer, nullable=False, server_default='0')
+    finished                = Column(DateTime(timezone=True))
+    # set if we gave up on the job instead of getting results
+    error                   = Column(String)
+
+
+# The tables of things we learn in a checkrun are partitioned by the
+# time of the checkrun, copied into each row; see dmt.partitions.
+PARTITIONED = {'postgresql_partition_by': 'RANGE (checkrun_timestamp)'}
+
+# What we observe of a site usually stays the same for many checkruns.
+# So the observation tables (see OBSERVATIONS below) store runs: a row
+# stands for all consecutive checkruns from checkrun_timestamp (and
+# checkrun_id) to last_checkrun_timestamp that saw the very same
+# values, and is extended instead of repeated; see dmt.resultwriter.
+# The <table>_by_checkrun views expand them to one row per checkrun.
+
+class Traceblob(Base):
+    """Full text of a tracefile, stored once no matter how many checks saw it
+    """
+    __tablename__           = 'traceblob'
+    # hex sha256 of the utf-8 encoded text
+    digest                  = Column(String, primary_key=True)
+    full                    = Column(String, nullable=False)
 
 
 class Mastertrace(Base):
@@ -59,17 +109,26 @@ class Mastertrace(Base):
     """
     __tablename__           = 'mastertrace'
     __plural__              = __tablename__ + 's'
-    id                      = Column(Integer, primary_key=True)
+    __table_args__          = PARTITIONED
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
 
     site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
     checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
     site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
     checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
+    last_checkrun_timestamp = Column(DateTime(timezone=True), nullable=False, index=True)
 
-    full                    = Column(String, index=True)
+    full_digest             = Column(String, ForeignKey("traceblob.digest"), index=True)
     trace_timestamp         = Column(DateTime(timezone=True))
     error                   = Column(String)
     content                 = Column(JSONB(none_as_null=True))
+    # if set, nothing in this row was fetched in this checkrun; the whole
+    # result was carried forward from an observation at this time.
+    carried_forward_from    = Column(DateTime(timezone=True))
+
+    http_last_modified      = Column(String)
+    http_etag               = Column(String)
 
 
 class Sitetrace(Base):
@@ -77,20 +136,99 @@ class Sitetrace(Base):
     """
     __tablename__           = 'sitetrace'
     __plural__              = __tablename__ + 's'
-    id                      = Column(Integer, primary_key=True)
+    __table_args__          = PARTITIONED
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
 
     site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
     checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
     site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
     checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
+    last_checkrun_timestamp = Column(DateTime(timezone=True), nullable=False, index=True)
 
     archive_update_in_progress = Column(DateTime(timezone=True))
     archive_update_required    = Column(DateTime(timezone=True))
+    # if set, the archive_update_* values were not fetched in this checkrun
+    # but carried forward from an observation at this time.
+    archive_update_carried_forward_from = Column(DateTime(timezone=True))
 
-    full                    = Column(String, index=True)
+    full_digest             = Column(String, ForeignKey("traceblob.digest"), index=True)
     trace_timestamp         = Column(DateTime(timezone=True), index=True)
     error                   = Column(String)
     content                 = Column(JSONB(none_as_null=True))
+    # often used fields of content, extracted by SitetraceFetcher.extract_fields
+    upstream_mirror         = Column(String)
+    creator                 = Column(String)
+    trigger                 = Column(String)
+    rsync_seconds           = Column(Integer)
+    architectures           = Column(ARRAY(String))
+    architectures_configuration = Column(String)
+    # if set, nothing in this row was fetched in this checkrun; the whole
+    # result was carried forward from an observation at this time.
+    carried_forward_from    = Column(DateTime(timezone=True))
+
+    http_last_modified      = Column(String)
+    http_etag               = Column(String)
+
+
+class HttpsMastertrace(Base):
+    """Master tracefile, fetched over https
+    """
+    __tablename__           = 'httpsmastertrace'
+    __plural__              = __tablename__ + 's'
+    __table_args__          = PARTITIONED
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
+
+    site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
+    checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
+    site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
+    checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
+    last_checkrun_timestamp = Column(DateTime(timezone=True), nullable=False, index=True)
+
+    full_digest             = Column(String, ForeignKey("traceblob.digest"), index=True)
+    trace_timestamp         = Column(DateTime(timezone=True))
+    error                   = Column(String)
+    # the error is a certificate or TLS protocol problem, not an HTTP one
+    tls_failed              = Column(Boolean, nullable=False, server_default=sqlalchemy.false())
+    tls_version             = Column(String)
+    certificate_expires     = Column(DateTime(timezone=True))
+    # if set, nothing in this row was fetched in this checkrun; the whole
+    # result was carried forward from an observation at this time.
+    carried_forward_from    = Column(DateTime(timezone=True))
+
+    http_last_modified      = Column(String)
+    http_etag               = Column(String)
+
+
+class HttpsSitetrace(Base):
+    """site tracefile, fetched over https
+    """
+    __tablename__           = 'httpssitetrace'
+    __plural__              = __tablename__ + 's'
+    __table_args__          = PARTITIONED
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
+
+    site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
+    checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
+    site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
+    checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
+    last_checkrun_timestamp = Column(DateTime(timezone=True), nullable=False, index=True)
+
+    full_digest             = Column(String, ForeignKey("traceblob.digest"), index=True)
+    trace_timestamp         = Column(DateTime(timezone=True))
+    error                   = Column(String)
+    # the error is a certificate or TLS protocol problem, not an HTTP one
+    tls_failed              = Column(Boolean, nullable=False, server_default=sqlalchemy.false())
+    tls_version             = Column(String)
+    certificate_expires     = Column(DateTime(timezone=True))
+    # if set, nothing in this row was fetched in this checkrun; the whole
+    # result was carried forward from an observation at this time.
+    carried_forward_from    = Column(DateTime(timezone=True))
+
+    http_last_modified      = Column(String)
+    http_etag               = Column(String)
 
 
 class Traceset(Base):
@@ -98,32 +236,86 @@ class Traceset(Base):
     """
     __tablename__           = 'traceset'
     __plural__              = __tablename__ + 's'
-    id                      = Column(Integer, primary_key=True)
+    __table_args__          = PARTITIONED
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
 
     site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
     checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
     site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
     checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
+    last_checkrun_timestamp = Column(DateTime(timezone=True), nullable=False, index=True)
 
     traceset                = Column(JSONB(none_as_null=True))
     error                   = Column(String)
+    # if set, the traceset was not fetched in this checkrun
+    # but carried forward from an observation at this time.
+    carried_forward_from    = Column(DateTime(timezone=True))
+
+    http_last_modified      = Column(String)
+    http_etag               = Column(String)
 
 class SiteAliasMastertrace(Base):
     """Age of the master tracefile
     """
     __tablename__           = 'sitealiasmastertrace'
     __plural__              = __tablename__ + 's'
-    id                      = Column(Integer, primary_key=True)
+    __table_args__          = PARTITIONED
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
 
     sitealias_id            = Column(Integer, ForeignKey("sitealias.id", ondelete='CASCADE'), nullable=False, index=True)
     checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
     sitealias               = relationship("SiteAlias", backref=backref(__plural__, passive_deletes=True))
     checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
+    last_checkrun_timestamp = Column(DateTime(timezone=True), nullable=False, index=True)
 
-    full                    = Column(String)
+    full_digest             = Column(String, ForeignKey("traceblob.digest"), index=True)
     trace_timestamp         = Column(DateTime(timezone=True))
     error                   = Column(String)
     content                 = Column(JSONB(none_as_null=True))
+    # if set, nothing in this row was fetched in this checkrun; the whole
+    # result was carried forward from an observation at this time.
+    carried_forward_from    = Column(DateTime(timezone=True))
+
+    http_last_modified      = Column(String)
+    http_etag               = Column(String)
+
+class Fetchstat(Base):
+    """How long a single fetch took, and whether it timed out
+    """
+    __tablename__           = 'fetchstat'
+    __plural__              = __tablename__ + 's'
+    __table_args__          = PARTITIONED
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
+
+    site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
+    checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
+    site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
+    checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
+
+    # mastertrace, sitetrace, archive-update, traceset, sitealias,
+    # https-mastertrace or https-sitetrace
+    kind                    = Column(String, nullable=False)
+    elapsed                 = Column(Float, nullable=False)
+    timeout                 = Column(Float, nullable=False)
+    timed_out               = Column(Boolean, nullable=False)
+    # the fetch failed, timed out or otherwise; None for fetches recorded before we kept track
+    error                   = Column(Boolean)
+    # the timeout was lowered from the default based on the site's latency history
+    adaptive_timeout        = Column(Boolean, nullable=False)
+
+    # where the elapsed time went, in seconds; see connpool.FetchTiming
+    dns                     = Column(Float)
+    connect                 = Column(Float)
+    tls                     = Column(Float)
+    ttfb                    = Column(Float)
+    transfer                = Column(Float)
+    bytes                   = Column(Integer)
+    reused                  = Column(Boolean)
+    # whether the TLS handshake of a new connection resumed an earlier session
+    tls_resumed             = Column(Boolean)
 
 class Checkoverview(Base):
     """For a mirror and a check, summarize all we learned from a test-run.
@@ -133,18 +325,154 @@ class Checkoverview(Base):
     """
     __tablename__           = 'checkoverview'
     __plural__              = __tablename__ + 's'
-    id                      = Column(Integer, primary_key=True)
+    __table_args__          = PARTITIONED
+    id                      = Column(Integer, primary_key=True, autoincrement=True)
 
     site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), nullable=False, index=True)
     checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False, index=True)
     site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
     checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun_timestamp      = Column(DateTime(timezone=True), primary_key=True)
 
     error                   = Column(String)
     version                 = Column(DateTime(timezone=True))
     age                     = Column(Interval)
     score                   = Column(Float)
     aliases                 = Column(JSONB(none_as_null=True))
+    # the error came from giving up early on an adaptive timeout
+    adaptive_timeout        = Column(Boolean, nullable=False, server_default=sqlalchemy.false())
+
+class Scorereplay(Base):
+    """Scores checkoverview rows would have had under another scoring
+    policy; see dmt.scoring
+    """
+    __tablename__           = 'scorereplay'
+    __plural__              = __tablename__ + 's'
+    # the name of the policy
+    policy                  = Column(String, primary_key=True)
+    site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), primary_key=True)
+    checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), primary_key=True, index=True)
+    site                    = relationship("Site", backref=backref(__plural__, passive_deletes=True))
+    checkrun                = relationship("Checkrun", backref=backref(__plural__, passive_deletes=True))
+    checkrun_timestamp      = Column(DateTime(timezone=True), nullable=False)
+
+    score                   = Column(Float, nullable=False)
+
+class Siteversion(Base):
+    """Which version of the archive a site tracefile stands for.
+
+    That is what the master tracefile said the first time we saw the
+    site tracefile together with it (see RunProcessor).  Once we know,
+    it does not change, so we keep it here instead of looking through
+    the history of the site on every run.
+    """
+    __tablename__           = 'siteversion'
+    site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), primary_key=True)
+    site                    = relationship("Site", backref=backref("siteversions", passive_deletes=True))
+    sitetrace_trace_timestamp = Column(DateTime(timezone=True), primary_key=True)
+
+    version                 = Column(DateTime(timezone=True), nullable=False)
+    # the first checkrun that saw both
+    first_seen              = Column(DateTime(timezone=True), nullable=False)
+
+class Ftpmastertrace(Base):
+    """When each master tracefile of ftp-master was first and last seen there
+
+    Kept up to date from mastertrace by run-process; see
+    helpers.update_ftpmaster_traces().
+    """
+    __tablename__           = 'ftpmastertrace'
+    trace_timestamp         = Column(DateTime(timezone=True), primary_key=True)
+    first_seen              = Column(DateTime(timezone=True), nullable=False)
+    last_seen               = Column(DateTime(timezone=True), nullable=False)
+
+class Siterollup(Base):
+    """What we learned about a site in a (UTC) day, in a form that adds up
+    over several days.
+
+    Kept up to date by run-process for the days it stores checkoverview
+    rows of; the status page reads the last two weeks of it.
+    """
+    __tablename__           = 'siterollup'
+    site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), primary_key=True)
+    site                    = relationship("Site", backref=backref("siterollups", passive_deletes=True))
+    day                     = Column(Date, primary_key=True)
+
+    # the first checkrun of the day that has a checkoverview row of the site
+    first_checkrun_timestamp = Column(DateTime(timezone=True), nullable=False)
+    # how many site tracefiles we saw for the first time
+    updates                 = Column(Integer, nullable=False)
+    # ages (in seconds) the site reached just before it was updated
+    max_age_count           = Column(Integer, nullable=False)
+    max_age_sum             = Column(Float, nullable=False)
+    max_age_sumsq           = Column(Float, nullable=False)
+
+class Sitestatus(Base):
+    """Where each site stood at the latest completed checkrun, with all
+    the pages need to know about it.
+
+    Written as a whole at the end of run-process; see dmt.StatusSnapshot.
+    """
+    __tablename__           = 'sitestatus'
+    site_id                 = Column(Integer, ForeignKey("site.id", ondelete='CASCADE'), primary_key=True)
+    site                    = relationship("Site", backref=backref("sitestatus", uselist=False, passive_deletes=True))
+    checkrun_id             = Column(Integer, ForeignKey("checkrun.id", ondelete='CASCADE'), nullable=False)
+    checkrun_timestamp      = Column(DateTime(timezone=True), nullable=False)
+
+    checkoverview_error     = Column(String)
+    checkoverview_age       = Column(Interval)
+    checkoverview_score     = Column(Float)
+    checkoverview_aliases   = Column(JSONB(none_as_null=True))
+
+    mastertrace_error       = Column(String)
+    mastertrace_trace_timestamp = Column(DateTime(timezone=True))
+
+    sitetrace_error         = Column(String)
+    sitetrace_trace_timestamp = Column(DateTime(timezone=True))
+    sitetrace_content       = Column(JSONB(none_as_null=True))
+
+    traceset_id             = Column(Integer)
+    traceset_error          = Column(String)
+    traceset_traceset       = Column(JSONB(none_as_null=True))
+
+    # with run-tests --https; NULL if the tracefiles were not fetched over https
+    httpsmastertrace_error  = Column(String)
+    httpsmastertrace_tls_failed = Column(Boolean)
+    httpssitetrace_error    = Column(String)
+    httpssitetrace_tls_failed = Column(Boolean)
+    httpssitetrace_tls_version = Column(String)
+    httpssitetrace_certificate_expires = Column(DateTime(timezone=True))
+
+    # the latest traceset we got in the last few hours, and how often
+    # it changed in that time
+    recent_traceset         = Column(JSONB(none_as_null=True))
+    traceset_changes        = Column(Integer, nullable=False)
+    traceset_last_change    = Column(DateTime(timezone=True))
+
+    # from the latest site tracefile that had any content
+    tracefile_last_seen     = Column(DateTime(timezone=True))
+    upstream_mirror         = Column(String)
+    creator                 = Column(String)
+    trigger                 = Column(String)
+    # the trace page shows it as is, whether it is a number or not
+    rsync_time              = Column(String)
+    architectures           = Column(ARRAY(String))
+    architectures_configuration = Column(String)
+
+    # from the last two weeks of siterollup
+    runs_per_day            = Column(Float)
+    max_age_avg             = Column(Interval)
+    max_age_stddev          = Column(Float)
+
+# observation tables, and what their rows are about
+OBSERVATIONS = (
+    (Mastertrace, 'site_id'),
+    (Sitetrace, 'site_id'),
+    (Traceset, 'site_id'),
+    (SiteAliasMastertrace, 'sitealias_id'),
+    (HttpsMastertrace, 'site_id'),
+    (HttpsSitetrace, 'site_id'),
+)
 
 class MirrorDB():
     DBURL = 'postgresql:///mirror-status'
@@ -168,6 +496,9 @@ class RawDB():
     def commit(self):
        self.conn.commit()
 
+    def rollback(self):
+       self.conn.rollback()
+
 def update_or_create(session, model, updates, **kwargs):
     r = session.query(model).filter_by(**kwargs)
     if len(updates) == 0:
@@ -179,3 +510,30 @@ def update_or_create(session, model, updates, **kwargs):
         attributes.update(updates)
         instance = model(**attributes)
         session.add(instance)
+
+def prune_traceblobs(session):
+    """Delete trace blobs no check refers to anymore.
+    """
+    unreferenced = [~sqlalchemy.exists().where(model.full_digest == Traceblob.digest)
+                    for model in (Mastertrace, Sitetrace, SiteAliasMastertrace, HttpsMastertrace, HttpsSitetrace)]
+    return session.query(Traceblob).filter(*unreferenced).delete(synchronize_session=False)
+
+def prune_siteversions(session):
+    """Forget the versions of site tracefiles we no longer have any
+    sitetrace of.
+    """
+    seen = sqlalchemy.exists().where(Sitetrace.site_id == Siteversion.site_id). \
+        where(Sitetrace.trace_timestamp == Siteversion.sitetrace_trace_timestamp)
+    return session.query(Siteversion).filter(~seen).delete(synchronize_session=False)
+
+def prune_ftpmastertraces(session, cutoff):
+    """Forget the master tracefiles of ftp-master not seen since cutoff,
+    just like their mastertraces.
+    """
+    return session.query(Ftpmastertrace).filter(Ftpmastertrace.last_seen < cutoff).delete(synchronize_session=False)
+
+def prune_siterollups(session, cutoff):
+    """Forget the days before that of cutoff.
+    """
+    day = cutoff.astimezone(datetime.timezone.utc).date()
+    return session.query(Siterollup).filter(Siterollup.day < day).delete(synchronize_session=False)
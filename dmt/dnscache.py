@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+
+# Name resolution shared by all fetches of a checkrun.
+#
+# Without it every new connection asks the system resolver again, for
+# the same few hundred mirror hostnames.  Lookups are cached for the TTL
+# of the DNS records (if python3-dns is available to tell us; otherwise
+# for DEFAULT_TTL), failures for NEGATIVE_TTL, and concurrent lookups of
+# the same name share one query.
+
+import collections
+import concurrent.futures
+import socket
+import threading
+import time
+
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:
+    dns = None
+
+DEFAULT_TTL = 300
+NEGATIVE_TTL = 60
+# never trust records for longer than a checkrun is likely to take
+MAX_TTL = 3600
+DNS_TIMEOUT = 10
+
+
+class ResolverStats:
+    """Thread-safe counters of how lookups were answered.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.slowest = (0.0, None)
+
+    def incr(self, what, n=1):
+        with self.lock:
+            self.counters[what] += n
+
+    def record_lookup(self, host, seconds):
+        with self.lock:
+            self.counters['lookups'] += 1
+            self.counters['lookup_seconds'] += seconds
+            if seconds > self.slowest[0]:
+                self.slowest = (seconds, host)
+
+    def __getitem__(self, what):
+        return self.counters[what]
+
+    def __str__(self):
+        lookups = self.counters['lookups']
+        return "%d resolutions: %d cache hits, %d shared with a concurrent lookup, %d lookups (%d failed, %d failures repeated from cache); %.3fs average, slowest %.3fs for %s" % (
+            self.counters['hits'] + self.counters['coalesced'] + lookups + self.counters['negative_hits'],
+            self.counters['hits'], self.counters['coalesced'],
+            lookups, self.counters['failed'], self.counters['negative_hits'],
+            self.counters['lookup_seconds']/lookups if lookups > 0 else 0,
+            self.slowest[0], self.slowest[1])
+
+
+class DNSCache:
+    """Cache of getaddrinfo() results, keyed by (host, port).
+
+    resolve() returns a list of (family, type, proto, canonname, sockaddr)
+    tuples for stream sockets, or raises socket.gaierror, just like
+    socket.getaddrinfo() would.  It is safe to call from many threads at
+    once.
+    """
+    def __init__(self, default_ttl=DEFAULT_TTL, negative_ttl=NEGATIVE_TTL):
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        # (host, port) -> (expires, addrinfos or exception)
+        self.cache = {}
+        # (host, port) -> Future of a lookup in progress
+        self.inflight = {}
+        self.stats = ResolverStats()
+        self.resolver = None
+        if dns is not None:
+            try:
+                self.resolver = dns.resolver.Resolver()
+                self.resolver.lifetime = DNS_TIMEOUT
+            except dns.exception.DNSException:
+                # no usable resolv.conf; getaddrinfo will have to do
+                pass
+
+    def _lookup_dns(self, host, port):
+        """Ask DNS directly, so we learn the records' TTL.
+
+        Returns None if DNS does not know about host; it might still be in
+        /etc/hosts or similar, so the caller should fall back to getaddrinfo.
+        """
+        infos = []
+        ttl = None
+        for family, rdtype in ((socket.AF_INET, 'A'), (socket.AF_INET6, 'AAAA')):
+            try:
+                answer = self.resolver.resolve(host, rdtype)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoNameservers):
+                continue
+            except dns.exception.Timeout:
+                raise socket.gaierror(socket.EAI_AGAIN, 'Temporary failure in name resolution')
+            except dns.exception.DNSException:
+                return None
+            ttl = answer.rrset.ttl if ttl is None else min(ttl, answer.rrset.ttl)
+            for rr in answer:
+                sockaddr = (rr.address, port, 0, 0) if family == socket.AF_INET6 else (rr.address, port)
+                infos.append((family, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', sockaddr))
+        if len(infos) == 0:
+            return None
+        return (infos, ttl)
+
+    def _lookup(self, host, port):
+        if self.resolver is not None:
+            try:
+                res = self._lookup_dns(host, port)
+            except ValueError:
+                # not a name DNS can handle, like an IP address literal
+                res = None
+            if res is not None:
+                return res
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        return (infos, self.default_ttl)
+
+    def resolve(self, host, port):
+        key = (host, port)
+        with self.lock:
+            if key in self.cache:
+                (expires, value) = self.cache[key]
+                if expires > time.monotonic():
+                    if isinstance(value, Exception):
+                        self.stats.incr('negative_hits')
+                        raise value
+                    self.stats.incr('hits')
+                    return value
+                del self.cache[key]
+            future = self.inflight.get(key)
+            if future is None:
+                future = concurrent.futures.Future()
+                self.inflight[key] = future
+                ours = True
+            else:
+                ours = False
+
+        if not ours:
+            self.stats.incr('coalesced')
+            return future.result()
+
+        start = time.monotonic()
+        try:
+            (infos, ttl) = self._lookup(host, port)
+        except OSError as e:
+            self.stats.record_lookup(host, time.monotonic() - start)
+            self.stats.incr('failed')
+            with self.lock:
+                self.cache[key] = (time.monotonic() + self.negative_ttl, e)
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        self.stats.record_lookup(host, time.monotonic() - start)
+        with self.lock:
+            self.cache[key] = (time.monotonic() + min(ttl, MAX_TTL), infos)
+            del self.inflight[key]
+        future.set_result(infos)
+        return infos
+
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        """Drop-in replacement for socket.create_connection() that resolves
+        through the cache.
+        """
+        (host, port) = address
+        err = None
+        for (family, socktype, proto, _, sockaddr) in self.resolve(host, port):
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except OSError as e:
+                err = e
+                if sock is not None:
+                    sock.close()
+        if err is not None:
+            raise err
+        raise OSError("getaddrinfo returns an empty list")
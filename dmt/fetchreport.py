@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+# Summarize where the time of a checkrun went, from the fetchstat table.
+
+import sys
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.fetchreport
+    __package__ = 'dmt.fetchreport'
+
+from sqlalchemy import func, Integer
+
+import dmt.db as db
+
+SLOWEST = 20
+PHASES = ('dns', 'connect', 'tls', 'ttfb', 'transfer')
+
+
+def slowest_sites(session, checkrun_id, limit=SLOWEST):
+    """The sites that took longest to check in a checkrun.
+
+    Returns rows of site name, number of fetches, number of timeouts,
+    total elapsed time, total time per phase and bytes transferred.
+    """
+    return session.query(
+            db.Site.name,
+            func.count(),
+            func.sum(db.Fetchstat.timed_out.cast(Integer)),
+            func.sum(db.Fetchstat.elapsed).label('elapsed'),
+            *[func.sum(getattr(db.Fetchstat, phase)) for phase in PHASES],
+            func.sum(db.Fetchstat.bytes)). \
+        join(db.Fetchstat.site). \
+        filter(db.Fetchstat.checkrun_id == checkrun_id). \
+        group_by(db.Site.name). \
+        order_by(func.sum(db.Fetchstat.elapsed).desc()). \
+        limit(limit)
+
+def totals(session, checkrun_id):
+    return session.query(
+            func.count(),
+            func.sum(db.Fetchstat.timed_out.cast(Integer)),
+            func.sum(db.Fetchstat.elapsed),
+            *[func.sum(getattr(db.Fetchstat, phase)) for phase in PHASES],
+            func.sum(db.Fetchstat.bytes)). \
+        filter(db.Fetchstat.checkrun_id == checkrun_id). \
+        one()
+
+def tls_handshakes(session, checkrun_id):
+    """How many TLS handshakes a checkrun did, how many of them resumed a
+    session, and how long full and resumed ones took in total.
+    """
+    handshake = db.Fetchstat.tls_resumed != None
+    return session.query(
+            func.count().filter(handshake),
+            func.count().filter(db.Fetchstat.tls_resumed == True),
+            func.sum(db.Fetchstat.tls).filter(db.Fetchstat.tls_resumed == False),
+            func.sum(db.Fetchstat.tls).filter(db.Fetchstat.tls_resumed == True)). \
+        filter(db.Fetchstat.checkrun_id == checkrun_id). \
+        one()
+
+def _format_row(name, fetches, timeouts, elapsed, *rest):
+    phases = rest[:len(PHASES)]
+    nbytes = rest[len(PHASES)]
+    return "%-40s %5d %4d %9.3f %s %10d" % (
+        name, fetches, timeouts or 0, elapsed or 0,
+        ' '.join('%9.3f' % (p or 0,) for p in phases),
+        nbytes or 0)
+
+def report(session, checkrun_id, limit=SLOWEST, file=sys.stdout):
+    print("%-40s %5s %4s %9s %s %10s" % (
+        'site', 'fetch', 't/o', 'elapsed', ' '.join('%9s' % (p,) for p in PHASES), 'bytes'), file=file)
+    for row in slowest_sites(session, checkrun_id, limit):
+        print(_format_row(*row), file=file)
+    total = totals(session, checkrun_id)
+    if total[0] > 0:
+        print(_format_row('(all sites)', *total), file=file)
+    (handshakes, resumed, full_time, resumed_time) = tls_handshakes(session, checkrun_id)
+    if handshakes > 0:
+        full = handshakes - resumed
+        print("TLS: %d handshakes, %.3fs; %d full, %.3fs each on average; %d resumed, %.3fs each on average" % (
+            handshakes, (full_time or 0) + (resumed_time or 0),
+            full, (full_time or 0) / full if full > 0 else 0,
+            resumed, (resumed_time or 0) / resumed if resumed > 0 else 0), file=file)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Show the slowest sites of a checkrun')
+    parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
+    parser.add_argument('--checkrun', help='checkrun id (default: the latest)', type=int)
+    parser.add_argument('--limit', help='number of sites to show', type=int, default=SLOWEST)
+    args = parser.parse_args()
+
+    session = db.MirrorDB(args.dburl).session()
+    checkrun_id = args.checkrun
+    if checkrun_id is None:
+        checkrun_id = session.query(db.Checkrun.id).order_by(db.Checkrun.timestamp.desc()).limit(1).scalar()
+    if checkrun_id is not None:
+        report(session, checkrun_id, args.limit)
@@ -1,5 +1,8 @@
 #!/usr/bin/python3
 
+import array
+import bisect
+import datetime
 import urllib
 import psycopg2.extras
 import errno
@@ -44,19 +47,25 @@ class BTSInfo:
 
         yield from filter(lambda bug: p.search(bug['subject']), cls.state)
 
-def get_baseurl(site):
+def get_baseurl(site, scheme='http'):
+    """Where the site has the archive.
+
+    The http_override_host and http_override_port of a site only apply
+    to http; over https we have to talk to the name on its certificate.
+    """
     hn = site['name']
-    if not site['http_override_host'] is None:
-        hn = site['http_override_host']
-    if not site['http_override_port'] is None:
-        hn += ':%d'%(site['http_override_port'],)
+    if scheme == 'http':
+        if not site['http_override_host'] is None:
+            hn = site['http_override_host']
+        if not site['http_override_port'] is None:
+            hn += ':%d'%(site['http_override_port'],)
 
-    baseurl = urllib.parse.urljoin("http://" + hn, site['http_path'])
+    baseurl = urllib.parse.urljoin(scheme + "://" + hn, site['http_path'])
     if not baseurl.endswith('/'): baseurl += '/'
     return baseurl
 
-def get_tracedir(site):
-    baseurl = get_baseurl(site)
+def get_tracedir(site, scheme='http'):
+    baseurl = get_baseurl(site, scheme)
     tracedir = urllib.parse.urljoin(baseurl, 'project/trace/')
     return tracedir
 
@@ -67,13 +76,12 @@ def get_ftpmaster_trace(cur):
     cur.execute("""
         SELECT trace_timestamp
         FROM mastertrace JOIN
-            site ON site.id = mastertrace.site_id JOIN
-            checkrun ON checkrun.id = mastertrace.checkrun_id
+            site ON site.id = mastertrace.site_id
         WHERE
             site.name = %(site_name)s AND
             trace_timestamp IS NOT NULL
         ORDER BY
-            timestamp DESC
+            last_checkrun_timestamp DESC
         LIMIT 1
         """, {
             'site_name': FTPMASTER,
@@ -83,41 +91,142 @@ def get_ftpmaster_trace(cur):
     return res['trace_timestamp']
 
 def get_latest_checkrun(cur):
-    """Get the most current checkrun
+    """Get the most current completed checkrun
     """
     assert(isinstance(cur, psycopg2.extras.RealDictCursor))
     cur.execute("""
         SELECT id, timestamp
         FROM checkrun
+        WHERE completed
         ORDER BY timestamp DESC
         LIMIT 1
         """)
     checkrun = cur.fetchone()
     return checkrun
 
-def get_ftpmaster_traces_lastseen(cur):
-    """For each trace timestamp from ftp-master, report when it was last seen on ftp-master
+def get_sitestatus_checkrun(cur):
+    """Get the checkrun sitestatus is a snapshot of; rows of sites it
+    had nothing on are from earlier ones.
+    """
+    assert(isinstance(cur, psycopg2.extras.RealDictCursor))
+    cur.execute("""
+        SELECT checkrun_id AS id, checkrun_timestamp AS timestamp
+        FROM sitestatus
+        ORDER BY checkrun_timestamp DESC
+        LIMIT 1
+        """)
+    checkrun = cur.fetchone()
+    return checkrun
+
+class FtpmasterTraces():
+    """The trace timestamps seen on ftp-master, and when each was first
+    and last seen there.
+
+    Looks like a dict of trace timestamp -> last seen.  The timestamps are
+    kept as microseconds since the epoch in sorted arrays, and looked up
+    by bisection.
+    """
+    EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def __init__(self, rows):
+        """rows are (trace_timestamp, first_seen, last_seen), sorted by
+        trace_timestamp.
+        """
+        self.trace_timestamps = array.array('q')
+        self.first = array.array('q')
+        self.last = array.array('q')
+        for (trace_timestamp, first_seen, last_seen) in rows:
+            self.trace_timestamps.append(self._to_int(trace_timestamp))
+            self.first.append(self._to_int(first_seen))
+            self.last.append(self._to_int(last_seen))
+
+    @classmethod
+    def _to_int(cls, timestamp):
+        return (timestamp - cls.EPOCH) // datetime.timedelta(microseconds=1)
+
+    @classmethod
+    def _from_int(cls, microseconds):
+        return cls.EPOCH + datetime.timedelta(microseconds=microseconds)
+
+    def _index(self, trace_timestamp):
+        if trace_timestamp is None:
+            return None
+        key = self._to_int(trace_timestamp)
+        i = bisect.bisect_left(self.trace_timestamps, key)
+        if i < len(self.trace_timestamps) and self.trace_timestamps[i] == key:
+            return i
+        return None
+
+    def __len__(self):
+        return len(self.trace_timestamps)
+
+    def __contains__(self, trace_timestamp):
+        return self._index(trace_timestamp) is not None
+
+    def __getitem__(self, trace_timestamp):
+        i = self._index(trace_timestamp)
+        if i is None:
+            raise KeyError(trace_timestamp)
+        return self._from_int(self.last[i])
+
+    def get(self, trace_timestamp, default=None):
+        i = self._index(trace_timestamp)
+        return self._from_int(self.last[i]) if i is not None else default
+
+    def first_seen(self, trace_timestamp):
+        i = self._index(trace_timestamp)
+        return self._from_int(self.first[i]) if i is not None else None
+
+def update_ftpmaster_traces(cur):
+    """Bring ftpmastertrace up to date with the mastertraces of ftp-master.
+
+    Only runs that went on since we last looked are considered: those
+    that end after the last sighting we know of, or after the oldest
+    checkrun that is not complete yet, which may still add older ones.
+    If ftpmastertrace is empty, all of them are.
     """
     assert(isinstance(cur, psycopg2.extras.RealDictCursor))
     cur.execute("""
+        INSERT INTO ftpmastertrace (trace_timestamp, first_seen, last_seen)
         SELECT
-            checkrun.timestamp,
-            mastertrace.trace_timestamp
-        FROM checkrun JOIN
-            mastertrace ON mastertrace.checkrun_id = checkrun.id JOIN
+            mastertrace.trace_timestamp,
+            min(mastertrace.checkrun_timestamp),
+            max(mastertrace.last_checkrun_timestamp)
+        FROM mastertrace JOIN
             site ON mastertrace.site_id = site.id
         WHERE
             site.name = %(ftpmastername)s AND
-            mastertrace.trace_timestamp IS NOT NULL
-        ORDER BY
-            timestamp
+            mastertrace.trace_timestamp IS NOT NULL AND
+            CASE
+                -- everything if we have not looked before
+                WHEN NOT EXISTS (SELECT * FROM ftpmastertrace) THEN TRUE
+                -- least() skips NULL, if no checkrun is incomplete
+                ELSE mastertrace.last_checkrun_timestamp >= least(
+                    (SELECT max(last_seen) FROM ftpmastertrace),
+                    (SELECT min(timestamp) FROM checkrun WHERE NOT completed))
+            END
+        GROUP BY
+            mastertrace.trace_timestamp
+        ON CONFLICT (trace_timestamp) DO UPDATE SET
+            first_seen = least(ftpmastertrace.first_seen, excluded.first_seen),
+            last_seen = greatest(ftpmastertrace.last_seen, excluded.last_seen)
         """, {
             'ftpmastername': FTPMASTER,
         })
-    trace_timestamp_lastseen = {}
-    for row in cur.fetchall():
-        trace_timestamp_lastseen[row['trace_timestamp']] = row['timestamp']
-    return trace_timestamp_lastseen
+
+def get_ftpmaster_traces_lastseen(cur):
+    """For each trace timestamp from ftp-master, report when it was last seen on ftp-master
+
+    Returns an FtpmasterTraces, read from ftpmastertrace; see
+    update_ftpmaster_traces().
+    """
+    assert(isinstance(cur, psycopg2.extras.RealDictCursor))
+    cur.execute("""
+        SELECT trace_timestamp, first_seen, last_seen
+        FROM ftpmastertrace
+        ORDER BY trace_timestamp
+        """)
+    return FtpmasterTraces((row['trace_timestamp'], row['first_seen'], row['last_seen']) for row in cur.fetchall())
 
 def hostname_comparator(hostname):
     return '.'.join(reversed(hostname.split('.')))
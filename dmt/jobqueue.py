@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+# A queue of site checks in the database, for spreading a checkrun over
+# any number of worker processes and hosts.
+#
+# `run-tests --enqueue` creates a checkrun and one checkjob per site.
+# Workers (`run-tests --worker`) claim batches of jobs with FOR UPDATE
+# SKIP LOCKED, so they never wait for each other, and hold a lease on
+# them while they work.  Jobs whose lease ran out, because their worker
+# crashed or hangs, are claimed again by somebody else, up to
+# MAX_ATTEMPTS times.  Results are written in the same transaction that
+# finishes their jobs, and the checkrun is marked completed when the
+# last of its jobs is finished.
+
+import datetime
+import os
+import socket
+import sys
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.jobqueue
+    __package__ = 'dmt.jobqueue'
+
+import sqlalchemy
+
+import dmt.db as db
+
+LEASE = datetime.timedelta(minutes=15)
+MAX_ATTEMPTS = 3
+CLAIM_SIZE = 50
+
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def enqueue(session, checkrun_id, jobs):
+    """Add a job for each (site_id, due) in jobs to checkrun_id.
+    """
+    rows = [{'checkrun_id': checkrun_id, 'site_id': site_id, 'due': due} for site_id, due in jobs]
+    if len(rows) > 0:
+        session.execute(db.Checkjob.__table__.insert().values(rows))
+    else:
+        complete(session, [checkrun_id])
+    return len(rows)
+
+def _give_up(session):
+    """Finish jobs that were leased MAX_ATTEMPTS times without results.
+    """
+    rows = session.execute(sqlalchemy.text("""
+        UPDATE checkjob
+        SET finished = now(), error = 'gave up after ' || attempts || ' attempts, last by ' || worker
+        WHERE id IN (
+            SELECT id FROM checkjob
+            WHERE finished IS NULL AND attempts >= :max_attempts AND leased_until < now()
+            FOR UPDATE SKIP LOCKED)
+        RETURNING checkrun_id
+        """), {'max_attempts': MAX_ATTEMPTS})
+    complete(session, set(row.checkrun_id for row in rows))
+
+def claim(session, worker, limit=CLAIM_SIZE, lease=LEASE):
+    """Lease up to limit jobs to worker, oldest checkrun first.
+
+    Returns rows with id, checkrun_id, site_id, due and attempts, ordered
+    by checkrun_id.  The caller has to commit.
+    """
+    _give_up(session)
+    rows = session.execute(sqlalchemy.text("""
+        UPDATE checkjob
+        SET worker = :worker, leased_until = now() + :lease, attempts = attempts + 1
+        WHERE id IN (
+            SELECT id FROM checkjob
+            WHERE finished IS NULL AND (leased_until IS NULL OR leased_until < now()) AND attempts < :max_attempts
+            ORDER BY checkrun_id, id
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED)
+        RETURNING id, checkrun_id, site_id, due, attempts
+        """), {'worker': worker, 'lease': lease, 'max_attempts': MAX_ATTEMPTS, 'limit': limit})
+    return sorted(rows, key=lambda row: (row.checkrun_id, row.id))
+
+def finish(session, worker, jobs):
+    """Mark jobs (as returned by claim) finished, and complete their
+    checkruns if these were the last of their jobs.
+
+    Returns the ids of the jobs that were still ours to finish: if our
+    lease ran out and somebody else claimed a job in the meantime, its
+    results are theirs to write.  The caller has to commit.
+    """
+    if len(jobs) == 0:
+        return set()
+    rows = session.execute(sqlalchemy.text("""
+        UPDATE checkjob
+        SET finished = now()
+        FROM (SELECT unnest(:ids) AS id, unnest(:attempts) AS attempts) AS ours
+        WHERE checkjob.id = ours.id AND
+              checkjob.attempts = ours.attempts AND
+              checkjob.worker = :worker AND
+              checkjob.finished IS NULL
+        RETURNING checkjob.id, checkjob.checkrun_id
+        """), {'worker': worker, 'ids': [j.id for j in jobs], 'attempts': [j.attempts for j in jobs]})
+    rows = rows.fetchall()
+    complete(session, set(row.checkrun_id for row in rows))
+    return set(row.id for row in rows)
+
+def complete(session, checkrun_ids):
+    """Mark those of checkrun_ids completed that have no unfinished jobs left.
+    """
+    for checkrun_id in sorted(checkrun_ids):
+        # Lock the checkrun first, so of two workers finishing its last
+        # jobs at the same time, the second one sees what the first did.
+        session.execute(sqlalchemy.text("SELECT id FROM checkrun WHERE id = :id FOR UPDATE"), {'id': checkrun_id})
+        session.execute(sqlalchemy.text("""
+            UPDATE checkrun SET completed = true
+            WHERE id = :id AND
+                  NOT EXISTS (SELECT * FROM checkjob WHERE checkrun_id = :id AND finished IS NULL)
+            """), {'id': checkrun_id})
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Show the state of the check job queue')
+    parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
+    args = parser.parse_args()
+
+    session = db.MirrorDB(args.dburl).session()
+    rows = session.execute(sqlalchemy.text("""
+        SELECT checkrun.id, checkrun.timestamp, checkrun.completed,
+            count(*) FILTER (WHERE finished IS NULL AND (leased_until IS NULL OR leased_until < now())) AS waiting,
+            count(*) FILTER (WHERE finished IS NULL AND leased_until >= now()) AS leased,
+            count(*) FILTER (WHERE finished IS NOT NULL AND error IS NULL) AS done,
+            count(*) FILTER (WHERE error IS NOT NULL) AS failed,
+            count(DISTINCT worker) AS workers
+        FROM checkrun JOIN checkjob ON checkjob.checkrun_id = checkrun.id
+        GROUP BY checkrun.id
+        ORDER BY checkrun.timestamp
+        """))
+    for row in rows:
+        print("checkrun %d at %s%s: %d waiting, %d leased, %d done, %d given up; %d workers" % (
+            row.id, row.timestamp, ' (completed)' if row.completed else '',
+            row.waiting, row.leased, row.done, row.failed, row.workers))
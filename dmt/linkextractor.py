@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+# Incremental extraction of <a href> values from directory listings.
+#
+# All we want from a mirror's project/trace/ autoindex page (as produced by
+# Apache, nginx, lighttpd and friends) are the link targets.  Building a
+# full BeautifulSoup tree for that is a lot of (GIL-holding) work, so this
+# just scans for anchor tags while the page is being downloaded.
+
+import html
+import re
+import sys
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.linkextractor
+    __package__ = 'dmt.linkextractor'
+
+# Unfinished tags longer than this are skipped rather than buffered forever.
+MAX_PENDING = 64*1024
+
+A_START_RE = re.compile(r'<a[\s/>]', re.IGNORECASE)
+A_TAG_RE = re.compile(r'''<a(?=[\s/>])((?:[^>"']|"[^"]*"|'[^']*')*)>''', re.IGNORECASE)
+HREF_RE = re.compile(r'''(?:^|[\s/])href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.IGNORECASE)
+
+
+class HrefExtractor:
+    """Feed it a page chunk by chunk; get back the href values of all <a>
+    tags completed so far.  Anchors inside comments are ignored, like an
+    HTML parser would.
+    """
+    def __init__(self):
+        self.pending = ''
+
+    @staticmethod
+    def _href(attrs):
+        value = None
+        # with duplicate attributes, the last one wins
+        for m in HREF_RE.finditer(attrs):
+            value = next(v for v in m.groups() if v is not None)
+        if value is None:
+            return None
+        return html.unescape(value)
+
+    def _scan(self, final):
+        buf = self.pending
+        hrefs = []
+        pos = 0
+        while True:
+            lt = buf.find('<', pos)
+            if lt == -1:
+                pos = len(buf)
+                break
+            if buf.startswith('<!--', lt):
+                end = buf.find('-->', lt + 4)
+                if end == -1:
+                    pos = len(buf) if final else lt
+                    break
+                pos = end + 3
+                continue
+            if not final and '<!--'.startswith(buf[lt:lt+4]) and len(buf) - lt < 4:
+                # might be the start of a comment
+                pos = lt
+                break
+            m = A_TAG_RE.match(buf, lt)
+            if m is not None:
+                href = self._href(m.group(1))
+                if href is not None:
+                    hrefs.append(href)
+                pos = m.end()
+                continue
+            if not final and len(buf) - lt < MAX_PENDING and \
+                    (A_START_RE.match(buf, lt) is not None or len(buf) - lt < 3):
+                # an anchor (or maybe one) that is not complete yet
+                pos = lt
+                break
+            pos = lt + 1
+
+        self.pending = buf[pos:]
+        return hrefs
+
+    def feed(self, data):
+        # latin-1 maps every byte to one character, so chunk boundaries
+        # cannot split a character.  Links we care about are plain ASCII.
+        if isinstance(data, bytes):
+            data = data.decode('iso8859-1')
+        self.pending += data
+        return self._scan(final=False)
+
+    def close(self):
+        hrefs = self._scan(final=True)
+        self.pending = ''
+        return hrefs
+
+
+def extract_hrefs(data, chunksize=None):
+    """Convenience wrapper: all hrefs of a complete page.
+    """
+    e = HrefExtractor()
+    hrefs = []
+    if chunksize is None:
+        hrefs.extend(e.feed(data))
+    else:
+        for i in range(0, len(data), chunksize):
+            hrefs.extend(e.feed(data[i:i+chunksize]))
+    hrefs.extend(e.close())
+    return hrefs
+
+
+def _sample_pages(tracedir, names):
+    """Synthetic listings in the style of the common web servers.
+    """
+    apache = ['<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n<html>\n <head>\n  <title>Index of /debian/project/trace</title>\n </head>\n <body>\n<h1>Index of /debian/project/trace</h1>\n  <table>\n   <tr><th valign="top"><img src="/icons/blank.gif" alt="[ICO]"></th><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th><th><a href="?C=S;O=A">Size</a></th></tr>\n   <tr><th colspan="4"><hr></th></tr>\n<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td><td><a href="/debian/project/">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td></tr>\n']
+    nginx = ['<html>\r\n<head><title>Index of /debian/project/trace/</title></head>\r\n<body>\r\n<h1>Index of /debian/project/trace/</h1><hr><pre><a href="../">../</a>\r\n']
+    lighttpd = ['<?xml version="1.0" encoding="iso-8859-1"?>\n<!DOCTYPE html>\n<html>\n<head>\n<title>Index of /debian/project/trace/</title>\n</head>\n<body>\n<h2>Index of /debian/project/trace/</h2>\n<div class="list">\n<table summary="Directory Listing" cellpadding="0" cellspacing="0">\n<thead><tr><th class="n">Name</th><th class="m">Last Modified</th><th class="s">Size</th><th class="t">Type</th></tr></thead>\n<tbody>\n<tr class="d"><td class="n"><a href="../">..</a>/</td><td class="m">&nbsp;</td><td class="s">- &nbsp;</td><td class="t">Directory</td></tr>\n']
+    for n in names:
+        apache.append('<tr><td valign="top"><img src="/icons/unknown.gif" alt="[   ]"></td><td><a href="%s">%s</a></td><td align="right">2017-09-16 20:03  </td><td align="right">1.2K</td></tr>\n' % (n, n))
+        nginx.append('<a href="%s">%s</a>                                   16-Sep-2017 20:03                1234\r\n' % (n, n))
+        lighttpd.append('<tr><td class="n"><a href="%s%s">%s</a></td><td class="m">2017-Sep-16 20:03:04</td><td class="s">1.2K</td><td class="t">application/octet-stream</td></tr>\n' % (tracedir, n, n))
+    apache.append('   <tr><th colspan="4"><hr></th></tr>\n<!-- <a href="commented-out">x</a> -->\n</table>\n<address>Apache/2.4.25 (Debian) Server at mirror Port 80</address>\n</body></html>\n')
+    nginx.append('</pre><hr></body>\r\n</html>\r\n')
+    lighttpd.append('</tbody>\n</table>\n</div>\n<div class="foot">lighttpd/1.4.45</div>\n</body>\n</html>\n')
+    return {'apache': ''.join(apache).encode(), 'nginx': ''.join(nginx).encode(), 'lighttpd': ''.join(lighttpd).encode()}
+
+
+if __name__ == "__main__":
+    import argparse
+    import timeit
+    from bs4 import BeautifulSoup
+    from dmt.checks import TracesetFetcher, TracefileCollector
+
+    parser = argparse.ArgumentParser(description='Compare the streaming link extractor against BeautifulSoup')
+    parser.add_argument('--tracedir', help='URL the listings were fetched from', default='http://mirror.example.org/debian/project/trace/')
+    parser.add_argument('--entries', help='number of tracefiles in the synthetic listings', type=int, default=300)
+    parser.add_argument('--chunksize', help='feed pages in chunks of this size', type=int, default=8192)
+    parser.add_argument('--rounds', help='benchmark rounds', type=int, default=50)
+    parser.add_argument('pages', nargs='*', help='saved listing pages to use instead of synthetic ones')
+    args = parser.parse_args()
+
+    def bs4_path(data):
+        soup = BeautifulSoup(data, "html.parser")
+        links = soup.find_all('a')
+        links = filter(lambda x: 'href' in x.attrs, links)
+        links = map(lambda x: TracesetFetcher._clean_link(x.get('href'), args.tracedir), links)
+        tracefiles = filter(lambda x: x is not None, links)
+        tracefiles = TracesetFetcher._filter_tracefilenames(tracefiles)
+        return sorted(set(tracefiles))
+
+    def streaming_path(data):
+        c = TracefileCollector(args.tracedir)
+        for i in range(0, len(data), args.chunksize):
+            c.feed(data[i:i+args.chunksize])
+        return c.close()
+
+    if args.pages:
+        pages = {}
+        for fn in args.pages:
+            with open(fn, 'rb') as f:
+                pages[fn] = f.read()
+    else:
+        names = ['master', '_hidden', 'ftp-master.debian.org.new', 'ftp-master.debian.org-stage1'] + \
+                ['mirror%03d.example.org' % (i,) for i in range(args.entries)]
+        pages = _sample_pages(args.tracedir, names)
+
+    ok = True
+    for name, data in sorted(pages.items()):
+        expected = bs4_path(data)
+        got = streaming_path(data)
+        # also try the worst case of single byte chunks
+        c = TracefileCollector(args.tracedir)
+        for i in range(len(data)):
+            c.feed(data[i:i+1])
+        got_bytewise = c.close()
+        same = expected == got == got_bytewise
+        ok = ok and same
+        t_bs4 = timeit.timeit(lambda: bs4_path(data), number=args.rounds) / args.rounds
+        t_stream = timeit.timeit(lambda: streaming_path(data), number=args.rounds) / args.rounds
+        print("%-30s %6d bytes %4d tracefiles  bs4: %7.3f ms  streaming: %7.3f ms  (x%.1f)  %s" % (
+            name, len(data), len(expected), t_bs4*1000, t_stream*1000, t_bs4/t_stream, "same" if same else "DIFFERENT"))
+    sys.exit(0 if ok else 1)
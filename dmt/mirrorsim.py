@@ -0,0 +1,319 @@
+#!/usr/bin/python3
+
+# A fleet of simulated mirrors on localhost, to benchmark run-tests
+# without bothering real mirrors.
+#
+# Each virtual mirror serves what the checks fetch: its trace directory
+# listing, the master tracefile and its own, and Archive-Update-* files.
+# Mirrors are spread over a number of 127.x.y.z addresses (all of which
+# are local on Linux), so connection limits per host work like they do
+# for real, and told apart on an address by their path.  How a mirror
+# behaves, how slow it is and how it answers for its aliases is drawn
+# from a seeded random generator, so the same arguments always give the
+# same fleet; run-benchmark uses that to create matching sites.
+
+import asyncio
+import collections
+import datetime
+import email.utils
+import hashlib
+import math
+import random
+import socket
+import struct
+import sys
+import threading
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.mirrorsim
+    __package__ = 'dmt.mirrorsim'
+
+import dmt.helpers as helpers
+
+PORT = 8400
+DOMAIN = 'sim.test'
+ADDRESSES = 64
+MIRRORS = 1000
+LATENCY_MS = 50.0
+LATENCY_SIGMA = 0.8
+# how much slower the slow ones are
+SLOW_FACTOR = 20
+SYNC_INTERVAL = datetime.timedelta(hours=6)
+
+# What a mirror does wrong, if anything:
+#  slow       - answers, but SLOW_FACTOR times slower than it would
+#  timeout    - accepts connections, but never answers
+#  reset      - resets the connection after reading a request
+#  notfound   - has no traces at all
+#  malformed  - serves tracefiles that are not
+#  stale      - has not synced for a while
+BEHAVIOURS = collections.OrderedDict((
+    ('slow', 0.05),
+    ('timeout', 0.01),
+    ('reset', 0.01),
+    ('notfound', 0.02),
+    ('malformed', 0.01),
+    ('stale', 0.05),
+))
+# What a mirror does when asked for one of its aliases in the Host header:
+# serve its master tracefile, an outdated one, or nothing.
+ALIAS_BEHAVIOURS = collections.OrderedDict((
+    ('ok', 0.8),
+    ('stale', 0.1),
+    ('notfound', 0.1),
+))
+ALIAS_FRACTION = 0.1
+ARCHIVE_UPDATE_FRACTION = 0.05
+
+VirtualMirror = collections.namedtuple('VirtualMirror',
+    ['name', 'address', 'path', 'behaviour', 'latency', 'aliases', 'synced', 'archive_update'])
+
+
+def _choose(rnd, weights, default):
+    x = rnd.random()
+    for choice, weight in weights.items():
+        if x < weight:
+            return choice
+        x -= weight
+    return default
+
+def build_fleet(count=MIRRORS, seed=0, addresses=ADDRESSES, behaviours=BEHAVIOURS,
+                latency_ms=LATENCY_MS, latency_sigma=LATENCY_SIGMA, now=None):
+    """Return (master timestamp, list of VirtualMirror).
+
+    The first mirror is the master site, helpers.FTPMASTER, and always
+    behaves.  latency is the mirror's median time to answer a request, in
+    seconds; synced is the master timestamp it has.
+    """
+    rnd = random.Random(seed)
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    # the master synced at the last full SYNC_INTERVAL
+    epoch = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+    master = now - (now - epoch) % SYNC_INTERVAL
+
+    mirrors = []
+    for i in range(count):
+        a = i % addresses
+        address = '127.0.%d.%d' % (a // 250, a % 250 + 1)
+        if i == 0:
+            name = helpers.FTPMASTER
+            behaviour = None
+        else:
+            name = 'm%05d.%s' % (i, DOMAIN)
+            behaviour = _choose(rnd, behaviours, None)
+        latency = rnd.lognormvariate(math.log(latency_ms / 1000), latency_sigma)
+        if behaviour == 'slow':
+            latency *= SLOW_FACTOR
+        synced = master
+        if behaviour == 'stale':
+            synced -= SYNC_INTERVAL * rnd.randint(1, 8)
+        aliases = []
+        if i > 0 and rnd.random() < ALIAS_FRACTION:
+            for n in range(rnd.randint(1, 2)):
+                aliases.append(('alias%d-m%05d.%s' % (n, i, DOMAIN), _choose(rnd, ALIAS_BEHAVIOURS, 'ok')))
+        archive_update = None
+        if rnd.random() < ARCHIVE_UPDATE_FRACTION:
+            archive_update = rnd.choice(('in-progress', 'required'))
+        mirrors.append(VirtualMirror(name, address, '/m%05d/debian/' % (i,), behaviour, latency, aliases, synced, archive_update))
+    return (master, mirrors)
+
+
+def _tracefile(timestamp, fields):
+    lines = [timestamp.strftime('%a %b %d %H:%M:%S UTC %Y')]
+    lines.extend('%s: %s' % field for field in fields)
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+class MirrorSimulator:
+    """Serve a fleet from build_fleet() on port, over HTTP/1.1 with keep-alive.
+    """
+    def __init__(self, master, mirrors, port=PORT):
+        self.master = master
+        self.mirrors = mirrors
+        self.port = port
+        # address -> first path component -> mirror
+        self.by_address = collections.defaultdict(dict)
+        for m in mirrors:
+            self.by_address[m.address][m.path.split('/')[1]] = m
+        self.servers = []
+        self.stats = collections.Counter()
+        self.rnd = random.Random(len(mirrors))
+
+    def _master_trace(self, synced):
+        return _tracefile(synced, (
+            ('Creator', 'ftpsync 20180513'),
+            ('Running on host', helpers.FTPMASTER),
+            ('Archive serial', synced.strftime('%Y%m%d%H')),
+        ))
+
+    def _site_trace(self, m):
+        if m.behaviour == 'malformed':
+            return b'this is not the tracefile you are looking for\n'
+        # mirrors finish their sync a few minutes after the master
+        finished = m.synced + datetime.timedelta(seconds=int(m.latency * 60000) % 3600)
+        return _tracefile(finished, (
+            ('Used ftpsync version', '20180513'),
+            ('Running on host', m.name),
+            ('Architectures', 'amd64 arm64 armel armhf i386'),
+            ('Architectures-Configuration', 'ALL'),
+            ('Upstream-mirror', helpers.FTPMASTER),
+            ('Trigger', 'cron'),
+            ('Total time spent in rsync', str(int(m.latency * 1000) % 600)),
+        ))
+
+    def _listing(self, m):
+        names = ['master', m.name, helpers.FTPMASTER, '_traces', m.name + '.new', m.name + '-stage1']
+        links = ''.join('<tr><td><a href="%s">%s</a></td></tr>\n' % (n, n) for n in sorted(set(names)))
+        return ('<html><head><title>Index of %sproject/trace</title></head><body><table>\n%s</table></body></html>\n' % (
+            m.path, links)).encode('utf-8')
+
+    def _document(self, m, path, host):
+        """Return (status, body, last modified) for path on mirror m.
+        """
+        if m.behaviour == 'notfound':
+            return (404, b'', None)
+        aliased = dict(m.aliases).get(host)
+        if aliased == 'notfound':
+            return (404, b'', None)
+        if path == 'project/trace/':
+            return (200, self._listing(m), m.synced)
+        if path == 'project/trace/master':
+            synced = m.synced - SYNC_INTERVAL if aliased == 'stale' else m.synced
+            return (200, self._master_trace(synced), synced)
+        if path == 'project/trace/' + m.name:
+            return (200, self._site_trace(m), m.synced)
+        for kind, filename in (('in-progress', 'Archive-Update-in-Progress-'), ('required', 'Archive-Update-Required-')):
+            if path == filename + m.name and m.archive_update == kind:
+                return (200, b'', m.synced)
+        return (404, b'', None)
+
+    async def _respond(self, writer, m, path, headers):
+        (status, body, last_modified) = self._document(m, path, headers.get('host', '').split(':')[0])
+        response = ['HTTP/1.1 %d %s' % (status, 'OK' if status == 200 else 'Not Found')]
+        if status == 200:
+            etag = '"%s"' % (hashlib.sha1(body).hexdigest()[:16],)
+            if headers.get('if-none-match') == etag:
+                status, body = 304, b''
+                response = ['HTTP/1.1 304 Not Modified']
+            response.append('ETag: %s' % (etag,))
+            if last_modified is not None:
+                response.append('Last-Modified: %s' % (email.utils.format_datetime(last_modified.astimezone(datetime.timezone.utc), usegmt=True),))
+        response.append('Content-Type: text/html' if path.endswith('/') else 'Content-Type: text/plain')
+        response.append('Content-Length: %d' % (len(body),))
+        self.stats[status] += 1
+        # each answer takes about the mirror's latency, give or take
+        await asyncio.sleep(m.latency * self.rnd.uniform(0.5, 1.5))
+        writer.write(('\r\n'.join(response) + '\r\n\r\n').encode('ascii') + body)
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        local = writer.get_extra_info('sockname')[0]
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('iso8859-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                (method, target, version) = request_line.decode('iso8859-1').split()
+                prefix = target.split('/')[1] if target.count('/') > 1 else ''
+                m = self.by_address[local].get(prefix)
+                if m is None:
+                    self.stats['unknown'] += 1
+                    writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+                elif m.behaviour == 'timeout':
+                    self.stats['hung'] += 1
+                    # until the client gives up
+                    await reader.read()
+                    break
+                elif m.behaviour == 'reset':
+                    self.stats['reset'] += 1
+                    sock = writer.get_extra_info('socket')
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                    writer.transport.abort()
+                    return
+                else:
+                    await self._respond(writer, m, target[len(m.path):], headers)
+                if version != 'HTTP/1.1' or headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        writer.close()
+
+    async def start(self):
+        for address in sorted(self.by_address):
+            server = await asyncio.start_server(self._handle, address, self.port, reuse_address=True, backlog=1024)
+            self.servers.append(server)
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+
+    def serve_in_thread(self):
+        """Start serving on an event loop in a background thread, and
+        return once all addresses are listening.
+        """
+        started = threading.Event()
+        failure = []
+        def run():
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self.start())
+            except Exception as e:
+                failure.append(e)
+                started.set()
+                return
+            started.set()
+            loop.run_forever()
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        if len(failure) > 0:
+            raise failure[0]
+
+    def __str__(self):
+        return ', '.join('%s: %d' % (k, v) for k, v in sorted(self.stats.items(), key=lambda kv: str(kv[0])))
+
+
+def add_arguments(parser):
+    """Options that define the fleet, shared with run-benchmark.
+    """
+    parser.add_argument('--mirrors', help='number of virtual mirrors', type=int, default=MIRRORS)
+    parser.add_argument('--addresses', help='spread them over this many 127.0.x.y addresses', type=int, default=ADDRESSES)
+    parser.add_argument('--port', help='port to listen on', type=int, default=PORT)
+    parser.add_argument('--seed', help='seed for how the fleet behaves', type=int, default=0)
+    parser.add_argument('--latency-ms', help='median time a mirror takes to answer', type=float, default=LATENCY_MS)
+    parser.add_argument('--latency-sigma', help='sigma of the log-normal distribution of mirror latency', type=float, default=LATENCY_SIGMA)
+    for behaviour, fraction in BEHAVIOURS.items():
+        parser.add_argument('--%s-fraction' % (behaviour,), help='fraction of mirrors that are %s' % (behaviour,), type=float, default=fraction)
+
+def fleet_from_args(args):
+    behaviours = collections.OrderedDict((b, getattr(args, '%s_fraction' % (b,))) for b in BEHAVIOURS)
+    return build_fleet(args.mirrors, args.seed, args.addresses, behaviours, args.latency_ms, args.latency_sigma)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description='Serve a fleet of simulated mirrors')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    (master, mirrors) = fleet_from_args(args)
+    simulator = MirrorSimulator(master, mirrors, args.port)
+    simulator.serve_in_thread()
+    print("serving %d mirrors on %d addresses, port %d; master at %s" % (len(mirrors), len(simulator.by_address), args.port, master))
+    print("behaviours:", dict(collections.Counter(m.behaviour or 'ok' for m in mirrors)))
+    try:
+        while True:
+            time.sleep(60)
+            print("requests:", simulator)
+    except KeyboardInterrupt:
+        simulator.close()
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+# Daily partitions of the tables that hold what we learn in a checkrun.
+#
+# Deleting old checkruns used to cascade into row-by-row deletes of all
+# their results, every run.  Now these tables are range-partitioned by
+# the time of the checkrun, one partition per (UTC) day, and pruning
+# detaches and drops whole partitions that are old enough.  Only the
+# checkruns of the one partition that straddles the cutoff are still
+# deleted row by row.
+#
+# Rows of observation tables stand for runs of checkruns (see db), and
+# are in the partition of the first one.  Runs that go on past the
+# cutoff are made to start at the first checkrun after it before
+# anything is dropped, which moves them to that checkrun's partition.
+
+import datetime
+import sys
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.partitions
+    __package__ = 'dmt.partitions'
+
+import sqlalchemy
+
+import dmt.db as db
+
+MODELS = (db.Mastertrace, db.Sitetrace, db.Traceset, db.SiteAliasMastertrace, db.HttpsMastertrace, db.HttpsSitetrace, db.Fetchstat, db.Checkoverview)
+PERIOD = datetime.timedelta(days=1)
+SUFFIX_FORMAT = '%Y%m%d'
+
+
+def period_start(timestamp):
+    """Start of the partition period timestamp falls into.
+    """
+    timestamp = timestamp.astimezone(datetime.timezone.utc)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def partition_name(table, start):
+    return '%s_p%s' % (table, start.strftime(SUFFIX_FORMAT))
+
+def partitions(session, table):
+    """Return (name, start) of all partitions of table, oldest first.
+    """
+    rows = session.execute(sqlalchemy.text("""
+        SELECT child.relname
+        FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child  ON child.oid  = pg_inherits.inhrelid
+        WHERE parent.relname = :table
+        """), {'table': table})
+    result = []
+    prefix = table + '_p'
+    for (name,) in rows:
+        try:
+            start = datetime.datetime.strptime(name[len(prefix):], SUFFIX_FORMAT).replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            # not one of ours
+            continue
+        result.append((name, start))
+    return sorted(result, key=lambda p: p[1])
+
+def ensure_partitions(session, timestamp):
+    """Create the partitions rows of a checkrun at timestamp go into.
+
+    timestamp should be timezone-aware, as read back from the database,
+    so we pick the same day PostgreSQL routes the rows to.
+    """
+    start = period_start(timestamp)
+    for model in MODELS:
+        table = model.__tablename__
+        session.execute(sqlalchemy.text(
+            "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')" % (
+                partition_name(table, start), table, start.isoformat(), (start + PERIOD).isoformat())))
+
+def trim_runs(session, cutoff):
+    """Make runs of observations that started before cutoff and end after
+    it start at the first checkrun after cutoff.
+    """
+    for model, _ in db.OBSERVATIONS:
+        table = model.__tablename__
+        session.execute(sqlalchemy.text("""
+            UPDATE %(table)s
+            SET checkrun_id = first.id, checkrun_timestamp = first.timestamp
+            FROM (SELECT id, timestamp FROM checkrun WHERE timestamp >= :cutoff ORDER BY timestamp LIMIT 1) AS first
+            WHERE %(table)s.checkrun_timestamp < :cutoff AND %(table)s.last_checkrun_timestamp >= :cutoff
+            """ % {'table': table}), {'cutoff': cutoff})
+
+def prune(session, cutoff):
+    """Delete all checkruns older than cutoff, and everything learned in them.
+
+    Returns the number of partitions dropped.
+    """
+    trim_runs(session, cutoff)
+    dropped = 0
+    for model in MODELS:
+        table = model.__tablename__
+        for name, start in partitions(session, table):
+            if start + PERIOD > cutoff:
+                break
+            session.execute(sqlalchemy.text("ALTER TABLE %s DETACH PARTITION %s" % (table, name)))
+            session.execute(sqlalchemy.text("DROP TABLE %s" % (name,)))
+            dropped += 1
+    # the rest of the checkruns before cutoff, and their rows in a partition
+    # that also has newer ones
+    session.query(db.Checkrun).filter(db.Checkrun.timestamp < cutoff).delete()
+    db.prune_traceblobs(session)
+    db.prune_siteversions(session)
+    db.prune_ftpmastertraces(session, cutoff)
+    db.prune_siterollups(session, cutoff)
+    return dropped
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='List the partitions of the check tables')
+    parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
+    args = parser.parse_args()
+
+    session = db.MirrorDB(args.dburl).session()
+    for model in MODELS:
+        table = model.__tablename__
+        for name, start in partitions(session, table):
+            count = session.execute(sqlalchemy.text("SELECT count(*) FROM %s" % (name,))).scalar()
+            print("%-40s %s - %s %10d rows" % (name, start.date(), (start + PERIOD).date(), count))
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+
+# Write check results to the database while a checkrun is still going.
+#
+# Adding every result to one ORM session and committing at the very end
+# keeps all of them in memory until then, and loses all of them if
+# anything goes wrong late in the run.  Instead, collect the rows of a
+# number of finished checks, write each table's share with one multi-row
+# INSERT, and commit.
+#
+# Rows of observation tables (db.OBSERVATIONS) that repeat the values of
+# the site's previous run of observations extend that run instead, with
+# one multi-row UPDATE per table.
+
+import collections
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+import dmt.db as db
+import dmt.jobqueue as jobqueue
+
+BATCH_SIZE = 50
+
+
+class ResultWriter:
+    """Batch up the rows of finished checks and write them out.
+
+    session should be a session of its own: committing a batch expires
+    all objects of the session it happens in, and the checks still
+    running use the site objects of theirs.
+
+    Checks that came from the job queue have their job as check.job.
+    Those jobs are finished in the transaction that writes their rows, by
+    worker, and the rows of jobs that turn out not to be ours anymore are
+    dropped.
+    """
+    def __init__(self, session, checkrun_timestamp, batch_size=BATCH_SIZE, worker=None):
+        self.session = session
+        self.checkrun_timestamp = checkrun_timestamp
+        self.batch_size = batch_size
+        self.worker = worker
+        self.pending = collections.OrderedDict()
+        self.pending_jobs = []
+        self.pending_checks = 0
+        self.stats = collections.Counter()
+        self.observations = dict(db.OBSERVATIONS)
+
+    def add(self, check):
+        job = getattr(check, 'job', None)
+        if job is not None:
+            self.pending_jobs.append(job)
+        for model, values in check.rows():
+            self.pending.setdefault(model, []).append((job, values))
+        self.pending_checks += 1
+        if self.pending_checks >= self.batch_size:
+            self.flush()
+
+    def extend_runs(self, table, key, rows):
+        """Extend the latest run of observations of each row's subject to
+        this checkrun, where the row has the very same values and no
+        checkrun happened in between.  Returns the rows that still have
+        to be inserted.
+        """
+        ts = self.checkrun_timestamp
+        values = [c for c in rows[0] if c not in ('checkrun_id', 'checkrun_timestamp', 'last_checkrun_timestamp')]
+        new = sqlalchemy.values(*[sqlalchemy.column(c, table.c[c].type) for c in values], name='new'). \
+            data([tuple(r[c] for c in values) for r in rows])
+        latest = table.alias('latest')
+        latest_id = sqlalchemy.select(latest.c.id). \
+            where(latest.c[key] == new.c[key], latest.c.last_checkrun_timestamp < ts). \
+            order_by(latest.c.last_checkrun_timestamp.desc()). \
+            limit(1). \
+            scalar_subquery()
+        checkrun = db.Checkrun.__table__
+        missed = sqlalchemy.exists().where(checkrun.c.timestamp > table.c.last_checkrun_timestamp, checkrun.c.timestamp < ts)
+        stmt = table.update(). \
+            where(table.c.id == latest_id, ~missed,
+                  *[table.c[c].is_not_distinct_from(sqlalchemy.cast(new.c[c], table.c[c].type)) for c in values]). \
+            values(last_checkrun_timestamp=ts). \
+            returning(new.c[key])
+        extended = set(subject for (subject,) in self.session.execute(stmt))
+        self.stats['extended'] += len(extended)
+        return [r for r in rows if r[key] not in extended]
+
+    def flush(self):
+        ours = set()
+        if len(self.pending_jobs) > 0:
+            ours = jobqueue.finish(self.session, self.worker, self.pending_jobs)
+            self.stats['lost_jobs'] += len(self.pending_jobs) - len(ours)
+        # referenced tables (like traceblob) have to be written first
+        tables = db.Base.metadata.sorted_tables
+        for model, rows in sorted(self.pending.items(), key=lambda item: tables.index(item[0].__table__)):
+            table = model.__table__
+            # A multi-row INSERT needs the same columns in every row; the
+            # ones a check did not set are NULL, just like with the ORM.
+            columns = [c.name for c in table.columns if c.name != 'id']
+            rows = [dict((c, values.get(c)) for c in columns) for job, values in rows
+                    if job is None or job.id in ours]
+            if len(rows) == 0:
+                continue
+            if 'checkrun_timestamp' in table.columns:
+                # what the table is partitioned by
+                for r in rows:
+                    r['checkrun_timestamp'] = self.checkrun_timestamp
+            if model in self.observations:
+                rows = self.extend_runs(table, self.observations[model], rows)
+                if len(rows) == 0:
+                    continue
+                for r in rows:
+                    r['last_checkrun_timestamp'] = self.checkrun_timestamp
+            if 'id' in table.columns:
+                stmt = postgresql.insert(table).values(rows)
+            else:
+                # Rows keyed by their content, like trace blobs, are shared
+                # between checks: write each one only once.
+                key = [c.name for c in table.primary_key]
+                rows = list(dict((tuple(r[k] for k in key), r) for r in rows).values())
+                stmt = postgresql.insert(table).values(rows).on_conflict_do_nothing(index_elements=key)
+            self.session.execute(stmt)
+            self.stats['rows'] += len(rows)
+        self.session.commit()
+        if self.pending_checks > 0:
+            self.stats['batches'] += 1
+        self.stats['checks'] += self.pending_checks
+        self.pending.clear()
+        self.pending_jobs = []
+        self.pending_checks = 0
+
+    def close(self):
+        self.flush()
+        self.session.close()
+
+    def __str__(self):
+        s = "%d checks written as %d new rows and %d extended runs in %d batches" % (
+            self.stats['checks'], self.stats['rows'], self.stats['extended'], self.stats['batches'])
+        if self.stats['lost_jobs'] > 0:
+            s += ", %d jobs dropped after their lease was taken over" % (self.stats['lost_jobs'],)
+        return s
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+# Decide which sites need checking in this checkrun.
+#
+# Most mirrors sync on a fixed schedule, a few times a day, and their site
+# tracefile only changes when they do.  Checking them on every run mostly
+# confirms that nothing happened.  From the sitetrace timestamps we have
+# seen we estimate how often each mirror syncs and when it will do so
+# next, check it often around that time and back off in between.  Sites
+# that are not due get their previous results carried forward.
+
+import collections
+import datetime
+import statistics
+import sys
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.scheduler
+    __package__ = 'dmt.scheduler'
+
+import dmt.db as db
+import dmt.helpers as helpers
+
+HISTORY = datetime.timedelta(weeks=2)
+MAX_INTERVAL = datetime.timedelta(hours=6)
+MIN_WINDOW = datetime.timedelta(minutes=30)
+# how much of a site's sync period around the predicted next sync we check on every run
+WINDOW_FRACTION = 0.25
+# sync intervals needed before we trust the estimate
+MIN_INTERVALS = 2
+
+
+class CheckScheduler:
+    """Predict when each site will sync next, and whether it should be
+    checked at time now.
+
+    The period of a site is the median interval between the distinct
+    sitetrace timestamps we saw in the last two weeks.  A site is due
+
+     - if we have not checked it yet, or know too little about it,
+     - if we have not really checked it for max_interval,
+     - if now is within a window around its predicted next sync, or
+     - if it is overdue, at intervals growing with how late it is.
+
+    The master site is always due, since everybody else's age is
+    measured against it.
+    """
+    def __init__(self, session, now, max_interval=MAX_INTERVAL):
+        self.now = now
+        self.max_interval = max_interval
+        self.stats = collections.Counter()
+
+        self.syncs = collections.defaultdict(list)
+        rows = session.query(db.Sitetrace.site_id, db.Sitetrace.trace_timestamp). \
+            filter(db.Sitetrace.trace_timestamp != None). \
+            filter(db.Sitetrace.last_checkrun_timestamp > now - HISTORY). \
+            distinct(). \
+            order_by(db.Sitetrace.site_id, db.Sitetrace.trace_timestamp)
+        for site_id, trace_timestamp in rows:
+            self.syncs[site_id].append(trace_timestamp)
+
+        # when we last actually fetched the site's tracefile
+        self.last_checked = {}
+        rows = session.query(db.Sitetrace.site_id, db.Sitetrace.last_checkrun_timestamp). \
+            filter(db.Sitetrace.carried_forward_from == None). \
+            distinct(db.Sitetrace.site_id). \
+            order_by(db.Sitetrace.site_id, db.Sitetrace.last_checkrun_timestamp.desc())
+        for site_id, timestamp in rows:
+            self.last_checked[site_id] = timestamp
+
+    def period(self, site_id):
+        """Median time between two syncs of the site, or None if we do not know.
+        """
+        syncs = self.syncs.get(site_id, [])
+        intervals = [b - a for a, b in zip(syncs, syncs[1:])]
+        if len(intervals) < MIN_INTERVALS:
+            return None
+        return statistics.median_low(intervals)
+
+    def next_sync(self, site_id):
+        """When we expect the site to sync next (may be in the past if it is late).
+        """
+        period = self.period(site_id)
+        if period is None:
+            return None
+        return self.syncs[site_id][-1] + period
+
+    def _decide(self, site):
+        if site.name == helpers.FTPMASTER:
+            return 'master'
+        last_checked = self.last_checked.get(site.id)
+        if last_checked is None:
+            return 'new'
+        since = self.now - last_checked
+        if since >= self.max_interval:
+            return 'max-interval'
+        period = self.period(site.id)
+        if period is None:
+            return 'no-history'
+
+        window = min(max(period * WINDOW_FRACTION, MIN_WINDOW), self.max_interval)
+        expected = self.next_sync(site.id)
+        if self.now < expected - window:
+            return None
+        if self.now <= expected + window:
+            return 'expected'
+        # late; check less and less often the later it is
+        if since >= min(max((self.now - expected) / 2, window), self.max_interval):
+            return 'overdue'
+        return None
+
+    def is_due(self, site):
+        reason = self._decide(site)
+        self.stats[reason if reason is not None else 'skipped'] += 1
+        return reason is not None
+
+    def __str__(self):
+        return ', '.join('%s: %d' % (k, v) for k, v in sorted(self.stats.items()))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Show the predicted sync schedule of all sites')
+    parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
+    parser.add_argument('--max-interval-hours', help='check every site at least every <x> hours', type=float, default=MAX_INTERVAL.total_seconds()/3600)
+    args = parser.parse_args()
+
+    session = db.MirrorDB(args.dburl).session()
+    now = datetime.datetime.now().astimezone()
+    scheduler = CheckScheduler(session, now, datetime.timedelta(hours=args.max_interval_hours))
+    for site in session.query(db.Site).order_by(db.Site.name):
+        print("%-40s period: %-16s next sync: %-32s last checked: %-32s %s" % (
+            site.name,
+            scheduler.period(site.id),
+            scheduler.next_sync(site.id),
+            scheduler.last_checked.get(site.id),
+            scheduler._decide(site) or 'skip'))
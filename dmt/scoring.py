@@ -0,0 +1,348 @@
+#!/usr/bin/python3
+
+# How what we learn about a mirror in a checkrun moves its score.
+#
+# After each checkrun, a mirror's score moves by an adjustment for how
+# old it was (or whether it failed), weighted by the time since the
+# previous checkrun, and is kept within [-100, 100].  A ScoringPolicy
+# holds the numbers that go into that.  To try other numbers, put them
+# in a JSON file and replay the retained history under them:
+#
+#   python3 -m dmt.scoring --policy lenient.json --jobs 4
+#
+# which reports how the scores would have turned out next to the current
+# ones, and with --store keeps them in scorereplay for a closer look.
+
+import collections
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.scoring
+    __package__ = 'dmt.scoring'
+
+import psycopg2.extras
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import dmt.db as db
+
+# ignore checkrun for scoring purposes if more than this fraction
+# of checks resulted in errors
+IGNORE_RUN_THRESHOLD = 0.7
+# upper bounds of age in hours, and what they do to the score
+AGE_ADJUSTMENTS = (
+    (4,  +5),
+    (12, +1),
+    (24,  0),
+    (48, -5),
+)
+OLD_ADJUSTMENT = -30
+ERROR_ADJUSTMENT = -30
+# pick some arbitrary time delta in seconds for the first weight
+FIRST_DELTA = 300
+MAX_SCORE = 100
+
+
+class ScoringPolicy:
+    """The numbers that decide how scores move; the defaults are the ones
+    run-process uses.
+
+    Scores are computed over rows of checkoverview (dicts with at least
+    checkrun_id, timestamp of the checkrun, error, age, adaptive_timeout
+    and score), one site at a time.  Subclasses may override any of
+    ignore_run(), adjustment(), adjustments(), weight() and recurrence();
+    site_scores() puts them together.
+
+    With NumPy, adjustments and their weights are done on arrays.  The
+    order of floating point operations is the same either way, and so
+    are the scores, to the bit.
+    """
+    def __init__(self, name='default',
+            ignore_run_threshold=IGNORE_RUN_THRESHOLD,
+            age_adjustments=AGE_ADJUSTMENTS,
+            old_adjustment=OLD_ADJUSTMENT,
+            error_adjustment=ERROR_ADJUSTMENT,
+            first_delta=FIRST_DELTA,
+            max_score=MAX_SCORE,
+            use_numpy=True):
+        self.name = name
+        self.ignore_run_threshold = ignore_run_threshold
+        self.age_adjustments = [(datetime.timedelta(hours = hours), adj) for (hours, adj) in age_adjustments]
+        self.old_adjustment = old_adjustment
+        self.error_adjustment = error_adjustment
+        self.first_delta = first_delta
+        self.max_score = max_score
+        self.use_numpy = use_numpy and numpy is not None
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Read a policy from a JSON object with any of our keyword
+        arguments; age_adjustments is a list of [hours, adjustment].
+        It is named after the file unless it says otherwise.
+        """
+        with open(path) as f:
+            settings = json.load(f)
+        settings.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+        settings.update(kwargs)
+        return cls(**settings)
+
+    def ignore_run(self, total, errors):
+        """Whether a checkrun with total rows, errors of them failed,
+        should not move any scores.
+        """
+        return total > 0 and float(errors)/total > self.ignore_run_threshold
+
+    def adjustment(self, row, ignored):
+        if row['checkrun_id'] in ignored:
+            return 0
+        elif row['adaptive_timeout']:
+            # we gave up on it earlier than usual; don't hold that against the mirror
+            return 0
+        elif row['error'] is not None:
+            return self.error_adjustment
+        for (age, adj) in self.age_adjustments:
+            if row['age'] <= age:
+                return adj
+        return self.old_adjustment
+
+    def adjustments(self, rows, ignored):
+        """The adjustments of rows, as an array if we use NumPy.
+        """
+        if not self.use_numpy:
+            return [self.adjustment(row, ignored) for row in rows]
+        ignore = numpy.array([row['checkrun_id'] in ignored or bool(row['adaptive_timeout']) for row in rows], dtype=bool)
+        error = numpy.array([row['error'] is not None for row in rows], dtype=bool)
+        age = numpy.array([row['age'] if row['age'] is not None else datetime.timedelta(0) for row in rows], dtype='timedelta64[us]')
+        conditions = [ignore, error]
+        choices = [0, self.error_adjustment]
+        for (limit, adj) in self.age_adjustments:
+            conditions.append(age <= numpy.timedelta64(limit))
+            choices.append(adj)
+        return numpy.select(conditions, choices, self.old_adjustment).astype(float)
+
+    def weight(self, previous, timestamp):
+        """How much an adjustment at timestamp counts, if the checkrun
+        before was at previous (None if there was none).
+        """
+        if previous is None:
+            delta = self.first_delta
+        else:
+            delta = (timestamp - previous).total_seconds()
+        return float(delta)/(3600*24)
+
+    def recurrence(self, score, increments):
+        """Add increments to score one after the other, keeping it within
+        [-max_score, max_score]; return the scores after each step.
+
+        This is a plain loop even with NumPy: a healthy mirror sits at
+        the bound most of the time, and a running sum would have to start
+        over at every step.
+        """
+        if self.use_numpy:
+            increments = increments.tolist()
+        result = []
+        for increment in increments:
+            score += increment
+            if   score >  self.max_score: score =  self.max_score
+            elif score < -self.max_score: score = -self.max_score
+            result.append(score)
+        return result
+
+    def site_scores(self, rows, ignored):
+        """Score the rows of one site, in order, that have no score yet;
+        return (row, score) for them.
+
+        Rows that do have a score only tell us where to go on from.
+        """
+        adjustments = self.adjustments(rows, ignored)
+        result = []
+        (score, previous) = (0.0, None)
+        for (unscored, segment) in itertools.groupby(range(len(rows)), key=lambda i: rows[i]['score'] is None):
+            segment = list(segment)
+            if not unscored:
+                (score, previous) = (rows[segment[-1]]['score'], rows[segment[-1]]['timestamp'])
+                continue
+            weights = []
+            for i in segment:
+                weights.append(self.weight(previous, rows[i]['timestamp']))
+                previous = rows[i]['timestamp']
+            if self.use_numpy:
+                increments = adjustments[segment] * numpy.array(weights)
+            else:
+                increments = [float(adjustments[i]) * weight for (i, weight) in zip(segment, weights)]
+            segment_scores = self.recurrence(score, increments)
+            for (i, segment_score) in zip(segment, segment_scores):
+                result.append((rows[i], float(segment_score)))
+            score = segment_scores[-1]
+        return result
+
+def ignored_checkruns(policy, counts):
+    """The ids of the checkruns policy ignores, from a dict of checkrun id
+    -> (total, errors).
+    """
+    return set(checkrun_id for (checkrun_id, (total, errors)) in counts.items() if policy.ignore_run(total, errors))
+
+
+# A replay worker gets the policy, the ignored checkruns and all rows once,
+# when it starts, and the slices of rows of its sites for each task.
+replay_worker = None
+
+def init_replay_worker(policy, ignored, rows):
+    global replay_worker
+    replay_worker = (policy, ignored, rows)
+
+def replay_sites(slices):
+    (policy, ignored, rows) = replay_worker
+    return [score for (start, end) in slices for (_, score) in policy.site_scores(rows[start:end], ignored)]
+
+class Replay:
+    """Score the whole retained history of checkoverview again under a
+    policy, from scratch, without touching the scores run-process keeps.
+
+    All rows are loaded at once, and the sites are scored in jobs worker
+    processes.  As the history before the oldest retained checkrun is
+    gone, every site starts from 0 again there; the replayed scores of
+    the first few days are therefore not comparable.
+    """
+    SHARDS_PER_JOB = 4
+
+    def __init__(self, policy, jobs=1):
+        self.policy = policy
+        self.jobs = jobs
+
+    def load(self, cur):
+        cur.execute("""
+            SELECT
+                checkrun_id,
+                count(*) AS total,
+                count(error) AS errors
+            FROM checkoverview
+            GROUP BY
+                checkrun_id
+            """)
+        counts = dict((row['checkrun_id'], (row['total'], row['errors'])) for row in cur.fetchall())
+
+        cur.execute("""
+            SELECT
+                checkoverview.site_id,
+                checkoverview.checkrun_id,
+                checkoverview.checkrun_timestamp,
+                checkrun.timestamp,
+                NULL AS score,
+                checkoverview.score AS current_score,
+                checkoverview.error,
+                checkoverview.age,
+                checkoverview.adaptive_timeout
+            FROM checkoverview JOIN
+                checkrun ON checkrun.id = checkoverview.checkrun_id
+            ORDER BY
+                checkoverview.site_id,
+                checkrun.timestamp
+            """)
+        return (counts, cur.fetchall())
+
+    def run(self, dbh):
+        """Return the rows of checkoverview with the score they get under
+        our policy, as (row, score).
+        """
+        (counts, rows) = self.load(dbh.cursor())
+        ignored = ignored_checkruns(self.policy, counts)
+        sites = []
+        start = 0
+        for (_, group) in itertools.groupby(rows, key=lambda row: row['site_id']):
+            end = start + len(list(group))
+            sites.append((start, end))
+            start = end
+
+        if self.jobs <= 1:
+            init_replay_worker(self.policy, ignored, rows)
+            scores = replay_sites(sites)
+        else:
+            count = max(1, min(len(sites), self.jobs * self.SHARDS_PER_JOB))
+            shards = [sites[i::count] for i in range(count)]
+            with multiprocessing.Pool(self.jobs, initializer=init_replay_worker, initargs=(self.policy, ignored, rows)) as pool:
+                results = pool.map(replay_sites, shards)
+            # put them back in the order of rows
+            scores = [None] * len(rows)
+            for (shard, shard_scores) in zip(shards, results):
+                i = 0
+                for (start, end) in shard:
+                    scores[start:end] = shard_scores[i:i + end - start]
+                    i += end - start
+        return list(zip(rows, scores))
+
+    def store(self, dbh, results):
+        """Keep the replayed scores in scorereplay, instead of those of an
+        earlier replay under a policy of the same name.
+        """
+        cur = dbh.cursor()
+        cur.execute("DELETE FROM scorereplay WHERE policy = %(policy)s", {'policy': self.policy.name})
+        psycopg2.extras.execute_values(cur,
+            """INSERT INTO scorereplay (policy, site_id, checkrun_id, checkrun_timestamp, score) VALUES %s""",
+            [(self.policy.name, row['site_id'], row['checkrun_id'], row['checkrun_timestamp'], score) for (row, score) in results],
+            template="(%s, %s, %s, %s::timestamptz, %s::double precision)",
+            page_size=1000)
+        dbh.commit()
+
+def report(results, policy, file=sys.stdout, buckets=8):
+    """Print how the latest scores of the sites are distributed, now and
+    as replayed under policy, and how much they moved.
+    """
+    latest = collections.OrderedDict()
+    for (row, score) in results:
+        latest[row['site_id']] = (row['current_score'], score)
+    if len(latest) == 0:
+        print("nothing to replay", file=file)
+        return
+    current = [c for (c, _) in latest.values() if c is not None]
+    replayed = [r for (_, r) in latest.values()]
+
+    max_score = policy.max_score
+    def histogram(scores):
+        counts = [0] * buckets
+        for score in scores:
+            # current scores may lie outside the bounds of policy
+            counts[max(0, min(buckets - 1, int((score + max_score) * buckets / (2 * max_score))))] += 1
+        return counts
+
+    print("latest score of %d sites:" % (len(latest),), file=file)
+    print("%-16s %8s %8s" % ('score', 'current', 'replayed'), file=file)
+    for (i, (c, r)) in enumerate(zip(histogram(current), histogram(replayed))):
+        bounds = (-max_score + i * 2 * max_score / buckets, -max_score + (i + 1) * 2 * max_score / buckets)
+        print("%-16s %8d %8d" % ("%d to %d" % tuple(round(b) for b in bounds), c, r), file=file)
+    print("%-16s %8.1f %8.1f" % ('mean', sum(current) / len(current) if current else 0, sum(replayed) / len(replayed)), file=file)
+    moved = [abs(r - c) for (c, r) in latest.values() if c is not None]
+    print("sites that moved by more than 10: %d; on average they moved by %.1f" % (
+        sum(1 for m in moved if m > 10), sum(moved) / len(moved) if moved else 0), file=file)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Replay the scoring of the retained history under a policy')
+    parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
+    parser.add_argument('--policy', help='JSON file with the policy to replay; default: the current one')
+    parser.add_argument('--jobs', help='score the sites in this many worker processes', type=int, default=1)
+    parser.add_argument('--store', help='keep the scores in scorereplay, under the name of the policy', action='store_true', default=False)
+    args = parser.parse_args()
+
+    policy = ScoringPolicy.from_file(args.policy) if args.policy is not None else ScoringPolicy()
+    dbh = db.RawDB(args.dburl)
+    start = time.monotonic()
+    replay = Replay(policy, args.jobs)
+    results = replay.run(dbh)
+    print("replayed %d rows under policy %s in %.1fs" % (len(results), policy.name, time.monotonic() - start))
+    report(results, policy)
+    if args.store:
+        replay.store(dbh, results)
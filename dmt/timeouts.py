@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+
+# Per-site timeouts learned from how long fetches took in the past.
+#
+# With one fixed timeout for everybody, a few mirrors that do not answer
+# at all decide how long a whole checkrun takes.  Most mirrors answer in
+# well under a second, so we can give up on them much earlier when they
+# do not, and only wait the full time for those that are always slow.
+
+import collections
+import datetime
+import sys
+
+if __name__ == '__main__' and __package__ is None:
+    from pathlib import Path
+    top = Path(__file__).resolve().parents[1]
+    sys.path.append(str(top))
+    import dmt.timeouts
+    __package__ = 'dmt.timeouts'
+
+from sqlalchemy import func
+
+import dmt.db as db
+
+HISTORY = datetime.timedelta(weeks=2)
+PERCENTILE = 0.95
+FACTOR = 3.0
+FLOOR = 5.0
+CEILING = 30.0
+# fetches of a kind we need to have seen before we trust their latency
+MIN_SAMPLES = 10
+# sites whose sitetrace fetches timed out this many times in a row are considered dead
+DEAD_RUNS = 3
+
+
+class TimeoutPolicy:
+    """Timeouts per site and kind of fetch.
+
+    For sites with enough successful fetches of a kind in the last two
+    weeks, the timeout is the 95th percentile of their latency times
+    FACTOR, kept between FLOOR and CEILING.  Failed fetches are left
+    out: one that was refused right away says nothing about how long an
+    answer takes.  Such timeouts are adaptive: if one hits, it says more
+    about our guess than about the mirror, and it should not count
+    against the mirror's score.
+
+    Sites whose last DEAD_RUNS sitetrace fetches in those two weeks all
+    timed out are dead.  If one of those fetches had the full timeout,
+    they only get FLOOR; otherwise, they get the full timeout once more.
+    So a dead site is given the full time every DEAD_RUNS+1 runs.  FLOOR
+    is an adaptive timeout too: a mirror that came back, but takes longer
+    than that to answer, should not be scored down for our short limit.
+    In general, any timeout below CEILING is an adaptive one.
+
+    Everything else gets CEILING, our regular timeout.
+    """
+    def __init__(self, session, now, floor=FLOOR, ceiling=CEILING, factor=FACTOR):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.factor = factor
+
+        self.latency = {}
+        rows = session.query(
+                db.Fetchstat.site_id,
+                db.Fetchstat.kind,
+                func.percentile_cont(PERCENTILE).within_group(db.Fetchstat.elapsed),
+                func.count()). \
+            filter(db.Fetchstat.checkrun_timestamp > now - HISTORY). \
+            filter(db.Fetchstat.error == False). \
+            filter(db.Fetchstat.elapsed > 0). \
+            group_by(db.Fetchstat.site_id, db.Fetchstat.kind)
+        for site_id, kind, latency, samples in rows:
+            if samples >= MIN_SAMPLES:
+                self.latency[(site_id, kind)] = latency
+
+        recent = session.query(
+                db.Fetchstat.site_id,
+                db.Fetchstat.timed_out,
+                db.Fetchstat.timeout,
+                func.row_number().over(partition_by=db.Fetchstat.site_id, order_by=db.Fetchstat.id.desc()).label('n')). \
+            filter(db.Fetchstat.checkrun_timestamp > now - HISTORY). \
+            filter(db.Fetchstat.kind == 'sitetrace'). \
+            subquery()
+        rows = session.query(recent.c.site_id, func.max(recent.c.timeout)). \
+            filter(recent.c.n <= DEAD_RUNS). \
+            group_by(recent.c.site_id). \
+            having(func.count() == DEAD_RUNS). \
+            having(func.bool_and(recent.c.timed_out))
+        # site_id -> whether it already got the full timeout recently
+        self.dead = {}
+        for site_id, max_timeout in rows:
+            self.dead[site_id] = max_timeout >= self.ceiling
+
+        self.stats = collections.Counter()
+
+    def get(self, site_id, kind):
+        """Return (timeout, adaptive) for a fetch of kind from site_id.
+        """
+        if site_id in self.dead:
+            self.stats['dead'] += 1
+            if self.dead[site_id]:
+                return (self.floor, self.floor < self.ceiling)
+            return (self.ceiling, False)
+        latency = self.latency.get((site_id, kind))
+        if latency is None:
+            self.stats['default'] += 1
+            return (self.ceiling, False)
+        timeout = min(max(latency * self.factor, self.floor), self.ceiling)
+        if timeout >= self.ceiling:
+            self.stats['default'] += 1
+            return (self.ceiling, False)
+        self.stats['adaptive'] += 1
+        return (timeout, True)
+
+    def __str__(self):
+        return "%d fetches with adaptive timeouts, %d of dead sites (%d sites), %d with the default timeout" % (
+            self.stats['adaptive'], self.stats['dead'], len(self.dead), self.stats['default'])
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Show the timeouts run-tests would use')
+    parser.add_argument('--dburl', help='database', default=db.MirrorDB.DBURL)
+    args = parser.parse_args()
+
+    session = db.MirrorDB(args.dburl).session()
+    now = datetime.datetime.now().astimezone()
+    policy = TimeoutPolicy(session, now)
+    for site in session.query(db.Site).order_by(db.Site.name):
+        timeouts = []
+        for kind in ('sitetrace', 'mastertrace', 'archive-update', 'traceset', 'sitealias', 'https-sitetrace', 'https-mastertrace'):
+            (timeout, adaptive) = policy.get(site.id, kind)
+            timeouts.append("%s: %4.1fs%s" % (kind, timeout, '*' if adaptive else ' '))
+        print("%-40s %s%s" % (site.name, '  '.join(timeouts), '  (dead)' if site.id in policy.dead else ''))